@@ -1,23 +1,18 @@
 import os
 import sys
 import io
-import json
-import requests
 import configparser
 from flask import Flask, request, jsonify
-from linebot.v3 import WebhookHandler
-from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    ReplyMessageRequest,
-    TextMessage
-)
+
+from job_queue import JobQueue
+from line_client import create_line_client
+from webhook_ingress import WebhookIngress, InvalidSignatureError
+from event_dedup import create_dedup_store
+from warmup import start_warmup, register_health_routes
 
 # 讀取 config.ini 內的 LINE Channel、LINE Login 與自訂參數，方便集中管理密鑰。
 config = configparser.ConfigParser()
 config.read('config.ini')
-configuration = Configuration(access_token=config.get('line-bot', 'channel_access_token'))
 
 # 強制 UTF-8 輸出
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
@@ -27,80 +22,111 @@ sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 # ==========================================
 os.environ["GOOGLE_API_KEY"] = config.get('line-bot', 'GOOGLE_API_KEY')
 LINE_CHANNEL_ACCESS_TOKEN = config.get('line-bot', 'channel_access_token')
-handler = WebhookHandler(config.get('line-bot', 'channel_secret'))
+ingress = WebhookIngress(config.get('line-bot', 'channel_secret'))
+dedup = create_dedup_store(config)
+
+# 背景 worker 數量與佇列上限 (沒設定就用預設值)
+RAG_MAX_WORKERS = config.getint('job-queue', 'max_workers', fallback=4)
+RAG_MAX_QUEUE_SIZE = config.getint('job-queue', 'max_queue_size', fallback=100)
+
+# 向量索引存放位置與向量模型
+CHROMA_PERSIST_DIR = config.get('rag-index', 'persist_dir', fallback='chroma_db')
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# 語意答案快取：相似度門檻、容量、存活秒數
+ANSWER_CACHE_THRESHOLD = config.getfloat('answer-cache', 'threshold', fallback=0.92)
+ANSWER_CACHE_SIZE = config.getint('answer-cache', 'max_size', fallback=512)
+ANSWER_CACHE_TTL = config.getint('answer-cache', 'ttl_seconds', fallback=86400)
+
+# 背景暖機時，訊息最多等幾秒讓 AI 準備好
+STARTUP_WAIT_SECONDS = config.getfloat('startup', 'request_wait_seconds', fallback=20)
 
 # ==========================================
 # 1. 初始化 RAG 系統 (只在啟動時跑一次)
 # ==========================================
-print("🚀 正在初始化 AI 大腦...")
+# langchain、sentence-transformers/torch、Chroma 都在 init_rag_system() 裡才 import，
+# 預設在背景暖機，Flask 一啟動就能回應 / 與 /healthz；就緒狀態看 /readyz
+# mode = preload (gunicorn.conf.py) 時，master 先跑 load_shared_model() 再 fork，
+# 每個 worker 共用同一份 MiniLM 權重 (copy-on-write)，只各自打開索引、建立 Gemini client
+qa_chain = None
+embeddings = None
+answer_cache = None
+
+def load_shared_model():
+    # 唯讀、可以跨 fork 共用的部分：langchain 模組與 MiniLM 權重 (佔記憶體最多的一塊)
+    # [embedding] backend = onnx 時改用 int8 量化的 ONNX 模型 (見 onnx_embeddings.py)
+    global embeddings
+    from onnx_embeddings import create_embeddings
+    from query_cache import CachedQueryEmbeddings
+
+    # 查詢向量有快取，答案快取與 retriever 對同一句話只會跑一次模型
+    embeddings = CachedQueryEmbeddings(create_embeddings(config, EMBEDDING_MODEL_NAME))
+
+def init_rag_system():
+    global qa_chain, answer_cache
+    print("🚀 正在初始化 AI 大腦...")
 
-try:
-    from langchain_community.document_loaders import PyPDFLoader
-    from langchain_text_splitters import RecursiveCharacterTextSplitter
-    from langchain_community.vectorstores import Chroma
-    from langchain_community.embeddings import HuggingFaceEmbeddings
     from langchain_classic.chains.retrieval_qa.base import RetrievalQA
     from langchain_google_genai import ChatGoogleGenerativeAI
-    import urllib.request
+    from rag_index import download_pdf, load_or_build_chroma
+    from answer_cache import SemanticAnswerCache
+
+    if embeddings is None:
+        load_shared_model()
 
     # 檢查並下載 PDF (如果沒有的話)
-    pdf_filename = "bitcoin_paper.pdf"
-    if not os.path.exists(pdf_filename):
-        print("📥 下載 PDF 中...")
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        req = urllib.request.Request("https://bitcoin.org/bitcoin.pdf", headers=headers)
-        with urllib.request.urlopen(req) as response, open(pdf_filename, 'wb') as out_file:
-            out_file.write(response.read())
-
-    # 讀取與建立索引 (這步會花一點時間)
-    loader = PyPDFLoader(pdf_filename)
-    docs = loader.load()
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    texts = text_splitter.split_documents(docs)
-    
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    # 建立向量資料庫
-    db = Chroma.from_documents(texts, embeddings)
+    pdf_filename = download_pdf("bitcoin_paper.pdf")
+
+    # 打開磁碟上的向量索引；只有 PDF 或切塊/模型設定變了才會重新建立
+    # (Chroma 的 client 不能跨 fork 共用，preload 模式下也是每個 worker 自己打開)
+    db = load_or_build_chroma(
+        [pdf_filename],
+        embeddings,
+        model_name=EMBEDDING_MODEL_NAME,
+        chunk_size=1000,
+        chunk_overlap=200,
+        persist_root=CHROMA_PERSIST_DIR,
+    )
     
     # 建立問答鏈
     llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0)
     retriever = db.as_retriever(search_kwargs={"k": 2}) # 找最相關的2段
-    qa_chain = RetrievalQA.from_chain_type(llm=llm, chain_type="stuff", retriever=retriever)
+    chain = RetrievalQA.from_chain_type(llm=llm, chain_type="stuff", retriever=retriever)
+
+    # 答案快取只在記憶體裡：索引、prompt 或模型變了都要重啟，重啟後快取是空的
+    answer_cache = SemanticAnswerCache(
+        embeddings,
+        threshold=ANSWER_CACHE_THRESHOLD,
+        max_size=ANSWER_CACHE_SIZE,
+        ttl_seconds=ANSWER_CACHE_TTL,
+    )
+    # qa_chain 最後才設定，handler 看到它就代表全部準備好了
+    qa_chain = chain
     
     print("✅ AI 系統準備就緒！")
 
-except Exception as e:
-    print(f"❌ RAG 初始化失敗: {e}")
-    sys.exit(1)
+warmup = start_warmup(config, "rag", init_rag_system, preload=load_shared_model)
 
 
 # ==========================================
 # 2. 定義「手動回覆」函式 (取代 SDK)
 # ==========================================
+line_client = create_line_client(config)
+
 def reply_to_line(reply_token, message_text):
     """
-    不使用 SDK，直接用 requests 發送 HTTP POST 給 LINE
+    不使用 SDK，透過共用的 LINE client (連線池 + keep-alive + 自動重試) 發送 HTTP POST 給 LINE
     """
-    api_url = "https://api.line.me/v2/bot/message/reply"
-    
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"
-    }
-    
     # 建構 LINE 要求的 JSON 格式
-    payload = {
-        "replyToken": reply_token,
-        "messages": [
-            {
-                "type": "text",
-                "text": message_text
-            }
-        ]
-    }
+    messages = [
+        {
+            "type": "text",
+            "text": message_text
+        }
+    ]
     
     # 發送請求
-    response = requests.post(api_url, headers=headers, json=payload)
+    response = line_client.reply(reply_token, messages)
     
     if response.status_code == 200:
         print("✅ 訊息回覆成功")
@@ -112,41 +138,85 @@ def reply_to_line(reply_token, message_text):
 # 3. Flask Server 設定
 # ==========================================
 app = Flask(__name__)
+register_health_routes(app, warmup)
+job_queue = JobQueue(max_workers=RAG_MAX_WORKERS, max_queue_size=RAG_MAX_QUEUE_SIZE, name="rag")
 
 @app.route("/callback", methods=['POST'])
 def callback():
-    # 取得 LINE 傳來的原始 JSON 資料
-    body = request.get_json()
+    # 取得 LINE 傳來的原始資料 (bytes)，驗證簽章後才解析
+    body = request.get_data()
     
     # 印出來看看 LINE 傳了什麼給我們 (除錯用)
-    print(f"📩 收到 Webhook: {json.dumps(body, indent=2, ensure_ascii=False)}")
+    print(f"📩 收到 Webhook: {body.decode('utf-8', 'replace')}")
     
     try:
         # 解析 events (LINE 可能一次傳送多個事件)
-        events = body.get('events', [])
-        
-        for event in events:
-            # 我們只處理「文字訊息」事件
-            if event.get('type') == 'message' and event['message'].get('type') == 'text':
-                user_msg = event['message']['text']
-                reply_token = event['replyToken']
-                
-                print(f"👤 用戶說: {user_msg}")
-                
-                # 呼叫 RAG AI 取得答案
-                print("🤖 AI 思考中...")
-                ai_response = qa_chain.invoke(user_msg)
-                answer = ai_response['result'] if isinstance(ai_response, dict) else ai_response
-                
-                # 使用我們自定義的 requests 函式回傳
-                reply_to_line(reply_token, answer)
-                
-    except Exception as e:
+        events = ingress.handle(body, request.headers.get('X-Line-Signature', ''))
+    except InvalidSignatureError:
+        print("❌ 簽章驗證失敗！可能是不合法的請求。")
+        return 'Invalid signature', 400
+    except ValueError as e:
         print(f"❌ 處理訊息時發生錯誤: {e}")
+        return 'Bad request', 400
+
+    for event in events:
+        # 我們只處理「文字訊息」事件，交給背景 worker 跑 RAG
+        if event.is_text_message:
+            # 重送的事件已經處理過或正在處理中：不要再跑一次檢索 + Gemini
+            if not dedup.claim(event.webhook_event_id):
+                print(f"🔁 略過重複事件 {event.webhook_event_id} (isRedelivery={event.is_redelivery})")
+                continue
+            if not job_queue.submit(dedup.run, event.webhook_event_id, handle_text_event, event):
+                dedup.release(event.webhook_event_id)
+                print(f"⚠️ 工作佇列已滿 (深度 {job_queue.depth()})，拒絕新訊息")
+                reply_to_line(event.reply_token, "目前詢問人數過多，請稍後再試一次 🙏")
     
     # 必須回傳 200 OK 給 LINE，不然它會以為傳送失敗
     return 'OK', 200
 
+
+def handle_text_event(event):
+    # 在背景 worker 中執行：檢索 + 生成 + 回覆
+    user_msg = event.text
+    reply_token = event.reply_token
+    
+    print(f"👤 用戶說: {user_msg}")
+
+    # 背景暖機還沒完成：稍等一下，等不到就請用戶稍後再問
+    if not warmup.wait(STARTUP_WAIT_SECONDS):
+        reply_to_line(reply_token, "系統啟動中，請稍後...")
+        return
+    
+    # 先查答案快取，別人問過差不多的問題就不用再檢索 + 呼叫 Gemini
+    answer = answer_cache.lookup(user_msg)
+    if answer is not None:
+        print("⚡ 命中答案快取")
+    else:
+        # 呼叫 RAG AI 取得答案
+        print("🤖 AI 思考中...")
+        ai_response = qa_chain.invoke(user_msg)
+        answer = ai_response['result'] if isinstance(ai_response, dict) else ai_response
+        answer_cache.store(user_msg, answer)
+    
+    # 使用我們自定義的 requests 函式回傳
+    reply_to_line(reply_token, answer)
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    # 佇列深度、執行中數量、拒絕數、快取命中率等指標
+    return jsonify({
+        "startup": warmup.status(),
+        "job_queue": job_queue.stats(),
+        "query_embedding_cache": embeddings.stats() if embeddings else None,
+        "answer_cache": answer_cache.stats() if answer_cache else None,
+        "line_api_latency": line_client.stats(),
+        "webhook": ingress.stats(),
+        "webhook_dedup": dedup.stats(),
+    })
+
 if __name__ == "__main__":
+    # 直接執行時沒有 fork；preload 模式也要在這裡開始暖機 (其他模式已經開始了，不會重跑)
+    warmup.start()
     # 啟動 Server 在 5001 port
     app.run(port=5001)
\ No newline at end of file
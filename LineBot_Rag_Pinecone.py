@@ -2,25 +2,23 @@ import os
 import sys
 import io
 import time
-import json
-import requests
 import configparser
-import hashlib
-import hmac
-import base64
-
-from flask import Flask, request, abort
-
-# LangChain & AI 相關
-from langchain_core.prompts import PromptTemplate
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_classic.chains.conversational_retrieval.base import ConversationalRetrievalChain
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_pinecone import PineconeVectorStore
-from pinecone import Pinecone, ServerlessSpec
-import urllib.request
+
+from flask import Flask, request, abort, jsonify
+
+from job_queue import JobQueue
+from rag_index import download_pdf
+from ingest_pinecone import INDEX_NAME, DEFAULT_MANIFEST, ingest
+from query_cache import CachedQueryEmbeddings
+from question_rewriter import QuestionRewriter
+from memory_store import create_history_store
+from history_budget import trim_history, PromptSizeTracker
+from line_stream import StreamingLineSender, stream_rag_answer
+from line_client import create_line_client
+from webhook_ingress import WebhookIngress, InvalidSignatureError
+from event_dedup import create_dedup_store
+from user_scheduler import create_user_scheduler
+from warmup import start_warmup, register_health_routes
 
 # 強制 UTF-8 輸出
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
@@ -33,61 +31,86 @@ config.read('config.ini')
 
 # 設定環境變數
 os.environ["GOOGLE_API_KEY"] = config.get('line-bot', 'GOOGLE_API_KEY')
-os.environ["PINECONE_API_KEY"] = config.get('line-bot', 'PINECONE_API_KEY')
+# [vector-store] backend = local 時不需要 Pinecone 金鑰 (見 local_vector_store.py)
+os.environ["PINECONE_API_KEY"] = config.get('line-bot', 'PINECONE_API_KEY', fallback='')
 
 LINE_CHANNEL_ACCESS_TOKEN = config.get('line-bot', 'channel_access_token')
 LINE_CHANNEL_SECRET = config.get('line-bot', 'channel_secret')
 
+# 背景 worker 數量與佇列上限 (沒設定就用預設值)
+RAG_MAX_WORKERS = config.getint('job-queue', 'max_workers', fallback=4)
+RAG_MAX_QUEUE_SIZE = config.getint('job-queue', 'max_queue_size', fallback=100)
+
+# 查詢向量快取的容量與存活秒數
+QUERY_CACHE_SIZE = config.getint('query-cache', 'max_size', fallback=1024)
+QUERY_CACHE_TTL = config.getint('query-cache', 'ttl_seconds', fallback=3600)
+
+# 問題改寫模式：llm / auto / local (見 question_rewriter.py)
+question_rewriter = QuestionRewriter(config.get('conversation', 'condense_mode', fallback='auto'))
+
+# 歷史紀錄的 token 預算；超過時 drop (丟掉舊對話) 或 summarize (壓成一行摘要)
+HISTORY_TOKEN_BUDGET = config.getint('conversation', 'history_token_budget', fallback=1500)
+HISTORY_OVERFLOW = config.get('conversation', 'history_overflow', fallback='drop')
+prompt_sizes = PromptSizeTracker()
+
+# 串流回覆：第一句先 reply，之後的段落用 push 補送 (push 會消耗推播額度)
+STREAMING_ENABLED = config.getboolean('streaming', 'enabled', fallback=False)
+STREAMING_MIN_PUSH_CHARS = config.getint('streaming', 'min_push_chars', fallback=200)
+STREAMING_MAX_PUSHES = config.getint('streaming', 'max_pushes', fallback=4)
+
+# 背景暖機時，訊息最多等幾秒讓 AI 準備好
+STARTUP_WAIT_SECONDS = config.getfloat('startup', 'request_wait_seconds', fallback=20)
+
 # ==========================================
-# 2. 初始化 AI 大腦 (Pinecone RAG) - 保持不變
+# 2. 初始化 AI 大腦 (Pinecone RAG)
 # ==========================================
-print("🚀 正在初始化 AI 大腦 (連接 Pinecone)...")
+# langchain、sentence-transformers/torch、Pinecone SDK 都在 init_rag_system() 裡才 import，
+# 預設在背景暖機，Flask 一啟動就能回應 / 與 /healthz；就緒狀態看 /readyz
 qa_chain = None 
+query_embeddings = None
+vector_index = None
+answer_llm = None
+answer_prompt = None
 
 def init_rag_system():
-    global qa_chain
-    try:
-        embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-        pc = Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
-        index_name = "line-bot-bitcoin"
-
-        # 檢查並建立 Index
-        if index_name not in pc.list_indexes().names():
-            print(f"📦 索引 {index_name} 不存在，正在建立中...")
-            pc.create_index(
-                name=index_name,
-                dimension=384, 
-                metric="cosine",
-                spec=ServerlessSpec(cloud="aws", region="us-east-1")
-            )
-            while not pc.describe_index(index_name).status['ready']:
-                time.sleep(1)
-
-        index = pc.Index(index_name)
-        
-        # 檢查是否需要上傳資料
-        if index.describe_index_stats()['total_vector_count'] == 0:
-            print("📥 雲端資料庫為空，開始下載並處理 PDF...")
-            pdf_filename = "bitcoin_paper.pdf"
-            if not os.path.exists(pdf_filename):
-                headers = {'User-Agent': 'Mozilla/5.0'}
-                req = urllib.request.Request("https://bitcoin.org/bitcoin.pdf", headers=headers)
-                with urllib.request.urlopen(req) as response, open(pdf_filename, 'wb') as out_file:
-                    out_file.write(response.read())
-
-            loader = PyPDFLoader(pdf_filename)
-            docs = loader.load()
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-            texts = text_splitter.split_documents(docs)
-            
-            PineconeVectorStore.from_documents(texts, embeddings, index_name=index_name)
-            print("✅ 資料上傳完畢！")
-        
-        vector_store = PineconeVectorStore.from_existing_index(index_name, embeddings)
-        retriever = vector_store.as_retriever(search_kwargs={"k": 2})
-        llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0)
+    global qa_chain, query_embeddings, vector_index, answer_llm, answer_prompt
+    print("🚀 正在初始化 AI 大腦 (連接 Pinecone)...")
+
+    # LangChain & AI 相關
+    from langchain_core.prompts import PromptTemplate
+    from langchain_classic.chains.conversational_retrieval.base import ConversationalRetrievalChain
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    from onnx_embeddings import create_embeddings
+    from local_vector_store import open_index, create_vector_store, manifest_path_for
+
+    index_name = INDEX_NAME
 
-        custom_template = """
+    # Pinecone 或本地索引 ([vector-store] backend)，兩者的 Index 介面相同
+    index = open_index(config, index_name)
+    manifest_path = manifest_path_for(index, DEFAULT_MANIFEST)
+    embeddings = create_embeddings(config)
+
+    # 雲端是空的就先匯入一次；之後新增或修改 PDF 請改跑 ingest_pinecone.py 做增量更新
+    # 這裡是在背景暖機執行緒裡 (Flask、JobQueue 的執行緒都在跑)，不開 process pool，
+    # 直接用查詢的模型向量化；文件多的話請先跑 ingest_pinecone.py (會用 [embedding] workers 開多行程)
+    if index.describe_index_stats()['total_vector_count'] == 0:
+        print("📥 雲端資料庫為空，開始下載並處理 PDF...")
+        pdf_filename = download_pdf("bitcoin_paper.pdf")
+        ingest([pdf_filename], index, embeddings, manifest_path=manifest_path, index_name=index_name)
+        print("✅ 資料上傳完畢！")
+
+    # 查詢向量快取：重複的問題不必再跑一次 MiniLM
+    query_embeddings = CachedQueryEmbeddings(
+        embeddings,
+        max_size=QUERY_CACHE_SIZE,
+        ttl_seconds=QUERY_CACHE_TTL,
+    )
+    vector_store = create_vector_store(config, index, index_name, query_embeddings)
+    vector_index = index
+    retriever = vector_store.as_retriever(search_kwargs={"k": 2})
+    llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0)
+
+    custom_template = """
         你是黃氏企業的 AI 助理。請根據下方的【參考文件】回答用戶的問題。
         如果【參考文件】中沒有答案，你可以運用你原本的知識來回答，但請說明這是你的補充知識。
         
@@ -97,124 +120,177 @@ def init_rag_system():
         用戶問題：{question}
         回答：
         """
-        PROMPT = PromptTemplate(template=custom_template, input_variables=["context", "question"])
+    PROMPT = PromptTemplate(template=custom_template, input_variables=["context", "question"])
 
-        qa_chain = ConversationalRetrievalChain.from_llm(
-            llm=llm,
-            retriever=retriever,
-            return_source_documents=True,
-            combine_docs_chain_kwargs={"prompt": PROMPT}
-        )
-        print("✅ AI 系統準備就緒！")
-
-    except Exception as e:
-        print(f"❌ RAG 初始化失敗: {e}")
+    chain = ConversationalRetrievalChain.from_llm(
+        llm=llm,
+        retriever=retriever,
+        return_source_documents=True,
+        combine_docs_chain_kwargs={"prompt": PROMPT}
+    )
+    # 串流模式會直接用同一個 llm 與 prompt 逐 token 產生答案
+    answer_llm, answer_prompt = llm, PROMPT
+    # qa_chain 最後才設定，handler 看到它就代表全部準備好了
+    qa_chain = chain
+    print("✅ AI 系統準備就緒！")
 
-init_rag_system()
+warmup = start_warmup(config, "rag", init_rag_system)
 
 # ==========================================
-# 3. 記憶體管理
+# 3. 記憶體管理 (每人輪數上限 + 閒置過期 + 全域上限，可切換成 SQLite 讓 worker 共用)
 # ==========================================
-user_histories = {}
+history_store = create_history_store(config)
 
 # ==========================================
-# 4. 定義發送訊息函式 (純 Requests)
+# 4. 定義發送訊息函式 (共用 LINE client)
 # ==========================================
+line_client = create_line_client(config)
+
 def reply_to_line(reply_token, message_text):
-    api_url = "https://api.line.me/v2/bot/message/reply"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"
-    }
-    # 建構 JSON Body
-    payload = {
-        "replyToken": reply_token,
-        "messages": [
-            {
-                "type": "text",
-                "text": message_text
-            }
-        ]
-    }
+    reply_messages_to_line(reply_token, [{"type": "text", "text": message_text}])
+
+
+def reply_messages_to_line(reply_token, messages):
+    _send_to_line(lambda: line_client.reply(reply_token, messages), "回覆訊息")
+
+
+def push_to_line(user_id, messages):
+    _send_to_line(lambda: line_client.push(user_id, messages), "推播訊息")
+
+
+def _send_to_line(call, action):
+    # 透過共用的 LINE client (連線池 + keep-alive + 429/5xx 自動重試)
+    response = None
     try:
-        response = requests.post(api_url, headers=headers, json=payload)
+        response = call()
         response.raise_for_status() # 如果是 4xx 或 5xx 會報錯
     except Exception as e:
-        print(f"⚠️ 回覆訊息失敗: {e}, 回應內容: {response.text}")
+        print(f"⚠️ {action}失敗: {e}, 回應內容: {response.text if response is not None else ''}")
 
 # ==========================================
 # 5. Flask Server (手動處理 Webhook)
 # ==========================================
 app = Flask(__name__)
+register_health_routes(app, warmup)
+job_queue = JobQueue(max_workers=RAG_MAX_WORKERS, max_queue_size=RAG_MAX_QUEUE_SIZE, name="rag")
+ingress = WebhookIngress(LINE_CHANNEL_SECRET)
+dedup = create_dedup_store(config)
 
 @app.route("/callback", methods=['POST'])
 def callback():
-    # 1. 取得 Header 中的簽章
+    # 1. 直接拿原始 bytes 驗簽 (不先解碼成字串)，驗過才解析 JSON
     signature = request.headers.get('X-Line-Signature', '')
-    
-    # 2. 取得 Body 內容 (字串格式)
-    body = request.get_data(as_text=True)
+    body = request.get_data()
 
-    # 3. 手動驗證簽章 (安全機制)
-    # 演算法：HMAC-SHA256(ChannelSecret, Body) 然後轉 Base64
     try:
-        hash_val = hmac.new(
-            LINE_CHANNEL_SECRET.encode('utf-8'),
-            body.encode('utf-8'),
-            hashlib.sha256
-        ).digest()
-        computed_signature = base64.b64encode(hash_val).decode('utf-8')
-        
-        if signature != computed_signature:
-            print("❌ 簽章驗證失敗！可能是不合法的請求。")
-            return 'Invalid signature', 400
-    except Exception as e:
-        print(f"❌ 驗證過程發生錯誤: {e}")
-        return 'Error', 500
+        events = ingress.handle(body, signature)
+    except InvalidSignatureError:
+        print("❌ 簽章驗證失敗！可能是不合法的請求。")
+        return 'Invalid signature', 400
+    except ValueError as e:
+        print(f"❌ Webhook 內容不是合法的 JSON: {e}")
+        return 'Bad request', 400
 
-    # 4. 解析 JSON 並處理事件
-    try:
-        events_data = json.loads(body) # 將 JSON 字串轉為 Python Dict
-        events = events_data.get('events', [])
-
-        for event in events:
-            # 只處理文字訊息事件
-            if event.get('type') == 'message' and event['message'].get('type') == 'text':
-                
-                user_msg = event['message']['text']
-                reply_token = event['replyToken']
-                user_id = event['source']['userId']
-                
-                print(f"👤 用戶({user_id[:5]}...) 說: {user_msg}")
-
-                # 若 AI 還沒好
-                if qa_chain is None:
-                    reply_to_line(reply_token, "系統啟動中，請稍後...")
-                    continue
-
-                # ---- RAG 邏輯開始 ----
-                chat_history = user_histories.get(user_id, [])
-                
-                result = qa_chain.invoke({
-                    "question": user_msg, 
-                    "chat_history": chat_history
-                })
-                answer = result['answer']
-                
-                # 更新記憶
-                chat_history.append((user_msg, answer))
-                if len(chat_history) > 5: chat_history.pop(0)
-                user_histories[user_id] = chat_history
-                # ---- RAG 邏輯結束 ----
-
-                # 發送回覆 (Call Requests)
-                reply_to_line(reply_token, answer)
+    # 2. 把事件丟進背景佇列後立刻回 200 給 LINE
+    for event in events:
+        # 只處理文字訊息事件
+        if event.is_text_message:
+            # 重送的事件已經處理過或正在處理中：不要再跑一次檢索 + Gemini
+            if not dedup.claim(event.webhook_event_id):
+                print(f"🔁 略過重複事件 {event.webhook_event_id} (isRedelivery={event.is_redelivery})")
+                continue
+            # 同一用戶的訊息依序處理 (可合併連續訊息)，並受每人/全域限速
+            scheduler.submit(event.user_id, event)
 
-    except Exception as e:
-        print(f"❌ 處理訊息失敗: {e}")
-        return 'Error', 500
-    
     return 'OK', 200
 
+
+def handle_text_event(event, user_msg):
+    # 在背景 worker 中執行：檢索 + 生成 + 回覆 (user_msg 可能是幾則連續訊息合併後的問題)
+    reply_token = event.reply_token
+    user_id = event.user_id
+    
+    print(f"👤 用戶({user_id[:5]}...) 說: {user_msg}")
+
+    # 若 AI 還沒好 (背景暖機中)：稍等一下，等不到就請用戶稍後再問
+    if not warmup.wait(STARTUP_WAIT_SECONDS):
+        reply_to_line(reply_token, "系統啟動中，請稍後...")
+        return
+
+    # ---- RAG 邏輯開始 ----
+    chat_history = history_store.get(user_id)
+    
+    # 完整的問題不需要 Gemini 改寫，rewriter 會給空歷史讓 chain 跳過那一步
+    # 歷史依 token 預算修剪，避免長答案把 prompt 撐大
+    trimmed_history, history_tokens = trim_history(chat_history, HISTORY_TOKEN_BUDGET, HISTORY_OVERFLOW)
+    question, history_for_chain = question_rewriter.prepare(user_msg, trimmed_history)
+
+    if STREAMING_ENABLED:
+        # 串流模式：第一句話一產生就回覆，剩下的內容邊生成邊推播
+        answer = stream_answer_to_line(reply_token, user_id, question, history_for_chain, history_tokens)
+    else:
+        result = qa_chain.invoke({
+            "question": question, 
+            "chat_history": history_for_chain
+        })
+        answer = result['answer']
+        prompt_sizes.record(
+            question,
+            history_tokens if history_for_chain else 0,
+            result.get('source_documents', []),
+        )
+        # 發送回覆 (Call Requests)
+        reply_to_line(reply_token, answer)
+    
+    # 更新記憶
+    history_store.append(user_id, user_msg, answer)
+    # ---- RAG 邏輯結束 ----
+
+
+def stream_answer_to_line(reply_token, user_id, question, history_for_chain, history_tokens):
+    sender = StreamingLineSender(
+        send_reply=lambda messages: reply_messages_to_line(reply_token, messages),
+        send_push=lambda messages: push_to_line(user_id, messages),
+        min_push_chars=STREAMING_MIN_PUSH_CHARS,
+        max_pushes=STREAMING_MAX_PUSHES,
+    )
+    question, docs, tokens = stream_rag_answer(qa_chain, answer_llm, answer_prompt, question, history_for_chain)
+    prompt_sizes.record(question, history_tokens if history_for_chain else 0, docs)
+    for token in tokens:
+        sender.feed(token)
+    return sender.finish()
+
+
+def reject_text_event(event, reason):
+    # 被排程器拒絕的訊息：告訴用戶稍後再試，不要讓 LINE 那邊沒有回應
+    if reason == "user_rate":
+        reply_to_line(event.reply_token, "您傳訊息的速度有點快，請稍等一下再問 🙏")
+    else:
+        reply_to_line(event.reply_token, "目前詢問人數過多，請稍後再試一次 🙏")
+
+
+# 每位用戶的排程器 (要在 handle_text_event 定義之後建立)
+scheduler = create_user_scheduler(config, job_queue, handle_text_event, on_reject=reject_text_event, dedup=dedup)
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    # 佇列深度、執行中數量、拒絕數、快取命中率等指標
+    return jsonify({
+        "startup": warmup.status(),
+        "job_queue": job_queue.stats(),
+        "user_scheduler": scheduler.stats(),
+        "query_embedding_cache": query_embeddings.stats() if query_embeddings else None,
+        "question_rewriter": question_rewriter.stats(),
+        "history_store": history_store.stats(),
+        "prompt_size": prompt_sizes.stats(),
+        "line_api_latency": line_client.stats(),
+        "webhook": ingress.stats(),
+        "webhook_dedup": dedup.stats(),
+        "vector_store": vector_index.stats() if hasattr(vector_index, "stats") else None,
+    })
+
 if __name__ == "__main__":
+    # 直接執行時沒有 fork；preload 模式也要在這裡開始暖機 (其他模式已經開始了，不會重跑)
+    warmup.start()
     app.run(port=5001)
\ No newline at end of file
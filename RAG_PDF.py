@@ -73,9 +73,21 @@ print(f"🔍 範例段落内容: {texts[0].page_content[:100]}...")
 # ==========================================
 print("⏳ 正在建立向量索引 (這可能需要幾秒鐘)...")
 
-embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+# config.ini 的 [embedding] workers > 1 時，改用多行程批次向量化引擎
+embedding_workers = config.getint('embedding', 'workers', fallback=1)
+if embedding_workers > 1:
+    from embedding_engine import BatchEmbeddingEngine
+    embeddings = BatchEmbeddingEngine(
+        batch_size=config.getint('embedding', 'batch_size', fallback=64),
+        num_workers=embedding_workers,
+    )
+else:
+    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
 db = Chroma.from_documents(texts, embeddings)
 
+if embedding_workers > 1:
+    print(f"⚡ 向量化速度: {embeddings.chunks_per_sec():.1f} chunks/sec")
+    embeddings.close()
 print("✅ 資料庫準備就緒！")
 
 # ==========================================
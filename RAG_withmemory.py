@@ -2,19 +2,19 @@ import os
 import sys
 import io
 import json
-import requests
 import configparser
 from flask import Flask, request, jsonify
-from linebot.v3 import WebhookHandler
-from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    ReplyMessageRequest,
-    TextMessage
-)
 
-from langchain_core.prompts import PromptTemplate
+from job_queue import JobQueue
+from question_rewriter import QuestionRewriter
+from memory_store import create_history_store
+from history_budget import trim_history, PromptSizeTracker
+from line_stream import StreamingLineSender, stream_rag_answer
+from line_client import create_line_client
+from webhook_ingress import WebhookIngress, InvalidSignatureError
+from event_dedup import create_dedup_store
+from user_scheduler import create_user_scheduler
+from warmup import start_warmup, register_health_routes
 
 # 強制 UTF-8 輸出
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
@@ -22,43 +22,79 @@ sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 # 讀取 config.ini 內的 LINE Channel、LINE Login 與自訂參數，方便集中管理密鑰。
 config = configparser.ConfigParser()
 config.read('config.ini')
-configuration = Configuration(access_token=config.get('line-bot', 'channel_access_token'))
 os.environ["GOOGLE_API_KEY"] = config.get('line-bot', 'GOOGLE_API_KEY')
 LINE_CHANNEL_ACCESS_TOKEN = config.get('line-bot', 'channel_access_token')
-handler = WebhookHandler(config.get('line-bot', 'channel_secret'))
+ingress = WebhookIngress(config.get('line-bot', 'channel_secret'))
+dedup = create_dedup_store(config)
+
+# 背景 worker 數量與佇列上限 (沒設定就用預設值)
+RAG_MAX_WORKERS = config.getint('job-queue', 'max_workers', fallback=4)
+RAG_MAX_QUEUE_SIZE = config.getint('job-queue', 'max_queue_size', fallback=100)
+
+# 向量索引存放位置與向量模型
+CHROMA_PERSIST_DIR = config.get('rag-index', 'persist_dir', fallback='chroma_db')
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# 語意答案快取：相似度門檻、容量、存活秒數
+ANSWER_CACHE_THRESHOLD = config.getfloat('answer-cache', 'threshold', fallback=0.92)
+ANSWER_CACHE_SIZE = config.getint('answer-cache', 'max_size', fallback=512)
+ANSWER_CACHE_TTL = config.getint('answer-cache', 'ttl_seconds', fallback=86400)
+
+# 問題改寫模式：llm / auto / local (見 question_rewriter.py)
+question_rewriter = QuestionRewriter(config.get('conversation', 'condense_mode', fallback='auto'))
+
+# 歷史紀錄的 token 預算；超過時 drop (丟掉舊對話) 或 summarize (壓成一行摘要)
+HISTORY_TOKEN_BUDGET = config.getint('conversation', 'history_token_budget', fallback=1500)
+HISTORY_OVERFLOW = config.get('conversation', 'history_overflow', fallback='drop')
+prompt_sizes = PromptSizeTracker()
+
+# 串流回覆：第一句先 reply，之後的段落用 push 補送 (push 會消耗推播額度)
+STREAMING_ENABLED = config.getboolean('streaming', 'enabled', fallback=False)
+STREAMING_MIN_PUSH_CHARS = config.getint('streaming', 'min_push_chars', fallback=200)
+STREAMING_MAX_PUSHES = config.getint('streaming', 'max_pushes', fallback=4)
+
+# 背景暖機時，訊息最多等幾秒讓 AI 準備好
+STARTUP_WAIT_SECONDS = config.getfloat('startup', 'request_wait_seconds', fallback=20)
 
 
 # ==========================================
 # 1. 初始化 RAG 系統
 # ==========================================
-print("🚀 正在初始化 AI 大腦...")
+# langchain、sentence-transformers/torch、Chroma 都在 init_rag_system() 裡才 import，
+# 預設在背景暖機，Flask 一啟動就能回應 / 與 /healthz；就緒狀態看 /readyz
+qa_chain = None
+embeddings = None
+answer_cache = None
+llm = None
+PROMPT = None
+
+def init_rag_system():
+    global qa_chain, embeddings, answer_cache, llm, PROMPT
+    print("🚀 正在初始化 AI 大腦...")
 
-try:
-    from langchain_community.document_loaders import PyPDFLoader
-    from langchain_text_splitters import RecursiveCharacterTextSplitter
-    from langchain_community.vectorstores import Chroma
-    from langchain_community.embeddings import HuggingFaceEmbeddings
+    from langchain_core.prompts import PromptTemplate
     from langchain_classic.chains.conversational_retrieval.base import ConversationalRetrievalChain # 👈 升級：使用對話鏈
     from langchain_google_genai import ChatGoogleGenerativeAI
-    import urllib.request
-
-    # 檢查並下載 PDF
-    pdf_filename = "bitcoin_paper.pdf"
-    if not os.path.exists(pdf_filename):
-        print("📥 下載 PDF 中...")
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        req = urllib.request.Request("https://bitcoin.org/bitcoin.pdf", headers=headers)
-        with urllib.request.urlopen(req) as response, open(pdf_filename, 'wb') as out_file:
-            out_file.write(response.read())
-
-    # 建立索引
-    loader = PyPDFLoader(pdf_filename)
-    docs = loader.load()
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    texts = text_splitter.split_documents(docs)
-    
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    db = Chroma.from_documents(texts, embeddings)
+    from rag_index import download_pdf, load_or_build_chroma
+    from query_cache import CachedQueryEmbeddings
+    from onnx_embeddings import create_embeddings
+    from answer_cache import SemanticAnswerCache
+
+    # 檢查並下載 PDF (如果沒有的話)
+    pdf_filename = download_pdf("bitcoin_paper.pdf")
+
+    # 打開磁碟上的向量索引；只有 PDF 或切塊/模型設定變了才會重新建立
+    # 查詢向量有快取，答案快取與 retriever 對同一句話只會跑一次模型
+    # [embedding] backend = onnx 時改用 int8 量化的 ONNX 模型 (見 onnx_embeddings.py)
+    embeddings = CachedQueryEmbeddings(create_embeddings(config, EMBEDDING_MODEL_NAME))
+    db = load_or_build_chroma(
+        [pdf_filename],
+        embeddings,
+        model_name=EMBEDDING_MODEL_NAME,
+        chunk_size=1000,
+        chunk_overlap=200,
+        persist_root=CHROMA_PERSIST_DIR,
+    )
     
     # 建立 Retriever
     retriever = db.as_retriever(search_kwargs={"k": 2})
@@ -89,91 +125,182 @@ try:
     # 1. 把用戶的新問題 + 歷史紀錄 -> 改寫成一個完整的問題
     # 2. 去資料庫搜尋
     # 3. 回答
-    qa_chain = ConversationalRetrievalChain.from_llm(
+    chain = ConversationalRetrievalChain.from_llm(
         llm=llm,
         retriever=retriever,
         return_source_documents=True,
         combine_docs_chain_kwargs={"prompt": PROMPT}   # 👈 把我們的規則塞進去
     )
+
+    # 答案快取只在記憶體裡：索引、prompt 或模型變了都要重啟，重啟後快取是空的
+    # (只在沒有對話紀錄時使用，有上下文的問題答案因人而異)
+    answer_cache = SemanticAnswerCache(
+        embeddings,
+        threshold=ANSWER_CACHE_THRESHOLD,
+        max_size=ANSWER_CACHE_SIZE,
+        ttl_seconds=ANSWER_CACHE_TTL,
+    )
     
+    # qa_chain 最後才設定，handler 看到它就代表全部準備好了
+    qa_chain = chain
+
     print("✅ AI 系統準備就緒 (已啟用記憶功能)！")
 
-except Exception as e:
-    print(f"❌ RAG 初始化失敗: {e}")
-    sys.exit(1)
+warmup = start_warmup(config, "rag", init_rag_system)
 
 # ==========================================
 # 🧠 記憶體管理區
 # ==========================================
-# 用來儲存不同使用者的對話紀錄
-# 格式: { 'user_id_1': [('問1', '答1'), ('問2', '答2')], ... }
-user_histories = {}
+# 用來儲存不同使用者的對話紀錄，每位用戶的格式: [('問1', '答1'), ('問2', '答2')]
+# 有每人輪數上限、閒置過期與全域上限；設定 memory_backend = sqlite 可讓多個 worker 共用
+history_store = create_history_store(config)
 
 # ==========================================
-# 2. 定義「手動回覆」函式 (Requests)
+# 2. 定義「手動回覆」函式 (共用 LINE client：連線池 + keep-alive + 自動重試)
 # ==========================================
+line_client = create_line_client(config)
+
 def reply_to_line(reply_token, message_text):
-    api_url = "https://api.line.me/v2/bot/message/reply"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"
-    }
-    payload = {
-        "replyToken": reply_token,
-        "messages": [{"type": "text", "text": message_text}]
-    }
-    requests.post(api_url, headers=headers, json=payload)
+    reply_messages_to_line(reply_token, [{"type": "text", "text": message_text}])
+
+def reply_messages_to_line(reply_token, messages):
+    line_client.reply(reply_token, messages)
+
+def push_to_line(user_id, messages):
+    # 串流模式用：reply 只能用一次，後續段落改用 push 送給同一位用戶
+    line_client.push(user_id, messages)
 
 # ==========================================
 # 3. Flask Server
 # ==========================================
 app = Flask(__name__)
+register_health_routes(app, warmup)
+job_queue = JobQueue(max_workers=RAG_MAX_WORKERS, max_queue_size=RAG_MAX_QUEUE_SIZE, name="rag")
 
 @app.route("/callback", methods=['POST'])
 def callback():
-    body = request.get_json()
-    
+    # 👇 用原始 bytes 驗證 X-Line-Signature，驗過才解析
     try:
-        events = body.get('events', [])
-        for event in events:
-            if event.get('type') == 'message' and event['message'].get('type') == 'text':
-                user_msg = event['message']['text']
-                reply_token = event['replyToken']
-                
-                # 👇 取得 User ID (這是每個用戶在 LINE 裡的唯一身分證)
-                user_id = event['source']['userId']
-                print(f"👤 用戶({user_id[:5]}...) 說: {user_msg}")
-                
-                # 👇 1. 取出這位用戶的歷史紀錄 (如果沒有就給空清單)
-                chat_history = user_histories.get(user_id, [])
-                
-                print("🤖 AI 思考中 (包含記憶)...")
-                
-                # 👇 2. 呼叫 AI，並把 chat_history 傳進去
-                # 這裡的 invoke 參數變了，需要傳入 question 和 chat_history
-                result = qa_chain.invoke({
-                    "question": user_msg, 
-                    "chat_history": chat_history
-                })
-                
-                answer = result['answer']
-                
-                # 👇 3. 更新記憶 (把這次的問答加進去)
-                # 限制記憶長度：只保留最近 5 組對話，避免 Token 爆掉
-                chat_history.append((user_msg, answer))
-                if len(chat_history) > 5:
-                    chat_history.pop(0) # 移除最舊的一筆
-                
-                # 存回全域變數
-                user_histories[user_id] = chat_history
-                
-                # 回覆用戶
-                reply_to_line(reply_token, answer)
-                
-    except Exception as e:
+        events = ingress.handle(request.get_data(), request.headers.get('X-Line-Signature', ''))
+    except InvalidSignatureError:
+        print("❌ 簽章驗證失敗！可能是不合法的請求。")
+        return 'Invalid signature', 400
+    except ValueError as e:
         print(f"❌ 錯誤: {e}")
-    
+        return 'Bad request', 400
+
+    for event in events:
+        if event.is_text_message:
+            # 👇 重送的事件已經處理過或正在處理中：不要再跑一次檢索 + Gemini
+            if not dedup.claim(event.webhook_event_id):
+                print(f"🔁 略過重複事件 {event.webhook_event_id} (isRedelivery={event.is_redelivery})")
+                continue
+            # 👇 排進背景佇列，馬上回 200 給 LINE；同一用戶的訊息依序處理 (可合併連續訊息)，並受每人/全域限速
+            scheduler.submit(event.user_id, event)
+
     return 'OK', 200
 
+
+def handle_text_event(event, user_msg):
+    # 在背景 worker 中執行：檢索 + 生成 + 回覆 (user_msg 可能是幾則連續訊息合併後的問題)
+    reply_token = event.reply_token
+    
+    # 👇 取得 User ID (這是每個用戶在 LINE 裡的唯一身分證)
+    user_id = event.user_id
+    print(f"👤 用戶({user_id[:5]}...) 說: {user_msg}")
+
+    # 👇 背景暖機還沒完成：稍等一下，等不到就請用戶稍後再問
+    if not warmup.wait(STARTUP_WAIT_SECONDS):
+        reply_to_line(reply_token, "系統啟動中，請稍後...")
+        return
+    
+    # 👇 1. 取出這位用戶的歷史紀錄 (如果沒有就給空清單)
+    chat_history = history_store.get(user_id)
+    
+    # 👇 2. 沒有對話紀錄時，先查答案快取 (別人問過差不多的問題就直接用)
+    answer = answer_cache.lookup(user_msg) if not chat_history else None
+    if answer is not None:
+        print("⚡ 命中答案快取")
+        reply_to_line(reply_token, answer)
+    else:
+        print("🤖 AI 思考中 (包含記憶)...")
+        
+        # 👇 呼叫 AI，並把 chat_history 傳進去
+        # 完整的問題不需要 Gemini 改寫，rewriter 會給空歷史讓 chain 跳過那一步
+        # 歷史依 token 預算修剪，避免長答案把 prompt 撐大
+        trimmed_history, history_tokens = trim_history(chat_history, HISTORY_TOKEN_BUDGET, HISTORY_OVERFLOW)
+        question, history_for_chain = question_rewriter.prepare(user_msg, trimmed_history)
+
+        if STREAMING_ENABLED:
+            # 👇 串流模式：第一句話一產生就回覆，剩下的內容邊生成邊推播
+            answer = stream_answer_to_line(reply_token, user_id, question, history_for_chain, history_tokens)
+        else:
+            result = qa_chain.invoke({
+                "question": question, 
+                "chat_history": history_for_chain
+            })
+            
+            answer = result['answer']
+            prompt_sizes.record(
+                question,
+                history_tokens if history_for_chain else 0,
+                result.get('source_documents', []),
+            )
+            # 回覆用戶
+            reply_to_line(reply_token, answer)
+
+        if not chat_history:
+            answer_cache.store(user_msg, answer)
+    
+    # 👇 3. 更新記憶 (把這次的問答加進去)
+    # 記憶長度上限 (預設最近 5 組) 由 history_store 負責，避免 Token 爆掉
+    history_store.append(user_id, user_msg, answer)
+
+
+def stream_answer_to_line(reply_token, user_id, question, history_for_chain, history_tokens):
+    sender = StreamingLineSender(
+        send_reply=lambda messages: reply_messages_to_line(reply_token, messages),
+        send_push=lambda messages: push_to_line(user_id, messages),
+        min_push_chars=STREAMING_MIN_PUSH_CHARS,
+        max_pushes=STREAMING_MAX_PUSHES,
+    )
+    question, docs, tokens = stream_rag_answer(qa_chain, llm, PROMPT, question, history_for_chain)
+    prompt_sizes.record(question, history_tokens if history_for_chain else 0, docs)
+    for token in tokens:
+        sender.feed(token)
+    return sender.finish()
+
+
+def reject_text_event(event, reason):
+    # 被排程器拒絕的訊息：告訴用戶稍後再試，不要讓 LINE 那邊沒有回應
+    if reason == "user_rate":
+        reply_to_line(event.reply_token, "您傳訊息的速度有點快，請稍等一下再問 🙏")
+    else:
+        reply_to_line(event.reply_token, "目前詢問人數過多，請稍後再試一次 🙏")
+
+
+# 每位用戶的排程器 (要在 handle_text_event 定義之後建立)
+scheduler = create_user_scheduler(config, job_queue, handle_text_event, on_reject=reject_text_event, dedup=dedup)
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    # 佇列深度、執行中數量、拒絕數、快取命中率等指標
+    return jsonify({
+        "startup": warmup.status(),
+        "job_queue": job_queue.stats(),
+        "user_scheduler": scheduler.stats(),
+        "query_embedding_cache": embeddings.stats() if embeddings else None,
+        "answer_cache": answer_cache.stats() if answer_cache else None,
+        "question_rewriter": question_rewriter.stats(),
+        "history_store": history_store.stats(),
+        "prompt_size": prompt_sizes.stats(),
+        "line_api_latency": line_client.stats(),
+        "webhook": ingress.stats(),
+        "webhook_dedup": dedup.stats(),
+    })
+
 if __name__ == "__main__":
+    # 直接執行時沒有 fork；preload 模式也要在這裡開始暖機 (其他模式已經開始了，不會重跑)
+    warmup.start()
     app.run(port=5001)
\ No newline at end of file
@@ -0,0 +1,116 @@
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from query_cache import normalize_query
+
+
+# ==========================================
+# 語意答案快取 (Semantic Answer Cache)
+# ==========================================
+# 不同用戶一分鐘前才問過幾乎一樣的問題，qa_chain.invoke 還是要再做一次檢索 + Gemini。
+# 這裡把「問題向量 -> 答案」存起來，新問題的向量跟舊問題的 cosine 相似度
+# 超過門檻就直接回舊答案。
+#
+# 快取只放在記憶體裡，不會比對索引或 prompt 的版本：索引只會在啟動時重建 (load_or_build_chroma)，
+# prompt 與模型也寫在程式裡，任何一個變了都要重啟，重啟後就是空的快取，舊答案不會沿用。
+#
+# 向量存在固定大小的矩陣裡 (max_size 列)，每筆答案佔一列，store 只改寫那一列，不必重建矩陣；
+# lookup 先把過期的列排除再取最相似的，過期的答案不會擋住還有效的次佳答案。
+
+
+class SemanticAnswerCache:
+    def __init__(self, embeddings, threshold=0.92, max_size=512, ttl_seconds=86400):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+
+        self._entries = OrderedDict()              # 正規化問題 -> (列號, 答案)，依最近使用排序
+        self._row_keys = [None] * max_size         # 列號 -> 正規化問題
+        self._free_rows = list(range(max_size - 1, -1, -1))
+        self._matrix = None                        # (max_size, 維度) 的單位向量，第一次 store 時才知道維度
+        self._created = np.full(max_size, -np.inf)  # 每列的建立時間；空的列是 -inf，永遠視為過期
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def _embed(self, question):
+        vec = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def _hit(self, key):
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key][1]
+
+    def lookup(self, question):
+        """找到夠相似的舊問題就回傳它的答案，否則回傳 None。"""
+        key = normalize_query(question)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - self._created[entry[0]] < self.ttl_seconds:
+                return self._hit(key)
+
+        vec = self._embed(question)
+        with self._lock:
+            if self._entries:
+                scores = self._matrix @ vec
+                scores[now - self._created >= self.ttl_seconds] = -np.inf
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    return self._hit(self._row_keys[best])
+            self.misses += 1
+        return None
+
+    def _release(self, key):
+        row, _ = self._entries.pop(key)
+        self._row_keys[row] = None
+        self._created[row] = -np.inf
+        self._free_rows.append(row)
+
+    def _prune_expired(self, now):
+        expired = np.flatnonzero((now - self._created >= self.ttl_seconds) & np.isfinite(self._created))
+        for row in expired:
+            self._release(self._row_keys[row])
+        self.expired += len(expired)
+
+    def store(self, question, answer):
+        if self.max_size <= 0:
+            return
+        key = normalize_query(question)
+        vec = self._embed(question)
+        with self._lock:
+            now = time.monotonic()
+            if self._matrix is None:
+                self._matrix = np.zeros((self.max_size, len(vec)), dtype=np.float32)
+            self._prune_expired(now)
+            if key in self._entries:
+                self._release(key)
+            if not self._free_rows:
+                # 滿了就淘汰最久沒用到的
+                self._release(next(iter(self._entries)))
+            row = self._free_rows.pop()
+            self._matrix[row] = vec
+            self._created[row] = now
+            self._row_keys[row] = key
+            self._entries[key] = (row, answer)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "expired": self.expired,
+            }
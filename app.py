@@ -1,30 +1,26 @@
 from __future__ import unicode_literals
 
-# 載入所有 Flask、LINE Bot SDK 與系統套件，後續的 webhook、訊息處理都會依賴這些物件。
-from flask import Flask, request, abort, render_template
-from linebot.v3 import (
-    WebhookHandler
-)
-from linebot.v3.exceptions import (
-    InvalidSignatureError
-)
-from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    ReplyMessageRequest,
-    TextMessage
-)
-from linebot.v3.webhooks import (
-    MessageEvent,
-    TextMessageContent
-)
+# 載入 Flask 與系統套件，後續的 webhook、訊息處理都會依賴這些物件。
+# LINE Bot SDK 只有 /callback 的示範流程會用到，改成第一次收到 /callback 才載入 (見 getSdkHandler)。
+from flask import Flask, request, abort, render_template, jsonify
 
 import requests
 import json
 import configparser
 import os
+import hmac
+import threading
+from functools import wraps
 from urllib import parse
+from concurrent.futures import ThreadPoolExecutor
+
+from line_client import create_line_client
+from line_router import EventRouter
+from message_templates import MessageTemplate, slot, to_json_bytes, reply_body
+from media_registry import create_media_registry
+from feed_cache import FeedCache
+from quota_service import QuotaService
+from bulk_push import create_bulk_push_engine
 
 # 建立 Flask 主體並設定靜態檔案資料夾，這樣 /static/ 下的素材才可供 LINE 使用。
 app = Flask(__name__, static_url_path='/static')
@@ -36,9 +32,6 @@ ALLOWED_EXTENSIONS = set(['pdf', 'png', 'jpg', 'jpeg', 'gif'])
 config = configparser.ConfigParser()
 config.read('config.ini')
 
-configuration = Configuration(access_token=config.get('line-bot', 'channel_access_token'))
-handler = WebhookHandler(config.get('line-bot', 'channel_secret'))
-
 my_line_id = config.get('line-bot', 'my_line_id')
 end_point = config.get('line-bot', 'end_point')
 line_login_id = config.get('line-bot', 'line_login_id')
@@ -50,13 +43,106 @@ my_phone = config.get('line-bot', 'my_phone')
 # end_point：部屬網址，方便組合靜態檔案、LINE Login redirect URI。
 # line_login_id/line_login_secret：LINE Login channel 的 client_id/client_secret。
 # my_phone：按鈕選單中提供的撥號電話。
-HEADER = {
-    'Content-type': 'application/json',
-    'Authorization': F'Bearer {config.get("line-bot", "channel_access_token")}'
-}
+# 所有 Messaging API 呼叫共用同一個 client (連線池 + keep-alive + 429/5xx 自動重試)
+line_client = create_line_client(config)
+# /multicast 不在 webhook 驗簽範圍內，要帶 X-Admin-Token；沒設定 admin_token 時整個路由停用
+bulk_push_admin_token = config.get('bulk-push', 'admin_token', fallback='')
+# static/ 素材的長度、尺寸、content type 在啟動時讀一次，請求時只查記憶體
+media = create_media_registry(config, end_point)
+
+
+# 事件路由表：(事件類型, 子類型, 關鍵字/action) -> handler，新增指令只要再註冊一個 handler。
+router = EventRouter()
+# 同一批 webhook 有多個事件時，是否用執行緒平行處理
+parallel_events = config.getboolean('webhook', 'parallel_events', fallback=True)
+event_executor = ThreadPoolExecutor(max_workers=config.getint('webhook', 'event_workers', fallback=4))
+
+
+@router.on("message", "text", "我的名字")
+def onNameEmoji(event):
+    return [getNameEmojiMessage()]
+
+
+@router.on("message", "text", "出去玩囉")
+def onPlaySticker(event):
+    return [getPlayStickerMessage()]
+
+
+@router.on("message", "text", "台北101")
+def onTaipei101(event):
+    return [getTaipei101ImageMessage(),
+            getTaipei101LocationMessage(),
+            getMRTVideoMessage()]
+
+
+@router.on("message", "text", "quoda")
+def onQuota(event):
+    return [{"type": "text", "text": getTotalSentMessageCount()}]
+
+
+@router.on("message", "text", "今日確診人數")
+def onCovid19(event):
+    return [{"type": "text", "text": getTodayCovid19Message()}]
+
+
+@router.on("message", "text", "主選單")
+def onMainMenu(event):
+    return [getMainMenuMessage()]
+
 
+@router.on("message", "text")
+def onEcho(event):
+    # 其他文字一律原樣回覆
+    return [{"type": "text", "text": event["message"]["text"]}]
 
-# 建立根路由，測試 GET 時回傳 ok，若為 LINE POST 事件則解析事件內容並分流處理。
+
+@router.on("message", "location")
+def onLocation(event):
+    message = event["message"]
+    return [getLocationConfirmMessage(message["title"], message["latitude"], message["longitude"])]
+
+
+@router.on("postback", "params")
+def onReservedTime(event):
+    reservedTime = event["postback"]["params"]["datetime"].replace("T", " ")
+    return [{"type": "text", "text": F"已完成預約於{reservedTime}的叫車服務"}]
+
+
+@router.on("postback", None, "get_near")
+def onGetNear(event):
+    data = json.loads(event["postback"]["data"])
+    data["action"] = "get_detail"
+    return [getCarouselMessage(data)]
+
+
+@router.on("postback", None, "get_detail")
+def onGetDetail(event):
+    data = json.loads(event["postback"]["data"])
+    del data["action"]
+    return [getTaipei101ImageMessage(),
+            getTaipei101LocationMessage(),
+            getMRTVideoMessage(),
+            getCallCarMessage(data)]
+
+
+def handleEvent(event):
+    # 沒有 replyToken (例如 unfollow) 或沒有對應的 handler 就略過
+    if "replyToken" not in event:
+        return
+    handler = router.resolve(event)
+    if handler is None:
+        return
+    try:
+        messages = handler(event)
+        if messages:
+            # 預先序列化的訊息直接拼進 request body，不再組 payload dict
+            replyMessage(reply_body(event["replyToken"], messages))
+    except Exception as e:
+        # 一個事件失敗不影響同一批的其他事件
+        print(f"❌ 處理事件 {event.get('type')} 發生錯誤: {e}")
+
+
+# 建立根路由，測試 GET 時回傳 ok，若為 LINE POST 事件則逐一交給路由表處理 (一批可能有多個事件)。
 @app.route("/", methods=['POST', 'GET'])
 def index():
     if request.method == 'GET':
@@ -66,102 +152,11 @@ def index():
     if request.method == 'POST' and len(events) == 0:
         return 'ok'
     print(body)
-    if "replyToken" in events[0]:
-        payload = dict()
-        replyToken = events[0]["replyToken"]
-        payload["replyToken"] = replyToken
-        if events[0]["type"] == "message":
-            if events[0]["message"]["type"] == "text":
-                text = events[0]["message"]["text"]
-
-                if text == "我的名字":
-                    payload["messages"] = [getNameEmojiMessage()]
-                elif text == "出去玩囉":
-                    payload["messages"] = [getPlayStickerMessage()]
-                elif text == "台北101":
-                    payload["messages"] = [getTaipei101ImageMessage(),
-                                           getTaipei101LocationMessage(),
-                                           getMRTVideoMessage()]
-                elif text == "quoda":
-                    payload["messages"] = [
-                            {
-                                "type": "text",
-                                "text": getTotalSentMessageCount()
-                            }
-                        ]
-                elif text == "今日確診人數":
-                    payload["messages"] = [
-                            {
-                                "type": "text",
-                                "text": getTodayCovid19Message()
-                            }
-                        ]
-                elif text == "主選單":
-                    payload["messages"] = [
-                            {
-                                "type": "template",
-                                "altText": "This is a buttons template",
-                                "template": {
-                                  "type": "buttons",
-                                  "title": "Menu",
-                                  "text": "Please select",
-                                  "actions": [
-                                      {
-                                        "type": "message",
-                                        "label": "我的名字",
-                                        "text": "我的名字"
-                                      },
-                                      {
-                                        "type": "message",
-                                        "label": "今日確診人數",
-                                        "text": "今日確診人數"
-                                      },
-                                      {
-                                        "type": "uri",
-                                        "label": "聯絡我",
-                                        "uri": f"tel:{my_phone}"
-                                      }
-                                  ]
-                              }
-                            }
-                        ]
-                else:
-                    payload["messages"] = [
-                            {
-                                "type": "text",
-                                "text": text
-                            }
-                        ]
-                replyMessage(payload)
-            elif events[0]["message"]["type"] == "location":
-                title = events[0]["message"]["title"]
-                latitude = events[0]["message"]["latitude"]
-                longitude = events[0]["message"]["longitude"]
-                payload["messages"] = [getLocationConfirmMessage(title, latitude, longitude)]
-                replyMessage(payload)
-        elif events[0]["type"] == "postback":
-            if "params" in events[0]["postback"]:
-                reservedTime = events[0]["postback"]["params"]["datetime"].replace("T", " ")
-                payload["messages"] = [
-                        {
-                            "type": "text",
-                            "text": F"已完成預約於{reservedTime}的叫車服務"
-                        }
-                    ]
-                replyMessage(payload)
-            else:
-                data = json.loads(events[0]["postback"]["data"])
-                action = data["action"]
-                if action == "get_near":
-                    data["action"] = "get_detail"
-                    payload["messages"] = [getCarouselMessage(data)]
-                elif action == "get_detail":
-                    del data["action"]
-                    payload["messages"] = [getTaipei101ImageMessage(),
-                                           getTaipei101LocationMessage(),
-                                           getMRTVideoMessage(),
-                                           getCallCarMessage(data)]
-                replyMessage(payload)
+    if parallel_events and len(events) > 1:
+        list(event_executor.map(handleEvent, events))
+    else:
+        for event in events:
+            handleEvent(event)
 
     return 'OK'
 
@@ -177,8 +172,9 @@ def callback():
     app.logger.info("Request body: " + body)
 
     # handle webhook body
+    from linebot.v3.exceptions import InvalidSignatureError
     try:
-        handler.handle(body, signature)
+        getSdkHandler().handle(body, signature)
     except InvalidSignatureError:
         app.logger.info("Invalid signature. Please check your channel access token/channel secret.")
         abort(400)
@@ -186,10 +182,31 @@ def callback():
     return 'OK'
 
 
-@handler.add(MessageEvent, message=TextMessageContent)
+# LINE v3 SDK (含 pydantic 模型) import 要花不少時間，而 / 與其他路由都直接用 requests，
+# 所以延後到第一次收到 /callback 才建立 handler，啟動時不必付這筆成本。
+_sdk_handler = None
+_sdk_configuration = None
+_sdk_lock = threading.Lock()
+
+def getSdkHandler():
+    global _sdk_handler, _sdk_configuration
+    with _sdk_lock:
+        if _sdk_handler is None:
+            from linebot.v3 import WebhookHandler
+            from linebot.v3.messaging import Configuration
+            from linebot.v3.webhooks import MessageEvent, TextMessageContent
+
+            _sdk_configuration = Configuration(access_token=config.get('line-bot', 'channel_access_token'))
+            sdk_handler = WebhookHandler(config.get('line-bot', 'channel_secret'))
+            sdk_handler.add(MessageEvent, message=TextMessageContent)(handle_message)
+            _sdk_handler = sdk_handler
+    return _sdk_handler
+
+
 def handle_message(event):
     # 此處示範「原樣回覆」的基本流程，demo 時可確認 SDK 是否可用。
-    with ApiClient(configuration) as api_client:
+    from linebot.v3.messaging import ApiClient, MessagingApi, ReplyMessageRequest, TextMessage
+    with ApiClient(_sdk_configuration) as api_client:
         line_bot_api = MessagingApi(api_client)
         line_bot_api.reply_message_with_http_info(
             ReplyMessageRequest(
@@ -200,16 +217,103 @@ def handle_message(event):
 
 
 
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    # 各個 LINE API 的呼叫次數、錯誤數與延遲分佈
+    return jsonify({
+        "line_api_latency": line_client.stats(),
+        "media": media.stats(),
+        "feeds": feeds.stats(),
+        "quota": quota.stats(),
+        "bulk_push": _bulk_push.stats() if _bulk_push else None,
+    })
+
+
+# 大量推播：每 500 人一批 multicast，限速送出，失敗的批次存在 SQLite 佇列裡重試。
+# import app.py (每個 gunicorn worker) 時不開 SQLite、也不啟動送出執行緒，第一次用到 /multicast 才建立
+_bulk_push = None
+_bulk_push_lock = threading.Lock()
+
+def getBulkPush():
+    global _bulk_push
+    with _bulk_push_lock:
+        if _bulk_push is None:
+            _bulk_push = create_bulk_push_engine(config, line_client)
+    return _bulk_push
+
+
+def requireAdminToken(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = request.headers.get('X-Admin-Token', '')
+        if not bulk_push_admin_token:
+            abort(404)
+        if not hmac.compare_digest(token.encode('utf-8'), bulk_push_admin_token.encode('utf-8')):
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@app.route("/multicast", methods=['POST'])
+@requireAdminToken
+def multicast():
+    # body: {"to": [userId, ...], "messages": [...]}，或用 "text" 代替 messages 送一則文字
+    body = request.json
+    messages = body.get("messages") or [{"type": "text", "text": body["text"]}]
+    job_id = getBulkPush().submit(body["to"], messages)
+    return jsonify({"job_id": job_id}), 202
+
+
+@app.route("/multicast/<job_id>", methods=['GET'])
+@requireAdminToken
+def multicastReport(job_id):
+    return jsonify(getBulkPush().report(job_id))
+
+
 @app.route("/sendTextMessageToMe", methods=['POST'])
 def sendTextMessageToMe():
     pushMessage({})
     return 'OK'
 
 
-def getNameEmojiMessage():
+# ---- 訊息模板 ----
+# 固定內容的訊息在啟動時就序列化成 JSON bytes (見 message_templates.py)，
+# 有參數的模板只在每次回覆時填入變動的欄位。
+MAIN_MENU_MESSAGE = to_json_bytes({
+    "type": "template",
+    "altText": "This is a buttons template",
+    "template": {
+        "type": "buttons",
+        "title": "Menu",
+        "text": "Please select",
+        "actions": [
+            {
+                "type": "message",
+                "label": "我的名字",
+                "text": "我的名字"
+            },
+            {
+                "type": "message",
+                "label": "今日確診人數",
+                "text": "今日確診人數"
+            },
+            {
+                "type": "uri",
+                "label": "聯絡我",
+                "uri": f"tel:{my_phone}"
+            }
+        ]
+    }
+})
+
+
+def getMainMenuMessage():
+    return MAIN_MENU_MESSAGE
+
+
+def buildNameEmojiMessage(name):
     lookUpStr = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
     productId = "5ac21a8c040ab15980c9b43f"
-    name = "joe"
     message = {
         "type": "text",
         "text": "",
@@ -238,167 +342,193 @@ def getNameEmojiMessage():
     return message
 
 
-def getCarouselMessage(data):
-    message ={
-        "type": "template",
-        "altText": "this is a image carousel template",
-        "template": {
-            "type": "image_carousel",
-            "columns": [
-            {
-                "imageUrl": F"{end_point}/static/taipei_101.jpeg",
-                "action": {
-                "type": "postback",
-                "label": "白天101",
-                "data": json.dumps(data)
-                }
-            },
-            {
-                "imageUrl": F"{end_point}/static/taipei_1.jpeg",
-                "action": {
-                "type": "postback",
-                "label": "夜晚101",
-                "data": json.dumps(data)
-                }
-            }
-            ]
-        }
-    }
-    # 需要使用 image carousel，使 data 內的欄位（名稱、地址、座標）渲染成多張卡片。
-    return message
+# 名字固定，啟動時算一次就好
+NAME_EMOJI_MESSAGE = to_json_bytes(buildNameEmojiMessage("joe"))
 
 
-def getLocationConfirmMessage(title, latitude, longitude):
-    message ={
+def getNameEmojiMessage():
+    return NAME_EMOJI_MESSAGE
+
+
+CAROUSEL_TEMPLATE = MessageTemplate({
     "type": "template",
-    "altText": "this is a confirm template",
+    "altText": "this is a image carousel template",
     "template": {
-        "type": "confirm",
-        "text": f"是否規劃{title}附近景點？",
-        "actions": [
+        "type": "image_carousel",
+        "columns": [
         {
+            "imageUrl": F"{end_point}/static/taipei_101.jpeg",
+            "action": {
             "type": "postback",
-            "label": "是",
-            "data": json.dumps({"title":title,"latitude":latitude,"longitude":longitude,"action":"get_near"}),
+            "label": "白天101",
+            "data": slot("data")
+            }
         },
         {
-            "type": "message",
-            "label": "No",
-            "text": "no"
+            "imageUrl": F"{end_point}/static/taipei_1.jpeg",
+            "action": {
+            "type": "postback",
+            "label": "夜晚101",
+            "data": slot("data")
+            }
         }
         ]
     }
+})
+
+
+def getCarouselMessage(data):
+    # 需要使用 image carousel，使 data 內的欄位（名稱、地址、座標）渲染成多張卡片。
+    return CAROUSEL_TEMPLATE.render(data=json.dumps(data))
+
+
+LOCATION_CONFIRM_TEMPLATE = MessageTemplate({
+"type": "template",
+"altText": "this is a confirm template",
+"template": {
+    "type": "confirm",
+    "text": slot("text"),
+    "actions": [
+    {
+        "type": "postback",
+        "label": "是",
+        "data": slot("data"),
+    },
+    {
+        "type": "message",
+        "label": "No",
+        "text": "no"
     }
+    ]
+}
+})
+
+
+def getLocationConfirmMessage(title, latitude, longitude):
     # 建立 Confirm 模板，讓使用者確認是否鎖定 title 所代表的地點，再利用 latitude/longitude 呼叫後續 API。
-    return message
+    return LOCATION_CONFIRM_TEMPLATE.render(
+        text=f"是否規劃{title}附近景點？",
+        data=json.dumps({"title":title,"latitude":latitude,"longitude":longitude,"action":"get_near"}))
+
+
+CALL_CAR_TEMPLATE = MessageTemplate({
+"type": "template",
+"altText": "This is a buttons template",
+"template": {
+    "type": "buttons",
+    "text": "是否叫車？",
+    "actions": [
+    {
+        "type": "datetimepicker",
+        "label": "預約",
+        "data": slot("data"),
+        "mode": "datetime"
+    },
+    {
+        "type": "uri",
+        "label": "🚗Uber官網",
+        "uri": "https://www.uber.com/tw/zh-tw/"
+    }
+    ]
+}
+})
 
 
 def getCallCarMessage(data):
-    message ={
-    "type": "template",
-    "altText": "This is a buttons template",
-    "template": {
-        "type": "buttons",
-        "text": "是否叫車？",
-        "actions": [
-        {
-            "type": "datetimepicker",
-            "label": "預約",
-            "data": json.dumps(data),
-            "mode": "datetime"
-        },
-        {
-            "type": "uri",
-            "label": "🚗Uber官網",
-            "uri": "https://www.uber.com/tw/zh-tw/"
-        }
-        ]
-    }
-    }
     # 將 data 內的叫車資訊整理成 Bubble 或文字，提醒使用者「聯絡平台時間」。
-    return message
+    return CALL_CAR_TEMPLATE.render(data=json.dumps(data))
+
+
+# 設定 packageId、stickerId 參數即可傳貼圖，記得參考官方貼圖列表。
+PLAY_STICKER_MESSAGE = to_json_bytes({
+"type": "sticker",
+"packageId": "446",
+"stickerId": "1988"
+})
 
 
 def getPlayStickerMessage():
-    message = {
-    "type": "sticker",
-    "packageId": "446",
-    "stickerId": "1988"
-    }
-    # 設定 packageId、stickerId 參數即可傳貼圖，記得參考官方貼圖列表。
-    return message
+    return PLAY_STICKER_MESSAGE
+
+
+# 建立 Location Message，並填入台北 101 的 title、address、latitude、longitude。
+TAIPEI101_LOCATION_MESSAGE = to_json_bytes({
+    "type": "location",
+    "title": "my location",
+    "address": "110臺北市信義區信義路五段7號",
+    "latitude": 25.034067415991537,
+    "longitude": 121.564524366665
+})
 
 
 def getTaipei101LocationMessage():
-    message = {
-        "type": "location",
-        "title": "my location",
-        "address": "110臺北市信義區信義路五段7號",
-        "latitude": 25.034067415991537,
-        "longitude": 121.564524366665
-    }   
-    # 建立 Location Message，並填入台北 101 的 title、address、latitude、longitude。
-    return message
+    return TAIPEI101_LOCATION_MESSAGE
+
+
+# video message 需同時指定 originalContentUrl 與 previewImageUrl，可使用 static/ 目錄的素材。
+MRT_VIDEO_MESSAGE = to_json_bytes({
+"type": "video",
+"originalContentUrl": media.get("mrt_sound.m4a")["url"],
+"previewImageUrl": media.get("taipei_101.jpeg")["url"]
+})
 
 
 def getMRTVideoMessage():
-    message = {
-    "type": "video",
-    "originalContentUrl": F"{end_point}/static/mrt_sound.m4a",
-    "previewImageUrl": F"{end_point}/static/taipei_101.jpeg"
-    }
-    # video message 需同時指定 originalContentUrl 與 previewImageUrl，可使用 static/ 目錄的素材。
-    return message
+    return MRT_VIDEO_MESSAGE
+
+
+# 音訊訊息記得附上毫秒數 duration，否則 LINE 端會出現「音訊長度未知」而無法播放。
+AUDIO_TEMPLATE = MessageTemplate({
+    "type": "audio",
+    "originalContentUrl": slot("url"),
+    "duration": slot("duration")
+})
+
+
+def getAudioMessage(relative_path):
+    # 長度來自啟動時的掃描結果 (檔案變動時背景會重新讀)，不在請求中解碼音檔
+    info = media.get(relative_path)
+    return AUDIO_TEMPLATE.render(url=info["url"], duration=info["duration_ms"] or 0)
 
 
 def getMRTSoundMessage():
-    message = dict()
-    message["type"] = "audio"
-    message["originalContentUrl"] = F"{end_point}/static/mrt_sound.m4a"
-    import audioread
-    with audioread.audio_open('static/mrt_sound.m4a') as f:
-        # totalsec contains the length in float
-        totalsec = f.duration
-    message["duration"] = totalsec * 1000
-    # 音訊訊息記得附上毫秒數 duration，否則 LINE 端會出現「音訊長度未知」而無法播放。
-    return message
+    return getAudioMessage("mrt_sound.m4a")
 
 
-def getTaipei101ImageMessage(originalContentUrl=F"{end_point}/static/taipei_101.jpeg"):
-    message ={
+# image message 最少要填 originalContentUrl 與 previewImageUrl，可用同一張圖做預覽。
+IMAGE_TEMPLATE = MessageTemplate({
     "type": "image",
-    "originalContentUrl": originalContentUrl,
-    "previewImageUrl": originalContentUrl
-    }
-    # 此函式只是傳遞檔案位置給共用的 getImageMessage，方便之後替換不同素材。
+    "originalContentUrl": slot("url"),
+    "previewImageUrl": slot("url")
+})
+TAIPEI101_IMAGE_URL = media.get("taipei_101.jpeg")["url"]
+TAIPEI101_IMAGE_MESSAGE = IMAGE_TEMPLATE.render(url=TAIPEI101_IMAGE_URL)
+
+
+def getTaipei101ImageMessage(originalContentUrl=TAIPEI101_IMAGE_URL):
+    # 預設的 101 照片已經預先序列化；換其他素材才走共用的 getImageMessage。
+    if originalContentUrl == TAIPEI101_IMAGE_URL:
+        return TAIPEI101_IMAGE_MESSAGE
     return getImageMessage(originalContentUrl)
 
 
 def getImageMessage(originalContentUrl):
-    message = {
-        "type": "image",
-        "originalContentUrl":originalContentUrl,
-        "previewImageUrl":originalContentUrl
-    }
-    # image message 最少要填 originalContentUrl 與 previewImageUrl，可用同一張圖做預覽。
-    return message
+    return IMAGE_TEMPLATE.render(url=originalContentUrl)
 
 
 def replyMessage(payload):
-    url = "https://api.line.me/v2/bot/message/reply"
-    response = requests.post(url, headers=HEADER, json=payload)
+    response = line_client.reply_payload(payload)
     if response.status_code == 200:
         return "ok"
     else:
         print(response.text)
-    # 使用 requests.post 呼叫 https://api.line.me/v2/bot/message/reply，
-    # 直接將 payload餵入requests.post(...,json=payload)，即可在 webhook 內回覆訊息。
+    # 透過共用的 line_client 呼叫 https://api.line.me/v2/bot/message/reply，
+    # 連線會重複使用 (keep-alive)，遇到 429/5xx 也會自動重試。
     return 'OK'
 
 
 def pushMessage(payload):
-    url = "https://api.line.me/v2/bot/message/push"
-    response = requests.post(url, headers=HEADER, json=payload)
+    response = line_client.push_payload(payload)
     if response.status_code == 200:
         return "ok"
     else:
@@ -408,32 +538,53 @@ def pushMessage(payload):
     return 'OK'
 
 
+def fetchQuotaUsage():
+    # 可呼叫 https://api.line.me/v2/bot/message/quota/consumption
+    # 取得本月推播訊息的用量，方便統計。
+    response = line_client.quota_consumption()
+    if response.status_code != 200:
+        raise RuntimeError(response.text)
+    return response.json().get("totalUsage", 0)
+
+
+# 用量快取一段時間，同時間的查詢只會打一次 LINE；之間用本地計數估計即時用量。
+quota = QuotaService(fetchQuotaUsage, ttl_seconds=config.getint('quota', 'ttl_seconds', fallback=60),
+                     error_ttl_seconds=config.getint('quota', 'error_ttl_seconds', fallback=15))
+line_client.add_send_listener(quota.record_sent)
+
+
 def getTotalSentMessageCount():
-    url = "https://api.line.me/v2/bot/message/quota/consumption"
-    response = requests.get(url, headers=HEADER)
-    if response.status_code == 200:
-        data = response.json()
-        total_usage = data.get("totalUsage", 0)
-        return total_usage
-    else:
-        print(response.text)
+    usage = quota.total_usage()
+    # 查詢失敗又沒有舊值時，回覆錯誤訊息 (失敗後 error_ttl_seconds 內不會再打 LINE)
+    return "推播用量暫時查不到，請稍後再試" if usage is None else usage
 
-    # 可呼叫 https://api.line.me/v2/bot/message/quota/consumption
-    # 取得近 24 小時的回覆數量，方便統計用量。
 
 
+COVID19_URL = "https://od.cdc.gov.tw/eic/NHI_COVID-19.json"
 
-def getTodayCovid19Message():
-    response = requests.get("https://od.cdc.gov.tw/eic/NHI_COVID-19.json", verify=False)
-    # 因為網址裡面儲存的格式是JSON array，要先轉編碼才能抓取回來
-    response.encoding = 'utf-8-sig'
-    data = response.json()[-1]
+
+def parseCovid19Feed(content):
+    # 因為網址裡面儲存的格式是JSON array，開頭有 BOM，要先用 utf-8-sig 解碼
+    data = json.loads(content.decode('utf-8-sig'))[-1]
     date = f'{data["年"]}-{data["週"]}'
     count = data["健保就診總人次"]
-    # 呼叫政府公開資料 API，把今日與累積確診數寫進字串後回傳。
+    # 把最新一筆的日期與就診人次寫進字串，之後直接回覆這個字串。
     return F"日期：{date}, 人數：{count}"
 
 
+# 政府開放資料由背景執行緒定期更新 (ETag / Last-Modified 條件式請求)，指令只讀記憶體。
+# 政府網站憑證有問題，沿用 verify=False。
+feeds = FeedCache()
+feeds.register("covid19", COVID19_URL, parseCovid19Feed,
+               refresh_seconds=config.getint('feeds', 'covid19_refresh_seconds', fallback=3600),
+               verify=False)
+feeds.start()
+
+
+def getTodayCovid19Message():
+    return feeds.get("covid19") or "資料更新中，請稍後再試"
+
+
 
 @app.route('/line_login', methods=['GET'])
 def line_login():
@@ -0,0 +1,235 @@
+import os
+import json
+import asyncio
+import inspect
+import mimetypes
+from urllib import parse
+
+import aiohttp
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from linebot.v3 import WebhookParser
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+
+# 訊息格式 (模板、Emoji、輪播...) 與設定都沿用 app.py，這裡只換掉伺服器與對外 I/O
+import app as bot
+from line_client import create_async_line_client
+from message_templates import reply_body
+
+# ==========================================
+# ASGI 版 Webhook 伺服器 (asyncio)
+# ==========================================
+# app.py 是同步的 Flask，每個等待 LINE / 政府開放資料 / LINE Login 回應的請求
+# 都會佔住一整條執行緒。這裡用同樣的路由 (/、/callback、/line_login、/static、/metrics)
+# 實作一個純 ASGI app，所有對外 HTTP 都是 await，一個行程就能同時掛著上百個對話。
+#
+# 啟動: uvicorn app_async:app --port 5001
+# 壓測比較: python loadtest_webhook.py (見檔案開頭說明)
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), bot.UPLOAD_FOLDER)
+TEMPLATE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+parser = WebhookParser(bot.config.get('line-bot', 'channel_secret'))
+line_client = create_async_line_client(bot.config)
+line_client.add_send_listener(bot.quota.record_sent)
+# LINE Login 用的非同步 HTTP session (要在 event loop 裡建立，啟動時才開)
+http_session = None
+
+templates = Environment(loader=FileSystemLoader(TEMPLATE_FOLDER), autoescape=select_autoescape())
+# login.html 用到 Flask 的 url_for('static', filename=...)
+templates.globals['url_for'] = lambda endpoint, filename: f"/{endpoint}/{filename}"
+
+
+# ---- ASGI 小工具 ----
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def send_response(send, status, body, content_type="text/plain; charset=utf-8"):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def get_header(scope, name):
+    name = name.lower().encode()
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+# ---- 對外 I/O (非同步版) ----
+async def reply_message(payload):
+    response = await line_client.reply_payload(payload)
+    if response.status_code != 200:
+        print(response.text)
+
+
+# ---- 事件處理：沿用 app.py 的路由表，只把要等外部 API 的指令換成 async 版 ----
+# (「今日確診人數」由 app.py 的 FeedCache 在背景更新，直接讀記憶體，不需要 async 版)
+router = bot.router.copy()
+
+
+@router.on("message", "text", "quoda")
+async def on_quota(event):
+    # 跟 app.py 共用同一個 QuotaService；快取過期時才到執行緒裡查詢 (同時間只會查一次)
+    usage = bot.quota.cached_usage()
+    if usage is None:
+        usage = await asyncio.to_thread(bot.quota.total_usage)
+    return [{"type": "text", "text": usage}]
+
+
+async def handle_event(event):
+    if "replyToken" not in event:
+        return
+    handler = router.resolve(event)
+    if handler is None:
+        return
+    try:
+        messages = handler(event)
+        if inspect.isawaitable(messages):
+            messages = await messages
+        if messages:
+            await reply_message(reply_body(event["replyToken"], messages))
+    except Exception as e:
+        print(f"❌ 處理事件 {event.get('type')} 發生錯誤: {e}")
+
+
+# ---- 路由 ----
+async def index(scope, receive, send):
+    if scope["method"] == "GET":
+        return await send_response(send, 200, "ok")
+    body = json.loads(await read_body(receive))
+    events = body["events"]
+    if len(events) == 0:
+        return await send_response(send, 200, "ok")
+    print(body)
+    # 同一批的事件一起處理
+    await asyncio.gather(*[handle_event(event) for event in events])
+    await send_response(send, 200, "OK")
+
+
+async def callback(scope, receive, send):
+    signature = get_header(scope, "X-Line-Signature")
+    body = (await read_body(receive)).decode("utf-8")
+    try:
+        events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        print("Invalid signature. Please check your channel access token/channel secret.")
+        return await send_response(send, 400, "Bad Request")
+
+    # 原樣回覆；多個事件同時送出，不用一個等一個
+    await asyncio.gather(*[
+        line_client.reply(event.reply_token, [{"type": "text", "text": event.message.text}])
+        for event in events
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent)
+    ])
+    await send_response(send, 200, "OK")
+
+
+async def line_login(scope, receive, send):
+    query = parse.parse_qs(scope["query_string"].decode())
+    code = query.get("code", [None])[0]
+    state = query.get("state", [None])[0]
+
+    if not (code and state):
+        html = templates.get_template('login.html').render(client_id=bot.line_login_id, end_point=bot.end_point)
+        return await send_response(send, 200, html, "text/html; charset=utf-8")
+
+    FormData = {"grant_type": 'authorization_code', "code": code, "redirect_uri": F"{bot.end_point}/line_login",
+                "client_id": bot.line_login_id, "client_secret": bot.line_login_secret}
+    async with http_session.post("https://api.line.me/oauth2/v2.1/token", data=FormData) as response:
+        content = json.loads(await response.text())
+    HEADERS = {'Authorization': content["token_type"] + " " + content["access_token"]}
+    async with http_session.get("https://api.line.me/v2/profile", headers=HEADERS) as response:
+        content = json.loads(await response.text())
+    print(content)
+    html = templates.get_template('profile.html').render(
+        name=content["displayName"], pictureURL=content["pictureUrl"],
+        userID=content["userId"], statusMessage=content.get("statusMessage", ""))
+    await send_response(send, 200, html, "text/html; charset=utf-8")
+
+
+async def metrics(scope, receive, send):
+    body = json.dumps({
+        "line_api_latency": line_client.stats(),
+        "feeds": bot.feeds.stats(),
+        "quota": bot.quota.stats(),
+    })
+    await send_response(send, 200, body, "application/json")
+
+
+async def static_file(scope, receive, send):
+    relative = scope["path"][len("/static/"):]
+    path = os.path.realpath(os.path.join(STATIC_FOLDER, relative))
+    # 不允許 ../ 跳出 static 資料夾
+    if not path.startswith(STATIC_FOLDER + os.sep) or not os.path.isfile(path):
+        return await send_response(send, 404, "Not Found")
+    # 讀檔丟到 thread，不要卡住 event loop
+    data = await asyncio.to_thread(_read_file, path)
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    await send_response(send, 200, data, content_type)
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+ROUTES = {
+    ("/", "GET"): index,
+    ("/", "POST"): index,
+    ("/callback", "POST"): callback,
+    ("/line_login", "GET"): line_login,
+    ("/metrics", "GET"): metrics,
+}
+
+
+async def lifespan(receive, send):
+    global http_session
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10, connect=3.05))
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await line_client.aclose()
+            await http_session.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    path = scope["path"]
+    if path.startswith("/static/") and scope["method"] == "GET":
+        return await static_file(scope, receive, send)
+    route = ROUTES.get((path, scope["method"]))
+    if route is None:
+        status = 405 if any(p == path for p, _ in ROUTES) else 404
+        return await send_response(send, status, "Method Not Allowed" if status == 405 else "Not Found")
+    try:
+        await route(scope, receive, send)
+    except Exception as e:
+        print(f"❌ 處理 {path} 發生錯誤: {e}")
+        await send_response(send, 500, "Internal Server Error")
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run("app_async:app", port=5001)
@@ -0,0 +1,125 @@
+import os
+import sys
+import io
+import time
+import statistics
+import configparser
+
+from question_rewriter import QuestionRewriter, CONDENSE_MODES
+
+# ==========================================
+# 改寫模式 Benchmark：llm vs auto vs local
+# ==========================================
+# 用幾段固定的多輪對話，分別以三種 condense_mode 跑同一條 ConversationalRetrievalChain，
+# 比較每一輪的延遲、Gemini 呼叫次數，以及答案品質：
+#   - keyword 命中率：答案裡有沒有出現預期的關鍵字
+#   - 來源重疊率：檢索到的段落跟 llm 模式 (原本的行為) 有多少相同
+#
+# 用法: python bench_condense.py   (需要 config.ini 裡的 GOOGLE_API_KEY)
+
+sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+# (對話內容, 每一輪預期答案中會出現的關鍵字)
+DIALOGUES = [
+    [
+        ("什麼是 Proof of Work？", ["hash", "雜湊", "工作量"]),
+        ("它怎麼防止雙重支付？", ["double", "雙重", "最長"]),
+        ("為什麼？", ["算力", "CPU", "攻擊"]),
+    ],
+    [
+        ("比特幣的交易是怎麼被驗證的？", ["簽章", "signature", "節點"]),
+        ("時間戳伺服器有什麼作用？", ["timestamp", "時間戳", "雜湊"]),
+        ("那個跟區塊鏈有什麼關係？", ["區塊", "block", "鏈"]),
+    ],
+    [
+        ("Merkle Tree 是用來做什麼的？", ["Merkle", "空間", "雜湊"]),
+        ("簡化支付驗證 SPV 需要下載完整區塊嗎？", ["header", "標頭", "不需要"]),
+        ("這樣安全嗎？", ["攻擊", "誠實", "節點"]),
+    ],
+]
+
+
+def build_chain():
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    os.environ["GOOGLE_API_KEY"] = config.get('line-bot', 'GOOGLE_API_KEY')
+
+    from langchain_core.prompts import PromptTemplate
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    from langchain_classic.chains.conversational_retrieval.base import ConversationalRetrievalChain
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    from rag_index import download_pdf, load_or_build_chroma
+
+    model_name = "sentence-transformers/all-MiniLM-L6-v2"
+    pdf_filename = download_pdf("bitcoin_paper.pdf")
+    db = load_or_build_chroma([pdf_filename], HuggingFaceEmbeddings(model_name=model_name), model_name=model_name)
+    llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0)
+    prompt = PromptTemplate(
+        template="請根據下方的【參考文件】回答用戶的問題。\n【參考文件】：\n{context}\n用戶問題：{question}\n回答：",
+        input_variables=["context", "question"],
+    )
+    return ConversationalRetrievalChain.from_llm(
+        llm=llm,
+        retriever=db.as_retriever(search_kwargs={"k": 2}),
+        return_source_documents=True,
+        combine_docs_chain_kwargs={"prompt": prompt},
+    )
+
+
+def run_mode(qa_chain, mode):
+    rewriter = QuestionRewriter(mode)
+    latencies = []      # 只記有歷史的追問輪次，第一輪三種模式都一樣
+    keyword_hits = []
+    sources = []        # 每一輪檢索到的段落內容，之後跟 llm 模式比較
+
+    for dialogue in DIALOGUES:
+        chat_history = []
+        for user_msg, keywords in dialogue:
+            question, history_for_chain = rewriter.prepare(user_msg, chat_history)
+            started = time.perf_counter()
+            result = qa_chain.invoke({"question": question, "chat_history": history_for_chain})
+            elapsed = time.perf_counter() - started
+
+            answer = result['answer']
+            if chat_history:
+                latencies.append(elapsed)
+            keyword_hits.append(any(k.lower() in answer.lower() for k in keywords))
+            sources.append({d.page_content for d in result.get('source_documents', [])})
+            chat_history.append((user_msg, answer))
+
+    stats = rewriter.stats()
+    turns = sum(len(d) for d in DIALOGUES)
+    return {
+        "mode": mode,
+        "latencies": latencies,
+        "keyword_rate": sum(keyword_hits) / len(keyword_hits),
+        "sources": sources,
+        # 每輪固定 1 次回答呼叫，改寫的輪次再多 1 次
+        "llm_calls_per_turn": (turns + stats["llm_rewrites"]) / turns,
+    }
+
+
+def source_overlap(baseline, other):
+    scores = []
+    for a, b in zip(baseline, other):
+        union = a | b
+        scores.append(len(a & b) / len(union) if union else 1.0)
+    return sum(scores) / len(scores)
+
+
+if __name__ == "__main__":
+    print("🚀 建立測試用 chain...")
+    qa_chain = build_chain()
+
+    results = {}
+    for mode in CONDENSE_MODES:
+        print(f"⏱️ 測試 condense_mode={mode} ...")
+        results[mode] = run_mode(qa_chain, mode)
+
+    baseline = results["llm"]["sources"]
+    print("\n📊 結果 (延遲只計算追問輪次)")
+    print(f"{'mode':<6} {'avg(s)':>8} {'p50(s)':>8} {'max(s)':>8} {'LLM次數/輪':>10} {'關鍵字命中':>10} {'來源重疊':>8}")
+    for mode, r in results.items():
+        lat = r["latencies"]
+        print(f"{mode:<6} {statistics.mean(lat):>8.2f} {statistics.median(lat):>8.2f} {max(lat):>8.2f} "
+              f"{r['llm_calls_per_turn']:>10.2f} {r['keyword_rate']:>10.0%} {source_overlap(baseline, r['sources']):>8.0%}")
@@ -0,0 +1,178 @@
+import sys
+import io
+import time
+import random
+import argparse
+import statistics
+
+import numpy as np
+
+from onnx_embeddings import OnnxEmbeddings, DEFAULT_MODEL_NAME, DEFAULT_ONNX_DIR
+
+# ==========================================
+# 向量化後端 Benchmark：torch vs ONNX fp32 vs ONNX int8
+# ==========================================
+# 同一批文件與問題分別用三種後端向量化，比較：
+#   - 查詢延遲：embed_query 一次一句 (bot 收到訊息時的情況)，p50 / p95
+#   - 吞吐量：embed_documents 整批文件 (匯入 PDF 的情況)，docs/sec
+#   - recall@k：以 torch 版「torch 查詢 × torch 索引」的前 k 名為標準答案
+#       自建索引：該後端的查詢 × 該後端建的索引 (整套換成 ONNX)
+#       混用索引：該後端的查詢 × torch 建好的索引 (只換查詢端，舊的 Chroma / Pinecone 不重建)
+#   - cos：跟 torch 向量的平均 cosine 相似度
+#
+#   python onnx_embeddings.py export --out onnx_models/all-MiniLM-L6-v2
+#   python bench_embeddings.py --docs 300 --queries 100 -k 5
+
+sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+QUESTIONS = [
+    "什麼是 Proof of Work？",
+    "比特幣怎麼防止雙重支付？",
+    "時間戳伺服器有什麼作用？",
+    "Merkle Tree 是用來做什麼的？",
+    "簡化支付驗證需要下載完整區塊嗎？",
+    "How does the network handle double spending?",
+    "What incentive do nodes have to stay honest?",
+    "How are transactions combined and split?",
+    "What happens if an attacker controls most of the CPU power?",
+    "How is privacy preserved when transactions are public?",
+]
+
+# 沒有 langchain / PDF 時用來組合文件的句子
+SAMPLE_SENTENCES = [
+    "A purely peer-to-peer version of electronic cash would allow online payments to be sent directly from one party to another.",
+    "Digital signatures provide part of the solution, but the main benefits are lost if a trusted third party is still required.",
+    "The network timestamps transactions by hashing them into an ongoing chain of hash-based proof-of-work.",
+    "The longest chain not only serves as proof of the sequence of events witnessed, but proof that it came from the largest pool of CPU power.",
+    "We define an electronic coin as a chain of digital signatures.",
+    "The problem of course is the payee can't verify that one of the owners did not double-spend the coin.",
+    "A timestamp server works by taking a hash of a block of items to be timestamped and widely publishing the hash.",
+    "The proof-of-work involves scanning for a value that when hashed begins with a number of zero bits.",
+    "Nodes always consider the longest chain to be the correct one and will keep working on extending it.",
+    "The incentive may help encourage nodes to stay honest.",
+    "Once the latest transaction in a coin is buried under enough blocks, the spent transactions before it can be discarded to save disk space.",
+    "Transactions are hashed in a Merkle Tree, with only the root included in the block's hash.",
+    "It is possible to verify payments without running a full network node.",
+    "A user only needs to keep a copy of the block headers of the longest proof-of-work chain.",
+    "To allow value to be split and combined, transactions contain multiple inputs and outputs.",
+    "Privacy can still be maintained by breaking the flow of information by keeping public keys anonymous.",
+    "We consider the scenario of an attacker trying to generate an alternate chain faster than the honest chain.",
+    "The probability of an attacker catching up diminishes exponentially as subsequent blocks are added.",
+    "比特幣是一種點對點的電子現金系統，不需要經過金融機構。",
+    "工作量證明讓竄改過去的區塊需要重新計算之後所有區塊的雜湊。",
+    "誠實節點掌握大部分算力時，誠實的鏈會成長得最快。",
+    "區塊標頭只有八十個位元組，輕量節點只需要保存標頭。",
+]
+
+
+def load_texts(pdf_paths, doc_count, query_count, seed=0):
+    # 優先用真正的 PDF 切塊 (跟 bot 建索引的方式一樣)；沒有 langchain 時用內建句子組合
+    rng = random.Random(seed)
+    try:
+        from rag_index import load_and_split
+        docs = [c.page_content for c in load_and_split(pdf_paths, 1000, 200)]
+        source = f"PDF 切塊 ({', '.join(pdf_paths)})"
+    except Exception as e:
+        docs = [" ".join(rng.sample(SAMPLE_SENTENCES, rng.randint(3, 8))) for _ in range(doc_count)]
+        source = f"內建句子組合 (讀不到 PDF: {e.__class__.__name__})"
+    while len(docs) < doc_count:
+        docs = docs + docs
+    docs = docs[:doc_count]
+
+    # 問題 = 固定問句 + 從文件中隨機截一段 (模擬用文件裡的用語發問)
+    queries = list(QUESTIONS)
+    while len(queries) < query_count:
+        words = rng.choice(docs).split()
+        start = rng.randint(0, max(0, len(words) - 12))
+        queries.append(" ".join(words[start:start + rng.randint(4, 12)]))
+    return docs, queries[:query_count], source
+
+
+class TorchBackend:
+    # HuggingFaceEmbeddings 底下就是 SentenceTransformer.encode；這裡直接呼叫，benchmark 不必裝 langchain
+    def __init__(self, model_name, batch_size):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.batch_size = batch_size
+
+    def encode(self, texts):
+        return self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True)
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def top_k(queries, docs, k):
+    # 向量都已 L2 正規化，內積就是 cosine
+    scores = queries @ docs.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def recall_at_k(found, expected):
+    return float(np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found, expected)]))
+
+
+def run_backend(backend, docs, queries):
+    backend.encode(queries[:2])  # 暖機 (第一次呼叫會配置記憶體)
+    latencies = []
+    query_vectors = []
+    for q in queries:
+        started = time.perf_counter()
+        query_vectors.append(backend.encode([q])[0])
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    doc_vectors = backend.encode(docs)
+    docs_per_sec = len(docs) / (time.perf_counter() - started)
+    return np.asarray(query_vectors, dtype=np.float32), np.asarray(doc_vectors, dtype=np.float32), latencies, docs_per_sec
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="向量化後端 benchmark (torch / ONNX fp32 / ONNX int8)")
+    arg_parser.add_argument("--model", default=DEFAULT_MODEL_NAME, help="torch 版模型 (跟匯出 ONNX 的同一個)")
+    arg_parser.add_argument("--onnx-dir", default=DEFAULT_ONNX_DIR)
+    arg_parser.add_argument("--pdf", action="append", help="文件來源 (預設 bitcoin_paper.pdf)")
+    arg_parser.add_argument("--docs", type=int, default=300, help="文件數")
+    arg_parser.add_argument("--queries", type=int, default=100, help="問題數")
+    arg_parser.add_argument("-k", type=int, default=5)
+    arg_parser.add_argument("--batch-size", type=int, default=16)
+    arg_parser.add_argument("--threads", type=int, default=0, help="ONNX Runtime 執行緒數 (0 = 全部核心)")
+    args = arg_parser.parse_args()
+
+    docs, queries, source = load_texts(args.pdf or ["bitcoin_paper.pdf"], args.docs, args.queries)
+    print(f"📄 {len(docs)} 篇文件、{len(queries)} 個問題，來源: {source}")
+
+    backends = [("torch", lambda: TorchBackend(args.model, args.batch_size))]
+    for label, quantized in (("onnx-fp32", False), ("onnx-int8", True)):
+        backends.append((label, lambda q=quantized: OnnxEmbeddings(
+            args.onnx_dir, quantized=q, batch_size=args.batch_size, threads=args.threads)))
+
+    results = {}
+    for label, factory in backends:
+        try:
+            started = time.perf_counter()
+            backend = factory()
+            load_seconds = time.perf_counter() - started
+        except Exception as e:
+            print(f"⚠️ 跳過 {label}: {e}")
+            continue
+        results[label] = run_backend(backend, docs, queries) + (load_seconds,)
+
+    if "torch" not in results:
+        print("❌ 需要 torch 版的結果當 recall 的標準答案")
+        sys.exit(1)
+
+    torch_queries, torch_docs = results["torch"][0], results["torch"][1]
+    k = min(args.k, len(docs))
+    expected = top_k(torch_queries, torch_docs, k)
+
+    print(f"\n{'後端':<10} {'載入 s':>7} {'p50 ms':>8} {'p95 ms':>8} {'docs/s':>9} "
+          f"{'recall@' + str(k) + ' 自建':>12} {'recall@' + str(k) + ' 混用':>12} {'cos':>7}")
+    for label, (query_vectors, doc_vectors, latencies, docs_per_sec, load_seconds) in results.items():
+        own = recall_at_k(top_k(query_vectors, doc_vectors, k), expected)
+        mixed = recall_at_k(top_k(query_vectors, torch_docs, k), expected)
+        cosine = float(np.mean(np.sum(doc_vectors * torch_docs, axis=1)))
+        print(f"{label:<10} {load_seconds:>7.2f} {statistics.median(latencies):>8.2f} {percentile(latencies, 95):>8.2f} "
+              f"{docs_per_sec:>9.1f} {own:>12.3f} {mixed:>12.3f} {cosine:>7.4f}")
@@ -0,0 +1,75 @@
+import sys
+import io
+import hmac
+import json
+import time
+import uuid
+import base64
+import hashlib
+import argparse
+
+from webhook_ingress import WebhookIngress, orjson
+
+# ==========================================
+# Webhook 驗簽 + 解析 微基準測試
+# ==========================================
+# 只量測「驗證 X-Line-Signature + 解析 JSON」這一段 (不含 Flask / 網路)，每秒可處理幾個 webhook：
+#   legacy  : 舊的 callback() 寫法 —— 解碼成字串、再編碼回 bytes 算 HMAC、!= 比對、json.loads
+#   ingress : WebhookIngress.handle() —— 原始 bytes、compare_digest、orjson (有安裝的話)、WebhookEvent
+#
+#   python bench_webhook_ingress.py --events 1 --events 5 -n 20000
+
+sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+SECRET = "bench-channel-secret"
+
+
+def make_body(event_count, text="請問申請補助需要準備哪些文件？"):
+    events = [{
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "webhookEventId": uuid.uuid4().hex.upper(),
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": uuid.uuid4().hex,
+        "source": {"type": "user", "userId": "U" + uuid.uuid4().hex},
+        "message": {"id": str(i), "type": "text", "quoteToken": uuid.uuid4().hex, "text": text},
+    } for i in range(event_count)]
+    return json.dumps({"destination": "Ubench", "events": events}, ensure_ascii=False).encode("utf-8")
+
+
+def legacy_handle(body_bytes, signature):
+    # 原本 LineBot_Rag_Pinecone.py 的流程 (Flask 的 get_data(as_text=True) 會先解碼一次)
+    body = body_bytes.decode("utf-8")
+    hash_val = hmac.new(SECRET.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    computed_signature = base64.b64encode(hash_val).decode("utf-8")
+    if signature != computed_signature:
+        raise ValueError("invalid signature")
+    return json.loads(body).get("events", [])
+
+
+def measure(handle, body, signature, n):
+    started = time.perf_counter()
+    for _ in range(n):
+        handle(body, signature)
+    return n / (time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Webhook 驗簽 + 解析 微基準測試")
+    arg_parser.add_argument("--events", type=int, action="append", help="每個 webhook 的事件數 (可重複指定)")
+    arg_parser.add_argument("-n", "--requests", type=int, default=20000)
+    args = arg_parser.parse_args()
+
+    ingress = WebhookIngress(SECRET)
+    print(f"JSON 解析器: {'orjson' if orjson else 'json (未安裝 orjson)'}")
+    for event_count in args.events or [1, 5, 20]:
+        body = make_body(event_count)
+        signature = ingress.signature_for(body).decode("ascii")
+        # 兩種寫法結果要一致，量出來的數字才有意義
+        assert [e.raw for e in ingress.handle(body, signature)] == legacy_handle(body, signature)
+
+        legacy = measure(legacy_handle, body, signature, args.requests)
+        fast = measure(ingress.handle, body, signature, args.requests)
+        print(f"📦 {event_count} 個事件 ({len(body)} bytes): "
+              f"legacy {legacy:,.0f} req/s | ingress {fast:,.0f} req/s | x{fast / legacy:.2f}")
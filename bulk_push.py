@@ -0,0 +1,355 @@
+import os
+import sys
+import io
+import json
+import time
+import uuid
+import sqlite3
+import argparse
+import threading
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+
+# ==========================================
+# 大量推播：multicast 批次 + 限速 + 可持久化的重試佇列
+# ==========================================
+# pushMessage() 一次只能送給一個人，通知上千位用戶就要上千個循序請求。
+# BulkPushEngine 把收件人切成每批最多 500 個 userId 的 multicast 請求：
+#   - 批次先寫進 SQLite 佇列 (push_queue.db)，行程重啟後會接著送
+#   - 多個 worker 同時送，但用 token bucket 控制每秒請求數，不超過 LINE 的限制
+#   - 失敗的批次 (連線錯誤、LineClient 重試後仍 429/5xx) 以指數退避排回佇列
+#   - 領取批次時寫上 owner 與租約到期時間；只有租約過期 (送的行程掛了) 的批次才會被別的行程接手，
+#     多個 gunicorn worker 共用同一個佇列時不會搶走彼此還在送的批次
+#   - 每批有固定的 X-Line-Retry-Key，重送時 LINE 不會重複送出 (已送過會回 409)
+#   - 每個 job 都有吞吐量報告 (收件人/秒、請求/秒)
+#
+# 用法: python bulk_push.py --to-file user_ids.txt --text "新文件已加入知識庫"
+
+MULTICAST_MAX_RECIPIENTS = 500
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second, burst=None):
+        self.rate = rate_per_second
+        self.capacity = burst or max(1, int(rate_per_second))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def try_acquire(self, timeout=0):
+        # 最多等 timeout 秒；拿不到 token 就回傳 False，不會一直卡住
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class PushQueue:
+    def __init__(self, path="push_queue.db", lease_seconds=120):
+        """lease_seconds 要比一批送完 (含 LineClient 的重試與等待) 還久，否則還在送的批次會被別人接手。"""
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.owner = self._new_owner()
+        self._local = threading.local()
+        os.register_at_fork(after_in_child=self._restart_after_fork)
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS push_batches (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id TEXT NOT NULL,
+                recipients TEXT NOT NULL,
+                recipient_count INTEGER NOT NULL,
+                messages TEXT NOT NULL,
+                retry_key TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                finished_at REAL,
+                owner TEXT,
+                lease_until REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_push_pending ON push_batches (status, next_attempt_at);
+            CREATE INDEX IF NOT EXISTS idx_push_job ON push_batches (job_id);
+        """)
+        # 舊版建立的資料庫沒有租約欄位
+        columns = {row[1] for row in self._conn().execute("PRAGMA table_info(push_batches)")}
+        for column, kind in (("owner", "TEXT"), ("lease_until", "REAL")):
+            if column not in columns:
+                self._conn().execute(f"ALTER TABLE push_batches ADD COLUMN {column} {kind}")
+        # 上次送到一半就停掉的批次不在這裡重設：別的行程可能還在送，租約過期後 claim() 才會接手
+        # (有 retry key，接手重送也不會重複送達)
+
+    @staticmethod
+    def _new_owner():
+        return f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    def _conn(self):
+        # sqlite3 連線不能跨執行緒共用，每個 worker thread 各開一條
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _restart_after_fork(self):
+        # sqlite3 連線不能帶到 fork 出來的子行程，子行程重新開連線；租約也要換成子行程自己的 owner
+        self._local = threading.local()
+        self.owner = self._new_owner()
+
+    def enqueue(self, job_id, user_ids, messages, batch_size=MULTICAST_MAX_RECIPIENTS):
+        now = time.time()
+        messages_json = json.dumps(messages, ensure_ascii=False)
+        rows = [
+            (job_id, json.dumps(user_ids[i:i + batch_size]), len(user_ids[i:i + batch_size]),
+             messages_json, str(uuid.uuid4()), now)
+            for i in range(0, len(user_ids), batch_size)
+        ]
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO push_batches (job_id, recipients, recipient_count, messages, retry_key, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+    def claim(self, limit):
+        # 取出到期的批次 (或租約已過期的 sending 批次)，標成 sending 並寫上自己的租約，避免重複領取
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, recipients, messages, retry_key, attempts FROM push_batches "
+                "WHERE (status = 'pending' AND next_attempt_at <= ?) "
+                "OR (status = 'sending' AND (lease_until IS NULL OR lease_until <= ?)) ORDER BY id LIMIT ?",
+                (now, now, limit)).fetchall()
+            conn.executemany(
+                "UPDATE push_batches SET status = 'sending', owner = ?, lease_until = ? WHERE id = ?",
+                [(self.owner, now + self.lease_seconds, r[0]) for r in rows])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [
+            {"id": r[0], "to": json.loads(r[1]), "messages": json.loads(r[2]), "retry_key": r[3], "attempts": r[4]}
+            for r in rows
+        ]
+
+    # 只更新自己租約中的批次；租約過期被別人接手後，結果以接手的行程為準
+    def mark_sent(self, batch_id):
+        self._conn().execute(
+            "UPDATE push_batches SET status = 'sent', attempts = attempts + 1, finished_at = ?, last_error = NULL, "
+            "owner = NULL, lease_until = NULL WHERE id = ? AND owner = ?", (time.time(), batch_id, self.owner))
+
+    def mark_retry(self, batch_id, error, delay):
+        self._conn().execute(
+            "UPDATE push_batches SET status = 'pending', attempts = attempts + 1, next_attempt_at = ?, last_error = ?, "
+            "owner = NULL, lease_until = NULL WHERE id = ? AND owner = ?",
+            (time.time() + delay, error, batch_id, self.owner))
+
+    def mark_failed(self, batch_id, error):
+        self._conn().execute(
+            "UPDATE push_batches SET status = 'failed', attempts = attempts + 1, finished_at = ?, last_error = ?, "
+            "owner = NULL, lease_until = NULL WHERE id = ? AND owner = ?", (time.time(), error, batch_id, self.owner))
+
+    def next_due(self):
+        # 下一個重試到期或租約過期的時間
+        row = self._conn().execute(
+            "SELECT MIN(CASE WHEN status = 'pending' THEN next_attempt_at ELSE COALESCE(lease_until, 0) END) "
+            "FROM push_batches WHERE status IN ('pending', 'sending')").fetchone()
+        return row[0]
+
+    def job_summary(self, job_id):
+        rows = self._conn().execute(
+            "SELECT status, COUNT(*), SUM(recipient_count), MIN(created_at), MAX(finished_at) "
+            "FROM push_batches WHERE job_id = ? GROUP BY status", (job_id,)).fetchall()
+        summary = {"job_id": job_id, "batches": {}, "recipients": {}}
+        started, finished = None, None
+        for status, batches, recipients, created_at, finished_at in rows:
+            summary["batches"][status] = batches
+            summary["recipients"][status] = recipients
+            started = created_at if started is None else min(started, created_at)
+            if finished_at:
+                finished = finished_at if finished is None else max(finished, finished_at)
+        summary["created_at"] = started
+        summary["finished_at"] = finished
+        return summary
+
+    def stats(self):
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM push_batches GROUP BY status").fetchall()
+        return dict(rows)
+
+
+class BulkPushEngine:
+    def __init__(self, line_client, queue, max_concurrency=4, requests_per_second=100,
+                 max_attempts=5, retry_base_seconds=5.0):
+        self.line_client = line_client
+        self.queue = queue
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.bucket = TokenBucket(requests_per_second)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="bulk-push")
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.requests_sent = 0
+        self.recipients_sent = 0
+        self.busy_seconds = 0.0
+
+    def submit(self, user_ids, messages):
+        """把收件人切批寫進佇列，回傳 job_id；實際送出由背景執行緒負責。"""
+        # 去掉重複的 userId，保留原本順序
+        user_ids = list(dict.fromkeys(user_ids))
+        job_id = uuid.uuid4().hex
+        batches = self.queue.enqueue(job_id, user_ids, messages)
+        print(f"📨 推播工作 {job_id}：{len(user_ids)} 位收件人，{batches} 批")
+        self._wake.set()
+        return job_id
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="bulk-push-drain", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.drain()
+            # 等新的工作，或等到下一個重試批次到期
+            next_due = self.queue.next_due()
+            timeout = None if next_due is None else max(0.0, next_due - time.time())
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+    def drain(self):
+        # 把目前到期的批次全部送完 (重試的批次要等到期才會再被領取)
+        started = time.perf_counter()
+        while True:
+            batches = self.queue.claim(self.max_concurrency * 2)
+            if not batches:
+                break
+            list(self.executor.map(self._send_batch, batches))
+        with self._lock:
+            self.busy_seconds += time.perf_counter() - started
+
+    def _send_batch(self, batch):
+        self.bucket.acquire()
+        try:
+            response = self.line_client.multicast(batch["to"], batch["messages"], retry_key=batch["retry_key"])
+            status, error = response.status_code, response.text
+        except Exception as e:
+            status, error = None, str(e)
+
+        # 409：這個 retry key 已經送過了 (上次其實成功)，當作完成
+        if status in (200, 409):
+            self.queue.mark_sent(batch["id"])
+            with self._lock:
+                self.requests_sent += 1
+                self.recipients_sent += len(batch["to"])
+        elif (status is None or status in RETRYABLE_STATUS) and batch["attempts"] + 1 < self.max_attempts:
+            delay = self.retry_base_seconds * (2 ** batch["attempts"])
+            print(f"⚠️ 推播批次 {batch['id']} 失敗 ({status})，{delay:.1f} 秒後重試")
+            self.queue.mark_retry(batch["id"], error, delay)
+        else:
+            print(f"❌ 推播批次 {batch['id']} 放棄 ({status}): {error}")
+            self.queue.mark_failed(batch["id"], error)
+
+    def report(self, job_id):
+        summary = self.queue.job_summary(job_id)
+        sent = summary["recipients"].get("sent", 0)
+        if summary["created_at"] and summary["finished_at"]:
+            seconds = max(summary["finished_at"] - summary["created_at"], 1e-6)
+            summary["seconds"] = round(seconds, 3)
+            summary["recipients_per_sec"] = round(sent / seconds, 1)
+            summary["requests_per_sec"] = round(summary["batches"].get("sent", 0) / seconds, 1)
+        summary["done"] = not (summary["batches"].get("pending") or summary["batches"].get("sending"))
+        return summary
+
+    def wait(self, job_id, poll_seconds=0.5, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            report = self.report(job_id)
+            if report["done"] or (deadline and time.monotonic() > deadline):
+                return report
+            time.sleep(poll_seconds)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue": self.queue.stats(),
+                "requests_sent": self.requests_sent,
+                "recipients_sent": self.recipients_sent,
+                "recipients_per_busy_sec": round(self.recipients_sent / self.busy_seconds, 1) if self.busy_seconds else 0,
+            }
+
+
+def create_bulk_push_engine(config, line_client):
+    # 依 config.ini 的 [bulk-push] 區段建立並啟動背景送出執行緒
+    engine = BulkPushEngine(
+        line_client,
+        PushQueue(config.get('bulk-push', 'queue_path', fallback='push_queue.db'),
+                  lease_seconds=config.getfloat('bulk-push', 'lease_seconds', fallback=120)),
+        max_concurrency=config.getint('bulk-push', 'max_concurrency', fallback=4),
+        requests_per_second=config.getfloat('bulk-push', 'requests_per_second', fallback=100),
+        max_attempts=config.getint('bulk-push', 'max_attempts', fallback=5),
+        retry_base_seconds=config.getfloat('bulk-push', 'retry_base_seconds', fallback=5.0),
+    )
+    engine.start()
+    return engine
+
+
+if __name__ == "__main__":
+    from line_client import create_line_client
+
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+    parser = argparse.ArgumentParser(description="用 multicast 大量推播文字訊息")
+    parser.add_argument("--to-file", required=True, help="每行一個 userId")
+    parser.add_argument("--text", required=True)
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+
+    with open(args.to_file, encoding="utf-8") as f:
+        user_ids = [line.strip() for line in f if line.strip()]
+
+    engine = create_bulk_push_engine(config, create_line_client(config))
+    job_id = engine.submit(user_ids, [{"type": "text", "text": args.text}])
+    report = engine.wait(job_id)
+    print(f"📊 {json.dumps(report, ensure_ascii=False)}")
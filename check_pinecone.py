@@ -1,16 +1,14 @@
 import os
 import configparser
-from pinecone import Pinecone
+from local_vector_store import open_index
 
 # 1. 讀取設定
 config = configparser.ConfigParser()
 config.read('config.ini')
-api_key = config.get('line-bot', 'PINECONE_API_KEY')
 
-# 2. 連接 Pinecone
-pc = Pinecone(api_key=api_key)
+# 2. 連接 Pinecone ([vector-store] backend = local 時改開本地索引，不需要連線)
 index_name = "line-bot-bitcoin"
-index = pc.Index(index_name)
+index = open_index(config, index_name, create=False)
 
 # 3. 查看統計數據
 stats = index.describe_index_stats()
@@ -22,7 +20,7 @@ print("-" * 30)
 # 4. 試著「搜尋」看看裡面的內容
 # 因為向量資料庫不能用 "Select *", 我們用一個「全零向量」去隨便搜前 3 筆最接近的
 # 384 是因為我們用 all-MiniLM-L6-v2 模型
-dummy_vector = [0.1] * 384 
+dummy_vector = [0.1] * stats['dimension']
 
 results = index.query(
     vector=dummy_vector,
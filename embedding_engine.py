@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+import threading
+import multiprocessing
+
+
+# ==========================================
+# 批次 + 多行程向量化引擎
+# ==========================================
+# HuggingFaceEmbeddings 預設只在單一行程裡跑，PDF 一多 CPU 大部分核心都閒著。
+# 這裡把 chunk 切成固定大小的批次，丟給 process pool 平行 encode，
+# 完成一批就 yield 一批，讓呼叫端可以邊算邊寫進向量資料庫。
+#
+# 介面跟 LangChain 的 Embeddings 相同 (embed_documents / embed_query)，
+# 可以直接取代 HuggingFaceEmbeddings 傳給 Chroma 或 PineconeVectorStore。
+
+DEFAULT_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+_worker_model = None
+
+
+def _init_worker(model_name, threads_per_worker):
+    # 每個子行程只載入一次模型；限制 torch 執行緒數，避免 N 個行程 x N 個執行緒互搶 CPU
+    global _worker_model
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(threads_per_worker)
+    _worker_model = SentenceTransformer(model_name)
+
+
+def _encode_batch(texts):
+    return _worker_model.encode(texts, batch_size=len(texts), show_progress_bar=False).tolist()
+
+
+def _start_method():
+    # 單執行緒、還沒載入 torch 的行程 (例如 ingest_pinecone.py、RAG_PDF.py) 用 fork：子行程不必重新 import 主程式，啟動最快。
+    # 已經有其他執行緒 (Flask、JobQueue、暖機執行緒) 或 torch 的執行緒池時，fork 出來的子行程
+    # 可能拿到被鎖住的鎖而卡死，也會觸發 register_at_fork 的 hook，這時改用 spawn；
+    # spawn 會重新 import 主程式，主程式必須有 if __name__ == "__main__": 保護。
+    if 'torch' not in sys.modules and threading.active_count() == 1 \
+            and 'fork' in multiprocessing.get_all_start_methods():
+        return "fork"
+    return "spawn"
+
+
+class BatchEmbeddingEngine:
+    def __init__(self, model_name=DEFAULT_MODEL_NAME, batch_size=64, num_workers=None):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.num_workers = num_workers or max(1, (os.cpu_count() or 2) - 1)
+        self._pool = None
+        self._local_model = None
+
+        # 統計數據
+        self.embedded_chunks = 0
+        self.embed_seconds = 0.0
+
+    def _get_pool(self):
+        if self._pool is None:
+            threads = max(1, (os.cpu_count() or 1) // self.num_workers)
+            ctx = multiprocessing.get_context(_start_method())
+            self._pool = ctx.Pool(
+                processes=self.num_workers,
+                initializer=_init_worker,
+                initargs=(self.model_name, threads),
+            )
+        return self._pool
+
+    def _get_local_model(self):
+        if self._local_model is None:
+            from sentence_transformers import SentenceTransformer
+            self._local_model = SentenceTransformer(self.model_name)
+        return self._local_model
+
+    def iter_embeddings(self, texts):
+        """依序 yield (texts 中的起始位置, 該批向量)，可以一邊算一邊寫入向量資料庫。"""
+        texts = list(texts)
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if not batches:
+            return
+
+        started = time.perf_counter()
+        done = 0
+        if self.num_workers == 1:
+            model = self._get_local_model()
+            results = (model.encode(b, batch_size=len(b), show_progress_bar=False).tolist() for b in batches)
+        else:
+            # imap 保持原本順序，但每批完成就能先拿到
+            results = self._get_pool().imap(_encode_batch, batches)
+
+        for i, vectors in enumerate(results):
+            done += len(vectors)
+            elapsed = time.perf_counter() - started
+            print(f"⚡ 已向量化 {done}/{len(texts)} 段，{done / elapsed:.1f} chunks/sec")
+            yield i * self.batch_size, vectors
+
+        self.embedded_chunks += done
+        self.embed_seconds += time.perf_counter() - started
+
+    def embed_documents(self, texts):
+        vectors = []
+        for _, batch in self.iter_embeddings(texts):
+            vectors.extend(batch)
+        return vectors
+
+    def embed_query(self, text):
+        # 查詢只有一句，不值得走 process pool
+        return self._get_local_model().encode(text, show_progress_bar=False).tolist()
+
+    def chunks_per_sec(self):
+        if self.embed_seconds == 0:
+            return 0.0
+        return self.embedded_chunks / self.embed_seconds
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,218 @@
+import os
+import time
+import sqlite3
+import threading
+
+
+# ==========================================
+# Webhook 事件去重 (依 webhookEventId)
+# ==========================================
+# RAG 回覆慢的時候，LINE 會重送同一個 webhook (deliveryContext.isRedelivery = true)，
+# 以前 bot 會對同一個 webhookEventId 再檢索、再呼叫一次 Gemini，多付一次錢還可能回覆兩次。
+#
+# 每個事件先 claim()：
+#   - 第一次看到 → 標記為「處理中」，回傳 True，照常處理
+#   - 已經處理完或正在處理 → 回傳 False，呼叫端直接略過 (計入 suppressed)
+# 處理成功呼叫 complete() (保留 ttl_seconds)，失敗呼叫 release() 讓之後的重送可以再處理。
+# 「處理中」有自己的期限 (in_flight_ttl_seconds)，worker 當掉也不會把事件永遠卡住。
+#
+# 兩種後端，介面相同 (claim / complete / release / run / stats)：
+#   InMemoryDedupStore : 單一行程
+#   SQLiteDedupStore   : 本機 SQLite 檔案，多個 gunicorn worker 共用
+
+SWEEP_EVERY_N_CLAIMS = 200
+
+IN_FLIGHT = "in_flight"
+DONE = "done"
+
+
+class InMemoryDedupStore:
+    def __init__(self, ttl_seconds=3600, in_flight_ttl_seconds=600):
+        self.ttl_seconds = ttl_seconds
+        self.in_flight_ttl_seconds = in_flight_ttl_seconds
+        self._events = {}  # webhookEventId -> (狀態, 到期時間)
+        self._claims = 0
+        self._lock = threading.Lock()
+
+        self.claimed = 0
+        self.suppressed_in_flight = 0
+        self.suppressed_done = 0
+
+    def claim(self, event_id):
+        # 沒有 webhookEventId (舊格式或測試用事件) 就無法去重，一律處理
+        if not event_id:
+            return True
+        now = time.time()
+        with self._lock:
+            entry = self._events.get(event_id)
+            if entry is not None and entry[1] > now:
+                if entry[0] == DONE:
+                    self.suppressed_done += 1
+                else:
+                    self.suppressed_in_flight += 1
+                return False
+            self._events[event_id] = (IN_FLIGHT, now + self.in_flight_ttl_seconds)
+            self.claimed += 1
+            self._claims += 1
+            if self._claims % SWEEP_EVERY_N_CLAIMS == 0:
+                self._sweep(now)
+            return True
+
+    def complete(self, event_id):
+        if event_id:
+            with self._lock:
+                self._events[event_id] = (DONE, time.time() + self.ttl_seconds)
+
+    def release(self, event_id):
+        if event_id:
+            with self._lock:
+                self._events.pop(event_id, None)
+
+    def _sweep(self, now):
+        expired = [event_id for event_id, (_, expires_at) in self._events.items() if expires_at <= now]
+        for event_id in expired:
+            del self._events[event_id]
+
+    def run(self, event_id, func, *args, **kwargs):
+        return _run(self, event_id, func, *args, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "memory",
+                "tracked": len(self._events),
+                "claimed": self.claimed,
+                "suppressed": self.suppressed_in_flight + self.suppressed_done,
+                "suppressed_in_flight": self.suppressed_in_flight,
+                "suppressed_done": self.suppressed_done,
+            }
+
+
+class SQLiteDedupStore:
+    def __init__(self, path="webhook_events.db", ttl_seconds=3600, in_flight_ttl_seconds=600):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.in_flight_ttl_seconds = in_flight_ttl_seconds
+        self._local = threading.local()
+        self._claims = 0
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._restart_after_fork)
+
+        self.claimed = 0
+        self.suppressed_in_flight = 0
+        self.suppressed_done = 0
+
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS webhook_events (
+                event_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_webhook_events_expires ON webhook_events (expires_at);
+        """)
+
+    def _conn(self):
+        # sqlite3 連線不能跨執行緒共用，每個執行緒各開一條
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _restart_after_fork(self):
+        # gunicorn preload 時 store 在 master 建立；sqlite3 連線不能帶到 fork 出來的 worker，子行程重新開連線
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def claim(self, event_id):
+        if not event_id:
+            return True
+        conn = self._conn()
+        now = time.time()
+        # BEGIN IMMEDIATE 先拿寫入鎖，兩個 worker 同時收到同一個事件時只有一個會 claim 成功
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT state, expires_at FROM webhook_events WHERE event_id = ?", (event_id,)
+            ).fetchone()
+            if row is not None and row[1] > now:
+                conn.execute("COMMIT")
+                with self._lock:
+                    if row[0] == DONE:
+                        self.suppressed_done += 1
+                    else:
+                        self.suppressed_in_flight += 1
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO webhook_events (event_id, state, expires_at) VALUES (?, ?, ?)",
+                (event_id, IN_FLIGHT, now + self.in_flight_ttl_seconds),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        with self._lock:
+            self.claimed += 1
+            self._claims += 1
+            sweep = self._claims % SWEEP_EVERY_N_CLAIMS == 0
+        if sweep:
+            conn.execute("DELETE FROM webhook_events WHERE expires_at <= ?", (now,))
+        return True
+
+    def complete(self, event_id):
+        if event_id:
+            self._conn().execute(
+                "UPDATE webhook_events SET state = ?, expires_at = ? WHERE event_id = ?",
+                (DONE, time.time() + self.ttl_seconds, event_id),
+            )
+
+    def release(self, event_id):
+        if event_id:
+            self._conn().execute("DELETE FROM webhook_events WHERE event_id = ?", (event_id,))
+
+    def run(self, event_id, func, *args, **kwargs):
+        return _run(self, event_id, func, *args, **kwargs)
+
+    def stats(self):
+        tracked = self._conn().execute("SELECT COUNT(*) FROM webhook_events").fetchone()[0]
+        with self._lock:
+            return {
+                "backend": "sqlite",
+                "path": self.path,
+                "tracked": tracked,
+                "claimed": self.claimed,
+                "suppressed": self.suppressed_in_flight + self.suppressed_done,
+                "suppressed_in_flight": self.suppressed_in_flight,
+                "suppressed_done": self.suppressed_done,
+            }
+
+
+def _run(store, event_id, func, *args, **kwargs):
+    # 給 job_queue.submit() 用：成功就標記完成，丟例外就釋放，讓 LINE 重送時可以再試
+    try:
+        result = func(*args, **kwargs)
+    except BaseException:
+        store.release(event_id)
+        raise
+    store.complete(event_id)
+    return result
+
+
+def create_dedup_store(config):
+    # 依 config.ini 的 [webhook-dedup] 區段建立對應的後端
+    backend = config.get('webhook-dedup', 'backend', fallback='memory')
+    ttl = config.getint('webhook-dedup', 'ttl_seconds', fallback=3600)
+    in_flight_ttl = config.getint('webhook-dedup', 'in_flight_ttl_seconds', fallback=600)
+
+    if backend == 'sqlite':
+        return SQLiteDedupStore(
+            path=config.get('webhook-dedup', 'sqlite_path', fallback='webhook_events.db'),
+            ttl_seconds=ttl,
+            in_flight_ttl_seconds=in_flight_ttl,
+        )
+    if backend == 'memory':
+        return InMemoryDedupStore(ttl_seconds=ttl, in_flight_ttl_seconds=in_flight_ttl)
+    raise ValueError(f"不支援的 webhook-dedup backend: {backend} (可用: memory / sqlite)")
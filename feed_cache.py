@@ -0,0 +1,127 @@
+import time
+import threading
+
+import requests
+
+
+# ==========================================
+# 外部資料快取 (背景定期更新)
+# ==========================================
+# 以前「今日確診人數」每次都把整份 NHI_COVID-19.json 下載、解析完，只取最後一筆。
+# FeedCache 改成由背景執行緒照排程更新，指令只讀記憶體裡的結果：
+#   - 條件式請求：帶 If-None-Match / If-Modified-Since，沒變就是 304，不用重下載
+#   - 保留最後一次成功的值：上游變慢或掛掉時照樣回覆舊資料
+#   - 失敗後用較短的間隔重試
+# 一個 FeedCache 可以同時掛多個 feed，之後其他開放資料也能用 register() 加進來。
+
+
+class Feed:
+    def __init__(self, name, url, parse, refresh_seconds=3600, retry_seconds=60, timeout=10, verify=True):
+        """parse(bytes) -> 要快取的值；丟例外就當作這次更新失敗，保留舊值。"""
+        self.name = name
+        self.url = url
+        self.parse = parse
+        self.refresh_seconds = refresh_seconds
+        self.retry_seconds = retry_seconds
+        self.timeout = timeout
+        self.verify = verify
+
+        self.value = None
+        self.etag = None
+        self.last_modified = None
+        self.updated_at = None     # 最後一次拿到新內容的時間
+        self.checked_at = None     # 最後一次成功問過上游的時間 (含 304)
+        self.next_refresh = 0
+        self.last_error = None
+        self.fetches = 0
+        self.not_modified = 0
+        self.failures = 0
+
+    def stats(self):
+        return {
+            "has_value": self.value is not None,
+            "updated_at": self.updated_at,
+            "checked_at": self.checked_at,
+            "fetches": self.fetches,
+            "not_modified": self.not_modified,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+class FeedCache:
+    def __init__(self, session=None):
+        self.session = session or requests.Session()
+        self._feeds = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def register(self, name, url, parse, **kwargs):
+        feed = Feed(name, url, parse, **kwargs)
+        with self._lock:
+            self._feeds[name] = feed
+        self._wake.set()
+        return feed
+
+    def get(self, name):
+        # 請求路徑只讀記憶體；還沒抓到過就回傳 None
+        return self._feeds[name].value
+
+    def refresh(self, name):
+        feed = self._feeds[name]
+        headers = {}
+        if feed.etag:
+            headers["If-None-Match"] = feed.etag
+        if feed.last_modified:
+            headers["If-Modified-Since"] = feed.last_modified
+
+        try:
+            response = self.session.get(feed.url, headers=headers, timeout=feed.timeout, verify=feed.verify)
+            if response.status_code == 304:
+                feed.not_modified += 1
+            else:
+                response.raise_for_status()
+                # 先解析成功才換掉舊值
+                feed.value = feed.parse(response.content)
+                feed.etag = response.headers.get("ETag")
+                feed.last_modified = response.headers.get("Last-Modified")
+                feed.updated_at = time.time()
+                feed.fetches += 1
+            feed.checked_at = time.time()
+            feed.last_error = None
+            feed.next_refresh = time.monotonic() + feed.refresh_seconds
+            return True
+        except Exception as e:
+            feed.failures += 1
+            feed.last_error = str(e)
+            feed.next_refresh = time.monotonic() + min(feed.retry_seconds, feed.refresh_seconds)
+            print(f"⚠️ 更新資料來源 {name} 失敗，沿用上一次的資料: {e}")
+            return False
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="feed-cache", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            with self._lock:
+                feeds = list(self._feeds.values())
+            for feed in feeds:
+                if feed.next_refresh <= now:
+                    self.refresh(feed.name)
+            # 睡到下一個 feed 該更新的時間；register() 會提早叫醒
+            next_due = min((f.next_refresh for f in feeds), default=now + 60)
+            self._wake.wait(max(0.0, next_due - time.monotonic()))
+            self._wake.clear()
+
+    def stats(self):
+        with self._lock:
+            return {name: feed.stats() for name, feed in self._feeds.items()}
@@ -0,0 +1,40 @@
+import gc
+import sys
+import configparser
+
+# ==========================================
+# gunicorn 設定 (多 worker 部署 LineBot_RAG.py)
+# ==========================================
+#   gunicorn -c gunicorn.conf.py LineBot_RAG:app
+#
+# config.ini 的 [startup] mode = preload 時開啟 preload_app：
+# master 先 import LineBot_RAG 並載入 MiniLM (warmup.py 的 preload)，再 fork 出 worker，
+# 模型權重的記憶體分頁由所有 worker 以 copy-on-write 共用，不會每個 worker 各載一份。
+# 比較 RSS / PSS：python rss_report.py --match "gunicorn"
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+bind = config.get('gunicorn', 'bind', fallback='0.0.0.0:5001')
+workers = config.getint('gunicorn', 'workers', fallback=2)
+# RAG 的工作在 JobQueue 背景執行緒跑，webhook 本身很快，sync worker 就夠了
+timeout = config.getint('gunicorn', 'timeout', fallback=120)
+preload_app = config.get('startup', 'mode', fallback='background') == 'preload'
+
+# 每個 worker 的 torch 執行緒數；0 表示不設定 (torch 預設用全部核心，多 worker 時會互搶 CPU)
+TORCH_THREADS_PER_WORKER = config.getint('gunicorn', 'torch_threads_per_worker', fallback=1)
+
+
+def when_ready(server):
+    # master 已經 import 完 app、還沒 fork worker；
+    # 把目前所有物件移到 GC 的永久世代，worker 的垃圾回收就不會去碰這些分頁而觸發複製
+    if preload_app:
+        gc.collect()
+        gc.freeze()
+        server.log.info("preload 完成，已凍結 %d 個物件，開始 fork worker", gc.get_freeze_count())
+
+
+def post_fork(server, worker):
+    torch = sys.modules.get("torch")
+    if torch is not None and TORCH_THREADS_PER_WORKER > 0:
+        torch.set_num_threads(TORCH_THREADS_PER_WORKER)
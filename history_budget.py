@@ -0,0 +1,132 @@
+import threading
+
+
+# ==========================================
+# 以 Token 預算修剪對話紀錄
+# ==========================================
+# 原本只用「最近 5 輪」限制歷史，但一則長答案就能讓 prompt 暴增、延遲跟著變長。
+# 這裡改成估算 token 數，從最新的一輪往回放，超過預算的舊對話：
+#   drop      : 直接丟掉
+#   summarize : 在本地壓成一行「先前聊過的問題」摘要 (不額外呼叫 LLM)
+#
+# Token 數用簡單規則估算：中日韓文字一字約 1 token，其他字元約 4 個 1 token。
+
+HISTORY_OVERFLOW_MODES = ("drop", "summarize")
+SUMMARY_QUESTION = "（先前的對話摘要）"
+SUMMARY_QUESTION_CHARS = 40
+
+
+def _is_cjk(ch):
+    code = ord(ch)
+    return (
+        0x4E00 <= code <= 0x9FFF      # CJK 統一漢字
+        or 0x3400 <= code <= 0x4DBF   # 擴充 A
+        or 0x3040 <= code <= 0x30FF   # 日文假名
+        or 0xAC00 <= code <= 0xD7AF   # 韓文
+        or 0xFF00 <= code <= 0xFFEF   # 全形符號
+        or 0x3000 <= code <= 0x303F   # 中文標點
+    )
+
+
+def estimate_tokens(text):
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+
+def _turn_tokens(turn):
+    return estimate_tokens(turn[0]) + estimate_tokens(turn[1])
+
+
+def _truncate_to_tokens(text, max_tokens):
+    # 從頭保留到預算用完為止
+    if max_tokens <= 0:
+        return ""
+    kept = []
+    used = 0.0
+    for ch in text:
+        used += 1 if _is_cjk(ch) else 0.25
+        if used > max_tokens:
+            kept.append("…")
+            break
+        kept.append(ch)
+    return "".join(kept)
+
+
+def _summarize(turns):
+    questions = [q[:SUMMARY_QUESTION_CHARS] for q, _ in turns]
+    return (SUMMARY_QUESTION, "先前聊過：" + "；".join(questions))
+
+
+def trim_history(chat_history, budget_tokens, overflow="drop"):
+    """回傳 (修剪後的歷史 list, 歷史佔用的 token 數)。"""
+    if overflow not in HISTORY_OVERFLOW_MODES:
+        raise ValueError(f"history_overflow 必須是 {HISTORY_OVERFLOW_MODES} 其中之一，收到: {overflow}")
+    kept = []
+    used = 0
+    cut = 0  # chat_history[:cut] 是放不下、要丟掉的舊對話
+    # 從最新往回放，放不下的就是較舊的對話
+    for i in range(len(chat_history) - 1, -1, -1):
+        turn = chat_history[i]
+        cost = _turn_tokens(turn)
+        if used + cost <= budget_tokens:
+            kept.append(turn)
+            used += cost
+            continue
+        cut = i + 1
+        if not kept:
+            # 連最新的一輪都放不下：保留問題，答案截斷到剩餘預算
+            remaining = budget_tokens - estimate_tokens(turn[0])
+            if remaining > 0:
+                # 留 1 token 給省略號
+                truncated = (turn[0], _truncate_to_tokens(turn[1], remaining - 1))
+                kept.append(truncated)
+                used += _turn_tokens(truncated)
+                cut = i
+        break
+    kept.reverse()
+
+    if cut and overflow == "summarize":
+        summary = _summarize(chat_history[:cut])
+        cost = _turn_tokens(summary)
+        if used + cost <= budget_tokens:
+            kept.insert(0, summary)
+            used += cost
+    return kept, used
+
+
+class PromptSizeTracker:
+    # 記錄每次請求的 prompt 大小，給 log 與 /metrics 使用
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.total_tokens = 0
+        self.max_tokens = 0
+        self.last = None
+
+    def record(self, question, history_tokens, source_documents=()):
+        question_tokens = estimate_tokens(question)
+        context_tokens = sum(estimate_tokens(d.page_content) for d in source_documents)
+        total = question_tokens + history_tokens + context_tokens
+        report = {
+            "question_tokens": question_tokens,
+            "history_tokens": history_tokens,
+            "context_tokens": context_tokens,
+            "total_tokens": total,
+        }
+        with self._lock:
+            self.requests += 1
+            self.total_tokens += total
+            self.max_tokens = max(self.max_tokens, total)
+            self.last = report
+        print(f"📏 Prompt 大小 ≈ {total} tokens (問題 {question_tokens}、歷史 {history_tokens}、文件 {context_tokens})")
+        return report
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "avg_tokens": round(self.total_tokens / self.requests, 1) if self.requests else 0,
+                "max_tokens": self.max_tokens,
+                "last": self.last,
+            }
@@ -0,0 +1,227 @@
+import os
+import sys
+import io
+import json
+import time
+import hashlib
+import argparse
+import configparser
+
+
+# ==========================================
+# Pinecone 增量匯入 (Content-addressed Ingestion)
+# ==========================================
+# 每個 chunk 用「內容 + 來源 + 切塊/模型設定」算 sha256，雜湊值就是向量 ID。
+# 重新匯入時只 upsert 新的 / 變動過的 chunk，並刪掉已經不存在的 ID，
+# 成本只跟差異大小有關，不用再整個 index 清空重灌。
+# 只會刪掉「這次有傳進來的 PDF」的舊 chunk，其他文件的向量不動；
+# 要把沒傳進來的文件也一起清掉 (索引內容 = 這次傳入的 PDF)，加 --prune。
+# 沒有 manifest 時 (例如舊版 from_documents 用 UUID 上傳的資料)，索引裡的 ID 不知道來源，
+# 一律當成這次匯入的 PDF 的舊版本刪掉，否則同一段文字會以新舊兩個 ID 各存一份。
+#
+# 用法:
+#   python ingest_pinecone.py bitcoin_paper.pdf other.pdf
+#   python ingest_pinecone.py --dry-run bitcoin_paper.pdf
+#   python ingest_pinecone.py --prune bitcoin_paper.pdf
+# config.ini 的 [vector-store] backend = local 時改匯入本地索引 (local_vector_store.py)，不需要 Pinecone
+
+INDEX_NAME = "line-bot-bitcoin"
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_DIMENSION = 384
+DEFAULT_MANIFEST = "pinecone_manifest.json"
+UPSERT_BATCH_SIZE = 100
+DELETE_BATCH_SIZE = 1000
+
+
+def chunk_id(chunk, model_name, chunk_size, chunk_overlap):
+    source = os.path.basename(chunk.metadata.get('source', ''))
+    page = chunk.metadata.get('page', '')
+    raw = f"{model_name}|{chunk_size}|{chunk_overlap}|{source}|{page}|{chunk.page_content}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    # 先寫暫存檔再取代，避免中途失敗留下壞掉的 manifest
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def ensure_index(pc, index_name=INDEX_NAME):
+    from pinecone import ServerlessSpec
+
+    # 檢查並建立 Index
+    if index_name not in pc.list_indexes().names():
+        print(f"📦 索引 {index_name} 不存在，正在建立中...")
+        pc.create_index(
+            name=index_name,
+            dimension=EMBEDDING_DIMENSION,
+            metric="cosine",
+            spec=ServerlessSpec(cloud="aws", region="us-east-1")
+        )
+        while not pc.describe_index(index_name).status['ready']:
+            time.sleep(1)
+    return pc.Index(index_name)
+
+
+def list_index_ids(index):
+    # 沒有 manifest 時 (例如舊版用 from_documents 上傳的資料)，直接列出雲端所有 ID 來對帳
+    ids = set()
+    for page in index.list():
+        ids.update(page)
+    return ids
+
+
+def iter_embeddings(embeddings, texts):
+    # BatchEmbeddingEngine 會邊算邊 yield；一般的 LangChain Embeddings 就自己切批次
+    if hasattr(embeddings, 'iter_embeddings'):
+        yield from embeddings.iter_embeddings(texts)
+        return
+    for start in range(0, len(texts), UPSERT_BATCH_SIZE):
+        yield start, embeddings.embed_documents(texts[start:start + UPSERT_BATCH_SIZE])
+
+
+def ingest(pdf_paths, index, embeddings, manifest_path=DEFAULT_MANIFEST,
+           index_name=INDEX_NAME, model_name=EMBEDDING_MODEL_NAME,
+           chunk_size=1000, chunk_overlap=200, dry_run=False, prune=False):
+    from rag_index import load_and_split, file_sha256
+
+    chunks = load_and_split(pdf_paths, chunk_size, chunk_overlap)
+    current = {}
+    for chunk in chunks:
+        # 同一份文件內完全相同的段落只存一份
+        current.setdefault(chunk_id(chunk, model_name, chunk_size, chunk_overlap), chunk)
+
+    manifest = load_manifest(manifest_path)
+    if manifest is None or manifest.get('index_name') != index_name \
+            or index.describe_index_stats()['total_vector_count'] == 0:
+        # manifest 不存在、屬於別的 index，或雲端已被清空時，manifest 都不可信
+        print("⚠️ manifest 不存在或已過期，改用雲端索引現有的 ID 對帳")
+        # 只拿得到 ID，不知道來源是哪個檔案；不在這次 chunk 裡的都當成過期的刪掉
+        known = {vid: {"source": None} for vid in list_index_ids(index)}
+        known_sources = {}
+    else:
+        known = manifest.get('chunks', {})
+        known_sources = manifest.get('sources', {})
+
+    sources = {os.path.basename(p) for p in pdf_paths}
+    to_upsert = [i for i in current if i not in known]
+    to_delete = [i for i, info in known.items()
+                 if i not in current and (prune or info.get('source') is None or info.get('source') in sources)]
+    unmanifested = sum(1 for i in to_delete if known[i].get('source') is None)
+    if unmanifested:
+        print(f"⚠️ {unmanifested} 個 ID 沒有 manifest 紀錄，視為 {', '.join(sorted(sources))} 的舊版本一併刪除")
+    deleted = set(to_delete)
+    # 沒傳進來的文件：chunk 留在索引裡，manifest 也照樣記著
+    kept = {i: info for i, info in known.items() if i not in current and i not in deleted}
+    print(f"📊 共 {len(current)} 個 chunk：新增/變更 {len(to_upsert)}，刪除 {len(to_delete)}，"
+          f"不變 {len(current) - len(to_upsert)}，其他文件保留 {len(kept)}")
+
+    if dry_run:
+        return {"upserted": 0, "deleted": 0, "unchanged": len(current) - len(to_upsert)}
+
+    uploaded = 0
+    for offset, vectors in iter_embeddings(embeddings, [current[i].page_content for i in to_upsert]):
+        # 向量化完一批就上傳一批，不必等全部算完
+        for start in range(0, len(vectors), UPSERT_BATCH_SIZE):
+            batch_ids = to_upsert[offset + start:offset + start + UPSERT_BATCH_SIZE]
+            index.upsert(vectors=[
+                {
+                    "id": vid,
+                    "values": vec,
+                    # LangChain 的 PineconeVectorStore 預設從 metadata['text'] 取回原文
+                    "metadata": dict(_clean_metadata(current[vid].metadata), text=current[vid].page_content),
+                }
+                for vid, vec in zip(batch_ids, vectors[start:start + UPSERT_BATCH_SIZE])
+            ])
+            uploaded += len(batch_ids)
+        print(f"📤 已上傳 {uploaded}/{len(to_upsert)}")
+
+    for start in range(0, len(to_delete), DELETE_BATCH_SIZE):
+        index.delete(ids=to_delete[start:start + DELETE_BATCH_SIZE])
+    if to_delete:
+        print(f"🗑️ 已刪除 {len(to_delete)} 筆過期向量")
+    if hasattr(index, 'flush'):
+        # 本地索引 (local_vector_store.py) 要把這次的變更重建成可以查詢的陣列
+        index.flush()
+
+    save_manifest(manifest_path, {
+        "index_name": index_name,
+        "model_name": model_name,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "updated_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "sources": dict({} if prune else known_sources,
+                        **{os.path.basename(p): file_sha256(p) for p in pdf_paths}),
+        "chunks": dict(kept, **{
+            vid: {
+                "source": os.path.basename(c.metadata.get('source', '')),
+                "page": c.metadata.get('page'),
+            }
+            for vid, c in current.items()
+        }),
+    })
+    print(f"✅ 匯入完成，manifest 已寫入 {manifest_path}")
+    return {"upserted": len(to_upsert), "deleted": len(to_delete), "unchanged": len(current) - len(to_upsert)}
+
+
+def _clean_metadata(metadata):
+    # Pinecone metadata 只接受字串、數字、布林與字串清單
+    return {
+        k: v for k, v in metadata.items()
+        if isinstance(v, (str, int, float, bool))
+        or (isinstance(v, list) and all(isinstance(x, str) for x in v))
+    }
+
+
+if __name__ == "__main__":
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+    parser = argparse.ArgumentParser(description="把 PDF 增量匯入 Pinecone")
+    parser.add_argument('pdfs', nargs='*', default=["bitcoin_paper.pdf"])
+    parser.add_argument('--manifest', default=None, help="預設 pinecone_manifest.json；本地索引放在索引目錄裡")
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--chunk-overlap', type=int, default=200)
+    parser.add_argument('--dry-run', action='store_true', help="只計算差異，不實際上傳/刪除")
+    parser.add_argument('--prune', action='store_true',
+                        help="一併刪除沒有傳進來的文件的向量 (預設只更新傳入的 PDF)")
+    parser.add_argument('--workers', type=int, default=None, help="向量化行程數 (預設讀 config.ini)")
+    parser.add_argument('--batch-size', type=int, default=None, help="每批向量化的 chunk 數")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    os.environ["PINECONE_API_KEY"] = config.get('line-bot', 'PINECONE_API_KEY', fallback='')
+
+    from embedding_engine import BatchEmbeddingEngine
+    from onnx_embeddings import create_embeddings
+    from local_vector_store import open_index, manifest_path_for
+
+    workers = args.workers or config.getint('embedding', 'workers', fallback=0) or None
+    batch_size = args.batch_size or config.getint('embedding', 'batch_size', fallback=64)
+
+    index = open_index(config, INDEX_NAME)
+    manifest_path = args.manifest or manifest_path_for(index, DEFAULT_MANIFEST)
+    if config.get('embedding', 'backend', fallback='torch') == 'onnx':
+        # ONNX Runtime 自己會用多執行緒，不需要另外開 process pool
+        embeddings = create_embeddings(config, EMBEDDING_MODEL_NAME)
+        if args.batch_size:
+            embeddings.batch_size = args.batch_size
+        ingest(args.pdfs, index, embeddings, manifest_path=manifest_path,
+               chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+               dry_run=args.dry_run, prune=args.prune)
+        print(f"⚡ 平均向量化速度: {embeddings.stats()['texts_per_sec']:.1f} chunks/sec")
+    else:
+        with BatchEmbeddingEngine(EMBEDDING_MODEL_NAME, batch_size=batch_size, num_workers=workers) as embeddings:
+            ingest(args.pdfs, index, embeddings, manifest_path=manifest_path,
+                   chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+                   dry_run=args.dry_run, prune=args.prune)
+            print(f"⚡ 平均向量化速度: {embeddings.chunks_per_sec():.1f} chunks/sec")
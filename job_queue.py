@@ -0,0 +1,108 @@
+import os
+import queue
+import threading
+import time
+
+
+# ==========================================
+# 背景工作佇列 (Bounded Worker Pool)
+# ==========================================
+# Webhook 只負責驗證與排程，真正耗時的 RAG 檢索、Gemini 生成與回覆
+# 都交給這裡的 worker 執行，避免 LINE 等太久而觸發重送。
+class JobQueue:
+    def __init__(self, max_workers=4, max_queue_size=100, name="rag"):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._workers = []
+
+        # 統計數據 (給 /metrics 使用)
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.running = 0
+        self.max_wait_seconds = 0.0
+
+        self._start_workers()
+        # gunicorn --preload 之類先 import 再 fork 的部署，子行程不會繼承執行緒，要重新開 worker
+        os.register_at_fork(after_in_child=self._restart_after_fork)
+
+    def _start_workers(self):
+        for i in range(self.max_workers):
+            t = threading.Thread(target=self._worker, name=f"{self.name}-worker-{i}", daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    def _restart_after_fork(self):
+        self._queue = queue.Queue(maxsize=self.max_queue_size)
+        self._lock = threading.Lock()
+        self._workers = []
+        self.running = 0
+        self._start_workers()
+
+    def submit(self, func, *args, **kwargs):
+        """丟一個工作進佇列；佇列滿了就回傳 False (背壓)，由呼叫端決定怎麼回覆用戶。"""
+        try:
+            self._queue.put_nowait((func, args, kwargs, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                break
+
+            func, args, kwargs, enqueued_at = job
+            waited = time.monotonic() - enqueued_at
+            with self._lock:
+                self.running += 1
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            try:
+                func(*args, **kwargs)
+                with self._lock:
+                    self.completed += 1
+            except Exception as e:
+                print(f"❌ 背景工作失敗 ({self.name}): {e}")
+                with self._lock:
+                    self.failed += 1
+            finally:
+                with self._lock:
+                    self.running -= 1
+                self._queue.task_done()
+
+    def depth(self):
+        # 目前排隊中 (尚未被 worker 拿走) 的工作數
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "max_workers": self.max_workers,
+                "max_queue_size": self.max_queue_size,
+                "queue_depth": self._queue.qsize(),
+                "running": self.running,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "max_wait_seconds": round(self.max_wait_seconds, 3),
+            }
+
+    def shutdown(self, wait=True):
+        # 每個 worker 收到一個 None 就會結束
+        for _ in self._workers:
+            self._queue.put(None)
+        if wait:
+            for t in self._workers:
+                t.join()
@@ -0,0 +1,323 @@
+import time
+import json
+import uuid
+import random
+import bisect
+import asyncio
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# ==========================================
+# 共用的 LINE Messaging API Client
+# ==========================================
+# 以前每次 reply / push 都是裸的 requests.post，每則訊息都要重新建立
+# TCP + TLS 連線到 api.line.me。這裡改成共用一個 requests.Session：
+#   - 連線池 + keep-alive，連線可以重複使用
+#   - 連線/讀取 timeout，避免卡死 worker
+#   - 遇到 429 / 5xx / 連線錯誤時，以指數退避 + jitter 重試 (有 Retry-After 就照它等，但最多等 max_retry_after 秒)
+#   - reply 讀取逾時不重試：請求可能已經送達，reply token 只能用一次，重送只會拿到 400
+#   - push 帶 X-Line-Retry-Key，重試時 LINE 不會重複送出
+#   - 每個 API 的延遲分佈 (histogram)，給 /metrics 使用
+#
+# AsyncLineClient 是給 ASGI 版 (app_async.py) 用的 aiohttp 非同步版本，重試規則相同。
+
+LINE_API_BASE = "https://api.line.me"
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# 延遲分佈的桶子 (毫秒)
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# 伺服器給的 Retry-After 最多照著等幾秒，避免一個 header 就把 worker 卡住很久
+MAX_RETRY_AFTER_SECONDS = 30
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最後一格是 +Inf
+        self.count = 0
+        self.sum_ms = 0.0
+        self.errors = 0
+
+    def observe(self, ms, ok=True):
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.sum_ms += ms
+        if not ok:
+            self.errors += 1
+
+    def snapshot(self):
+        labels = [f"le_{b}ms" for b in self.buckets] + ["le_inf"]
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg_ms": round(self.sum_ms / self.count, 1) if self.count else 0,
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+def _body_kwargs(payload):
+    return {"data": payload} if isinstance(payload, bytes) else {"json": payload}
+
+
+def _retry_delay(attempt, retry_after, backoff_base, max_retry_after=MAX_RETRY_AFTER_SECONDS):
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0.0), max_retry_after)
+        except ValueError:
+            pass
+    # Full jitter：0 ~ base * 2^attempt 之間隨機，避免大家同時重試
+    return random.uniform(0, backoff_base * (2 ** attempt))
+
+
+class LineClient:
+    def __init__(self, channel_access_token, pool_connections=4, pool_maxsize=32,
+                 connect_timeout=3.05, read_timeout=10, max_retries=3, backoff_base=0.5,
+                 api_base=LINE_API_BASE, max_retry_after=MAX_RETRY_AFTER_SECONDS):
+        self.api_base = api_base.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_retry_after = max_retry_after
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {channel_access_token}",
+        })
+        # 重試由我們自己控制 (才能加 jitter 和 Retry-After)，adapter 本身不重試
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._histograms = {}
+        self._lock = threading.Lock()
+        # 成功送出訊息後的通知 listener(kind, payload)，例如 quota_service 的本地計數
+        self._send_listeners = []
+
+    def add_send_listener(self, listener):
+        self._send_listeners.append(listener)
+
+    def _notify_sent(self, kind, payload, response):
+        if response.status_code == 200:
+            for listener in self._send_listeners:
+                try:
+                    listener(kind, payload)
+                except Exception as e:
+                    # 訊息已經送出了，統計出錯不影響回傳結果
+                    print(f"⚠️ send listener 失敗: {e}")
+        return response
+
+    # ---- 常用 API ----
+    def reply(self, reply_token, messages):
+        return self.reply_payload({"replyToken": reply_token, "messages": messages})
+
+    def reply_payload(self, payload):
+        # payload 可以是 dict，或已經序列化好的 JSON bytes (見 message_templates.reply_body)
+        response = self.request("POST", "/v2/bot/message/reply", retry_read_timeout=False, **_body_kwargs(payload))
+        return self._notify_sent("reply", payload, response)
+
+    def push(self, to, messages):
+        return self.push_payload({"to": to, "messages": messages})
+
+    def push_payload(self, payload):
+        # 同一個 retry key 重送時，LINE 只會送出一次
+        response = self.request("POST", "/v2/bot/message/push", json=payload,
+                                headers={"X-Line-Retry-Key": str(uuid.uuid4())})
+        return self._notify_sent("push", payload, response)
+
+    def multicast(self, to, messages, retry_key=None):
+        # 一次最多 500 個 userId；重送同一批時帶同一個 retry key，LINE 不會重複送出
+        payload = {"to": to, "messages": messages}
+        response = self.request("POST", "/v2/bot/message/multicast", json=payload,
+                                headers={"X-Line-Retry-Key": retry_key or str(uuid.uuid4())})
+        return self._notify_sent("multicast", payload, response)
+
+    def quota_consumption(self):
+        return self.request("GET", "/v2/bot/message/quota/consumption")
+
+    # ---- 底層請求 ----
+    def request(self, method, path, retry_read_timeout=True, **kwargs):
+        """retry_read_timeout=False：讀取逾時不重試 (請求可能已經被處理，例如只能用一次的 reply token)。"""
+        url = path if path.startswith("http") else self.api_base + path
+        kwargs.setdefault("timeout", self.timeout)
+
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._observe(path, started, ok=False)
+                if attempt >= self.max_retries or (not retry_read_timeout and isinstance(e, requests.ReadTimeout)):
+                    raise
+                print(f"⚠️ LINE API 連線失敗 ({path})，第 {attempt + 1} 次重試: {e}")
+                self._sleep_before_retry(attempt, None)
+                attempt += 1
+                continue
+
+            ok = response.status_code < 400
+            self._observe(path, started, ok=ok)
+            if response.status_code in RETRY_STATUS and attempt < self.max_retries:
+                print(f"⚠️ LINE API 回應 {response.status_code} ({path})，第 {attempt + 1} 次重試")
+                self._sleep_before_retry(attempt, response.headers.get("Retry-After"))
+                attempt += 1
+                continue
+            return response
+
+    def _sleep_before_retry(self, attempt, retry_after):
+        time.sleep(_retry_delay(attempt, retry_after, self.backoff_base, self.max_retry_after))
+
+    def _observe(self, path, started, ok):
+        ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            hist = self._histograms.get(path)
+            if hist is None:
+                hist = self._histograms[path] = LatencyHistogram()
+            hist.observe(ms, ok)
+
+    def stats(self):
+        with self._lock:
+            return {path: h.snapshot() for path, h in self._histograms.items()}
+
+
+class AsyncResponse:
+    # aiohttp 的 response 離開 context 就不能再讀，這裡先把內容讀完，介面比照 requests
+    def __init__(self, status_code, headers, text):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncLineClient:
+    def __init__(self, channel_access_token, pool_maxsize=100, connect_timeout=3.05,
+                 read_timeout=10, max_retries=3, backoff_base=0.5, api_base=LINE_API_BASE,
+                 max_retry_after=MAX_RETRY_AFTER_SECONDS):
+        self.api_base = api_base.rstrip("/")
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_retry_after = max_retry_after
+        self.pool_maxsize = pool_maxsize
+        self.timeout = (connect_timeout, read_timeout)
+        self.headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {channel_access_token}",
+        }
+        # aiohttp.ClientSession 要在 event loop 裡建立，第一次請求時才開
+        self._session = None
+        # 只在 event loop 裡使用，不需要鎖
+        self._histograms = {}
+        self._send_listeners = []
+
+    add_send_listener = LineClient.add_send_listener
+    _notify_sent = LineClient._notify_sent
+
+    def _get_session(self):
+        import aiohttp
+
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=self.pool_maxsize),
+                timeout=aiohttp.ClientTimeout(connect=self.timeout[0], sock_read=self.timeout[1]),
+            )
+        return self._session
+
+    async def reply(self, reply_token, messages):
+        return await self.reply_payload({"replyToken": reply_token, "messages": messages})
+
+    async def reply_payload(self, payload):
+        response = await self.request("POST", "/v2/bot/message/reply", retry_read_timeout=False,
+                                      **_body_kwargs(payload))
+        return self._notify_sent("reply", payload, response)
+
+    async def push(self, to, messages):
+        return await self.push_payload({"to": to, "messages": messages})
+
+    async def push_payload(self, payload):
+        response = await self.request("POST", "/v2/bot/message/push", json=payload,
+                                      headers={"X-Line-Retry-Key": str(uuid.uuid4())})
+        return self._notify_sent("push", payload, response)
+
+    async def quota_consumption(self):
+        return await self.request("GET", "/v2/bot/message/quota/consumption")
+
+    async def request(self, method, path, retry_read_timeout=True, **kwargs):
+        import aiohttp
+
+        url = path if path.startswith("http") else self.api_base + path
+        session = self._get_session()
+
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                async with session.request(method, url, **kwargs) as r:
+                    response = AsyncResponse(r.status, r.headers, await r.text())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self._observe(path, started, ok=False)
+                # 連線逾時代表請求還沒送出，可以重試；其他逾時都當成讀取逾時
+                read_timeout = isinstance(e, asyncio.TimeoutError) \
+                    and not isinstance(e, getattr(aiohttp, "ConnectionTimeoutError", ()))
+                if attempt >= self.max_retries or (not retry_read_timeout and read_timeout):
+                    raise
+                print(f"⚠️ LINE API 連線失敗 ({path})，第 {attempt + 1} 次重試: {e}")
+                await asyncio.sleep(_retry_delay(attempt, None, self.backoff_base, self.max_retry_after))
+                attempt += 1
+                continue
+
+            self._observe(path, started, ok=response.status_code < 400)
+            if response.status_code in RETRY_STATUS and attempt < self.max_retries:
+                print(f"⚠️ LINE API 回應 {response.status_code} ({path})，第 {attempt + 1} 次重試")
+                await asyncio.sleep(_retry_delay(attempt, response.headers.get("Retry-After"),
+                                                 self.backoff_base, self.max_retry_after))
+                attempt += 1
+                continue
+            return response
+
+    def _observe(self, path, started, ok):
+        ms = (time.perf_counter() - started) * 1000
+        hist = self._histograms.get(path)
+        if hist is None:
+            hist = self._histograms[path] = LatencyHistogram()
+        hist.observe(ms, ok)
+
+    def stats(self):
+        return {path: h.snapshot() for path, h in self._histograms.items()}
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+def create_line_client(config):
+    # 依 config.ini 的 [line-client] 區段建立 (沒設定就用預設值)
+    return LineClient(
+        config.get('line-bot', 'channel_access_token'),
+        pool_connections=config.getint('line-client', 'pool_connections', fallback=4),
+        pool_maxsize=config.getint('line-client', 'pool_maxsize', fallback=32),
+        connect_timeout=config.getfloat('line-client', 'connect_timeout', fallback=3.05),
+        read_timeout=config.getfloat('line-client', 'read_timeout', fallback=10),
+        max_retries=config.getint('line-client', 'max_retries', fallback=3),
+        backoff_base=config.getfloat('line-client', 'backoff_base', fallback=0.5),
+        api_base=config.get('line-client', 'api_base', fallback=LINE_API_BASE),
+        max_retry_after=config.getfloat('line-client', 'max_retry_after', fallback=MAX_RETRY_AFTER_SECONDS),
+    )
+
+
+def create_async_line_client(config):
+    # 非同步版：一個 event loop 可能同時有上百個請求，連線池預設開大一點
+    return AsyncLineClient(
+        config.get('line-bot', 'channel_access_token'),
+        pool_maxsize=config.getint('line-client', 'async_pool_maxsize', fallback=100),
+        connect_timeout=config.getfloat('line-client', 'connect_timeout', fallback=3.05),
+        read_timeout=config.getfloat('line-client', 'read_timeout', fallback=10),
+        max_retries=config.getint('line-client', 'max_retries', fallback=3),
+        backoff_base=config.getfloat('line-client', 'backoff_base', fallback=0.5),
+        api_base=config.get('line-client', 'api_base', fallback=LINE_API_BASE),
+        max_retry_after=config.getfloat('line-client', 'max_retry_after', fallback=MAX_RETRY_AFTER_SECONDS),
+    )
@@ -0,0 +1,74 @@
+import json
+
+
+# ==========================================
+# Webhook 事件路由表
+# ==========================================
+# 原本 index() 用一長串 if/elif 比對事件類型、訊息類型與關鍵字，
+# 而且只處理 events[0]。這裡改成一張 dict：
+#   (事件類型, 子類型, 關鍵字/postback action) -> handler
+# 查表是 O(1)，新增指令只要註冊一個 handler，不用改路由本身。
+#
+# 查找順序 (先精確、再退回通用)：
+#   message  : ("message", 訊息類型, 文字)  -> ("message", 訊息類型, None)
+#   postback : ("postback", "params", None)  (日期時間選擇器)
+#              ("postback", None, action)    (data 是 JSON 且有 action)
+#   其他事件 : (事件類型, None, None)        (follow、join...)
+#
+# handler(event) 回傳要 reply 的 messages list；回傳 None / [] 就不回覆。
+# ASGI 版的 handler 可以是 async function，由呼叫端 await。
+
+
+def route_keys(event):
+    event_type = event.get("type")
+    if event_type == "message":
+        message = event["message"]
+        message_type = message.get("type")
+        if message_type == "text":
+            yield ("message", "text", message.get("text"))
+        yield ("message", message_type, None)
+    elif event_type == "postback":
+        postback = event.get("postback", {})
+        if "params" in postback:
+            yield ("postback", "params", None)
+            return
+        try:
+            action = json.loads(postback.get("data", "")).get("action")
+        except (ValueError, AttributeError):
+            action = None
+        if action is not None:
+            yield ("postback", None, action)
+        yield ("postback", None, None)
+    else:
+        yield (event_type, None, None)
+
+
+class EventRouter:
+    def __init__(self):
+        self._routes = {}
+
+    def on(self, event_type, subtype=None, key=None):
+        # 裝飾器：@router.on("message", "text", "主選單")
+        def decorator(func):
+            self.add(event_type, subtype, key, func)
+            return func
+        return decorator
+
+    def add(self, event_type, subtype, key, handler):
+        self._routes[(event_type, subtype, key)] = handler
+
+    def resolve(self, event):
+        for route in route_keys(event):
+            handler = self._routes.get(route)
+            if handler is not None:
+                return handler
+        return None
+
+    def copy(self):
+        # 複製一份路由表，讓 ASGI 版只覆寫需要 await 的指令
+        router = EventRouter()
+        router._routes = dict(self._routes)
+        return router
+
+    def routes(self):
+        return list(self._routes)
@@ -0,0 +1,143 @@
+import re
+import time
+
+
+# ==========================================
+# 串流回覆：先 reply 第一句，後面的段落用 push 補上
+# ==========================================
+# 原本要等 Gemini 整段答案生成完才 reply，用戶要乾等好幾秒。
+# 串流模式一邊接收 LLM 的 token，一邊在句子/段落邊界切塊：
+#   - 第一個完整句子馬上用 replyToken 回覆 (reply 不算推播額度)
+#   - 之後累積到一定長度的段落，用 push API 補送
+#   - 遵守 LINE 限制：每次請求最多 5 則訊息、每則文字最多 5000 字
+#   - push 會消耗每月推播額度，所以每個答案最多 push max_pushes 次，
+#     剩下的內容全部併在最後一次送出
+
+LINE_MAX_MESSAGES_PER_REQUEST = 5
+LINE_MAX_TEXT_LENGTH = 5000
+
+# 句子結尾：中英文標點或換行
+_SENTENCE_END = re.compile(r"[。！？!?；;]|\.(?=\s)|\n")
+
+
+def split_text_messages(text, limit=LINE_MAX_TEXT_LENGTH):
+    # 超過單則上限就切成多則，盡量切在換行處
+    messages = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        messages.append({"type": "text", "text": text[:cut]})
+        text = text[cut:].lstrip("\n")
+    if text.strip():
+        messages.append({"type": "text", "text": text})
+    return messages
+
+
+def _last_boundary(text):
+    # 回傳最後一個句子結尾之後的位置；找不到就回傳 0
+    end = 0
+    for m in _SENTENCE_END.finditer(text):
+        end = m.end()
+    return end
+
+
+class StreamingLineSender:
+    def __init__(self, send_reply, send_push, min_push_chars=200, max_pushes=4):
+        """send_reply(messages) 用 replyToken 回覆；send_push(messages) 推播給同一位用戶。"""
+        self.send_reply = send_reply
+        self.send_push = send_push
+        self.min_push_chars = min_push_chars
+        self.max_pushes = max_pushes
+
+        self._buffer = ""
+        self._parts = []
+        self._replied = False
+        self.pushes = 0
+        self.started_at = time.perf_counter()
+        self.first_message_seconds = None
+
+    def feed(self, text):
+        if not text:
+            return
+        self._buffer += text
+        self._parts.append(text)
+
+        if not self._replied:
+            end = _last_boundary(self._buffer)
+            if end and self._buffer[:end].strip():
+                self._flush_reply(end)
+            return
+
+        # 最後一次 push 要留給 finish()，把剩下的內容一次送完
+        if self.pushes >= self.max_pushes - 1 or len(self._buffer) < self.min_push_chars:
+            return
+        end = self._buffer.rfind("\n\n") + 2
+        if end < self.min_push_chars:
+            end = _last_boundary(self._buffer)
+        if end >= self.min_push_chars:
+            self._flush_push(end, self.max_pushes - 1 - self.pushes)
+
+    def finish(self):
+        """串流結束，把剩下的內容送出，並回傳完整答案 (存進對話紀錄用)。"""
+        if not self._replied:
+            self._flush_reply(len(self._buffer))
+        elif self._buffer.strip():
+            self._flush_push(len(self._buffer), self.max_pushes - self.pushes)
+        return "".join(self._parts)
+
+    def _flush_reply(self, end):
+        text, self._buffer = self._buffer[:end].strip(), self._buffer[end:]
+        messages = split_text_messages(text)[:LINE_MAX_MESSAGES_PER_REQUEST] or [{"type": "text", "text": "..."}]
+        self.send_reply(messages)
+        self._replied = True
+        self.first_message_seconds = time.perf_counter() - self.started_at
+        print(f"⚡ 第一則訊息於 {self.first_message_seconds:.2f} 秒送出")
+
+    def _flush_push(self, end, max_requests):
+        text, self._buffer = self._buffer[:end].strip(), self._buffer[end:]
+        if max_requests <= 0:
+            print(f"⚠️ 已達 push 上限 ({self.max_pushes} 次)，捨棄剩下的 {len(text)} 字")
+            return
+        messages = split_text_messages(text)
+        # 一次 push 最多 5 則；超過就拆成多次請求，但不超過 max_requests 次，
+        # 放不下的部分併進最後一則 (超過單則上限就截斷)
+        limit = max_requests * LINE_MAX_MESSAGES_PER_REQUEST
+        if len(messages) > limit:
+            tail = "\n".join(m["text"] for m in messages[limit - 1:])
+            if len(tail) > LINE_MAX_TEXT_LENGTH:
+                print(f"⚠️ 已達 push 上限 ({self.max_pushes} 次)，截斷 {len(tail) - LINE_MAX_TEXT_LENGTH + 1} 字")
+                tail = tail[:LINE_MAX_TEXT_LENGTH - 1] + "…"
+            messages = messages[:limit - 1] + [{"type": "text", "text": tail}]
+        for start in range(0, len(messages), LINE_MAX_MESSAGES_PER_REQUEST):
+            self.send_push(messages[start:start + LINE_MAX_MESSAGES_PER_REQUEST])
+            self.pushes += 1
+
+
+def stream_rag_answer(qa_chain, llm, prompt, question, chat_history):
+    """ConversationalRetrievalChain 的串流版本：改寫問題 -> 檢索 -> 逐 token 產生答案。
+
+    chain.invoke 只會回傳整段答案，所以這裡照著 chain 的步驟自己跑一次。
+    回傳 (最後使用的問題, 檢索到的文件, 答案文字的 iterator)。"""
+    from langchain_classic.chains.conversational_retrieval.base import _get_chat_history
+
+    if chat_history:
+        get_chat_history = qa_chain.get_chat_history or _get_chat_history
+        question = qa_chain.question_generator.invoke({
+            "question": question,
+            "chat_history": get_chat_history(chat_history),
+        })["text"]
+
+    docs = qa_chain.retriever.invoke(question)
+    # 跟 stuff chain 預設的格式一樣：段落之間空一行
+    context = "\n\n".join(d.page_content for d in docs)
+
+    def tokens():
+        for chunk in llm.stream(prompt.format(context=context, question=question)):
+            content = chunk.content
+            # 部分模型會回傳 content blocks (list)，只取文字
+            if isinstance(content, list):
+                content = "".join(b.get("text", "") if isinstance(b, dict) else str(b) for b in content)
+            yield content
+
+    return question, docs, tokens()
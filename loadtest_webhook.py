@@ -0,0 +1,150 @@
+import sys
+import io
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import statistics
+
+import aiohttp
+
+# ==========================================
+# Webhook 壓測：Flask (app.py) vs ASGI (app_async.py)
+# ==========================================
+# 對 "/" 送出模擬的 LINE 文字訊息事件 (echo 分支，會呼叫一次 reply API)，
+# 固定併發數下量測吞吐量與延遲分佈。
+#
+# 為了不打到真的 LINE，先開一個假的 LINE API (每個請求固定延遲，模擬網路往返)，
+# 再把 config.ini 的 [line-client] api_base 指過去：
+#
+#   [line-client]
+#   api_base = http://127.0.0.1:8081
+#
+#   python loadtest_webhook.py mock --port 8081 --delay 0.2
+#   python app.py                                    # Flask, port 5001
+#   uvicorn app_async:app --port 5002                # ASGI
+#   python loadtest_webhook.py compare --flask http://127.0.0.1:5001/ --asgi http://127.0.0.1:5002/ -c 100 -n 2000
+
+sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+
+def make_event_body(text="壓測訊息"):
+    return {
+        "destination": "loadtest",
+        "events": [{
+            "type": "message",
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "replyToken": uuid.uuid4().hex,
+            "source": {"type": "user", "userId": "Uloadtest"},
+            "webhookEventId": uuid.uuid4().hex,
+            "message": {"type": "text", "id": uuid.uuid4().hex, "text": text},
+        }],
+    }
+
+
+# ---- 假的 LINE API ----
+def make_mock_line_app(delay):
+    async def mock_app(scope, receive, send):
+        if scope["type"] != "http":
+            return
+        more = True
+        while more:
+            more = (await receive()).get("more_body", False)
+        await asyncio.sleep(delay)
+        body = b'{"totalUsage": 0}' if scope["path"].endswith("/quota/consumption") else b"{}"
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
+    return mock_app
+
+
+def run_mock(port, delay):
+    import uvicorn
+    print(f"🧪 假的 LINE API: http://127.0.0.1:{port} (每個請求延遲 {delay}s)")
+    uvicorn.run(make_mock_line_app(delay), port=port, log_level="warning")
+
+
+# ---- 壓測 ----
+async def load_test(url, concurrency, total):
+    latencies = []
+    errors = 0
+    remaining = total
+    # 壓測端也用 aiohttp：httpx 的 async 連線池在高併發時自己就會變成瓶頸
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
+        async def worker():
+            nonlocal remaining, errors
+            while remaining > 0:
+                remaining -= 1
+                started = time.perf_counter()
+                try:
+                    async with session.post(url, data=json.dumps(make_event_body()),
+                                            headers={"Content-Type": "application/json"}) as response:
+                        await response.read()
+                        if response.status != 200:
+                            errors += 1
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": elapsed,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": pct(0.50),
+        "p95_ms": pct(0.95),
+        "p99_ms": pct(0.99),
+        "mean_ms": statistics.mean(latencies) * 1000,
+    }
+
+
+def print_results(results):
+    print(f"\n{'server':<8} {'req':>6} {'err':>5} {'req/s':>8} {'mean(ms)':>9} {'p50(ms)':>8} {'p95(ms)':>8} {'p99(ms)':>8}")
+    for name, r in results.items():
+        print(f"{name:<8} {r['requests']:>6} {r['errors']:>5} {r['rps']:>8.1f} {r['mean_ms']:>9.1f} "
+              f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="LINE webhook 壓測 (Flask vs ASGI)")
+    sub = arg_parser.add_subparsers(dest="command", required=True)
+
+    mock = sub.add_parser("mock", help="啟動假的 LINE API")
+    mock.add_argument("--port", type=int, default=8081)
+    mock.add_argument("--delay", type=float, default=0.2, help="每個請求的模擬延遲 (秒)")
+
+    run = sub.add_parser("run", help="壓測單一伺服器")
+    run.add_argument("--url", default="http://127.0.0.1:5001/")
+    run.add_argument("-c", "--concurrency", type=int, default=50)
+    run.add_argument("-n", "--requests", type=int, default=1000)
+
+    compare = sub.add_parser("compare", help="依序壓測 Flask 與 ASGI 並列出比較")
+    compare.add_argument("--flask", default="http://127.0.0.1:5001/")
+    compare.add_argument("--asgi", default="http://127.0.0.1:5002/")
+    compare.add_argument("-c", "--concurrency", type=int, default=50)
+    compare.add_argument("-n", "--requests", type=int, default=1000)
+
+    args = arg_parser.parse_args()
+    if args.command == "mock":
+        run_mock(args.port, args.delay)
+    elif args.command == "run":
+        print(f"⏱️ 壓測 {args.url} (併發 {args.concurrency}，共 {args.requests} 個請求)...")
+        print_results({"server": asyncio.run(load_test(args.url, args.concurrency, args.requests))})
+    else:
+        results = {}
+        for name, url in (("flask", args.flask), ("asgi", args.asgi)):
+            print(f"⏱️ 壓測 {name}: {url} (併發 {args.concurrency}，共 {args.requests} 個請求)...")
+            results[name] = asyncio.run(load_test(url, args.concurrency, args.requests))
+        print_results(results)
@@ -0,0 +1,537 @@
+import os
+import re
+import sys
+import io
+import json
+import time
+import uuid
+import sqlite3
+import argparse
+import threading
+
+import numpy as np
+
+try:
+    from langchain_core.documents import Document
+    from langchain_core.vectorstores import VectorStore
+except ImportError:  # check_pinecone.py / ingest_pinecone.py 只用 LocalIndex，不需要 langchain
+    Document = None
+    VectorStore = object
+
+# ==========================================
+# 本地向量索引 (取代 Pinecone 的 in-process ANN)
+# ==========================================
+# LineBot_Rag_Pinecone.py 每次查詢都要連到 Pinecone，check_pinecone.py 連看資料都要連線。
+# config.ini 設 [vector-store] backend = local 時改用這裡的本地索引：
+#   - LocalIndex：介面跟 Pinecone 的 Index 一樣 (upsert / delete / query / list / describe_index_stats)，
+#     ingest_pinecone.py 的增量匯入、check_pinecone.py 都不用改寫
+#   - LocalVectorStore：LangChain VectorStore，取代 PineconeVectorStore 給 retriever 用
+#
+# 資料放在 <local_dir>/<index_name>/：
+#   vectors.db          SQLite side table：id、原始向量、metadata (JSON)，寫入都先進這裡
+#   index.json          目前可查詢的版本
+#   vectors-<版本>.npy  依 IVF 分群排好的向量 (float32 或 float16)，查詢時 memory-map，多個 worker 共用 page cache
+#   ivf-<版本>.npz      IVF 的群中心、每群在 vectors 裡的起訖位置、每一列對應的 id
+# upsert / delete 之後呼叫 flush() (ingest() 會自動呼叫) 重建陣列；其他行程查詢時發現版本變了就重新 mmap。
+#
+# IVF：向量數超過 ivf_min_vectors 時用 spherical k-means 分成約 sqrt(N) 群，
+# 查詢只比對最近的 nprobe 群；向量少的時候直接全部比對 (精確結果)。
+# 向量都先 L2 正規化，分數是 cosine 相似度，跟 Pinecone (metric=cosine) 一致。
+#
+# 延遲 / recall 測試：python local_vector_store.py bench --vectors 20000
+
+DEFAULT_LOCAL_DIR = "local_index"
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLES_PER_LIST = 64
+LIST_PAGE_SIZE = 100
+_VERSION_FILE = re.compile(r"^(?:vectors-(\d+)\.npy|ivf-(\d+)\.npz)$")
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.clip(norms, 1e-12, None)
+
+
+def train_ivf(vectors, nlist, iterations=KMEANS_ITERATIONS, seed=0):
+    # spherical k-means：向量與群中心都正規化，用內積 (cosine) 分群
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), nlist * KMEANS_SAMPLES_PER_LIST)
+    sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = np.bincount(assign, minlength=nlist) == 0
+        # 空的群重新挑一個樣本當中心
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids
+
+
+def assign_ivf(vectors, centroids, batch=8192):
+    return np.concatenate([
+        np.argmax(vectors[start:start + batch] @ centroids.T, axis=1)
+        for start in range(0, len(vectors), batch)
+    ]) if len(vectors) else np.zeros(0, dtype=np.int64)
+
+
+class _Snapshot:
+    # 一個可查詢的版本；查詢時整個物件一起換掉，執行緒不會讀到一半新一半舊
+    __slots__ = ("version", "vectors", "centroids", "offsets", "ids")
+
+    def __init__(self, version, vectors, centroids, offsets, ids):
+        self.version = version
+        self.vectors = vectors
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+
+
+class LocalIndex:
+    def __init__(self, path, dimension=384, dtype="float32", nprobe=8, ivf_min_vectors=2048):
+        if dtype not in ("float32", "float16"):
+            raise ValueError(f"不支援的 dtype: {dtype} (可用: float32 / float16)")
+        self.path = path
+        self.dimension = dimension
+        self.dtype = dtype
+        self.nprobe = nprobe
+        self.ivf_min_vectors = ivf_min_vectors
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+        self.queries = 0
+        self.query_seconds = 0.0
+
+        os.makedirs(path, exist_ok=True)
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS vectors (
+                id TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                metadata TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS index_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            INSERT OR IGNORE INTO index_meta (key, value) VALUES ('version', '0');
+        """)
+        self._conn().execute("INSERT OR IGNORE INTO index_meta (key, value) VALUES ('dimension', ?)", (str(dimension),))
+        stored = int(self._conn().execute("SELECT value FROM index_meta WHERE key = 'dimension'").fetchone()[0])
+        if stored != dimension:
+            raise ValueError(f"{path} 的向量維度是 {stored}，不是 {dimension}")
+        # sqlite3 連線不能帶到 fork 出來的子行程
+        os.register_at_fork(after_in_child=self._restart_after_fork)
+
+    def _conn(self):
+        # sqlite3 連線不能跨執行緒共用，每個執行緒各開一條
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.path, "vectors.db"), timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _restart_after_fork(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _data_version(self):
+        return int(self._conn().execute("SELECT value FROM index_meta WHERE key = 'version'").fetchone()[0])
+
+    def _bump_version(self, conn):
+        conn.execute("UPDATE index_meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'version'")
+
+    # ---------- 寫入 (Pinecone Index 相容) ----------
+
+    def upsert(self, vectors):
+        rows = []
+        for item in vectors:
+            if isinstance(item, dict):
+                vid, values, metadata = item["id"], item["values"], item.get("metadata") or {}
+            else:
+                vid, values, metadata = item[0], item[1], (item[2] if len(item) > 2 else {})
+            values = np.asarray(values, dtype=np.float32)
+            if values.shape != (self.dimension,):
+                raise ValueError(f"向量 {vid} 的維度是 {values.shape}，索引是 {self.dimension}")
+            rows.append((vid, values.tobytes(), json.dumps(metadata, ensure_ascii=False)))
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO vectors (id, vector, metadata) VALUES (?, ?, ?)", rows)
+            self._bump_version(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return {"upserted_count": len(rows)}
+
+    def delete(self, ids=None, delete_all=False):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if delete_all:
+                conn.execute("DELETE FROM vectors")
+            else:
+                conn.executemany("DELETE FROM vectors WHERE id = ?", [(i,) for i in ids or []])
+            self._bump_version(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return {}
+
+    def flush(self):
+        """把 SQLite 裡的最新資料重建成 memory-map 用的陣列與 IVF，回傳新的版本號。"""
+        started = time.perf_counter()
+        conn = self._conn()
+        manifest_path = os.path.join(self.path, "index.json")
+        # 在同一個讀取交易裡拿版本號與資料，確保兩者一致；這個版本已經建好就不重建
+        conn.execute("BEGIN")
+        try:
+            version = self._data_version()
+            if self._built_version(manifest_path) == version:
+                return version
+            rows = conn.execute("SELECT id, vector FROM vectors ORDER BY id").fetchall()
+        finally:
+            conn.execute("COMMIT")
+
+        ids = np.array([r[0] for r in rows], dtype=str)
+        vectors = np.frombuffer(b"".join(r[1] for r in rows), dtype=np.float32).reshape(len(rows), self.dimension)
+        vectors = _normalize(vectors)
+        nlist = int(np.sqrt(len(rows))) if len(rows) >= self.ivf_min_vectors else 1
+        if nlist > 1:
+            centroids = train_ivf(vectors, nlist)
+            assign = assign_ivf(vectors, centroids)
+            order = np.argsort(assign, kind="stable")
+            vectors, ids = vectors[order], ids[order]
+            offsets = np.searchsorted(assign[order], np.arange(nlist + 1))
+        else:
+            centroids = np.zeros((0, self.dimension), dtype=np.float32)
+            offsets = np.array([0, len(rows)])
+
+        # 先寫暫存檔再 os.replace；index.json 最後才換，讀取端不會看到寫到一半的檔案
+        suffix = f".tmp{os.getpid()}"
+        vectors_path = os.path.join(self.path, f"vectors-{version}.npy")
+        ivf_path = os.path.join(self.path, f"ivf-{version}.npz")
+        # 同一個版本的內容都一樣；別的行程已經寫好 (而且可能正在 mmap) 就不再覆蓋
+        if not (os.path.exists(vectors_path) and os.path.exists(ivf_path)):
+            with open(vectors_path + suffix, "wb") as f:
+                np.save(f, vectors.astype(self.dtype))
+            with open(ivf_path + suffix, "wb") as f:
+                np.savez(f, centroids=centroids, offsets=offsets, ids=ids)
+            os.replace(vectors_path + suffix, vectors_path)
+            os.replace(ivf_path + suffix, ivf_path)
+        with open(manifest_path + suffix, "w", encoding="utf-8") as f:
+            json.dump({"version": version, "count": len(rows), "nlist": nlist, "dtype": self.dtype,
+                       "dimension": self.dimension}, f)
+        # 同時有兩個 flush 時，比較慢的那個不能把 index.json 換回舊版本
+        built = self._built_version(manifest_path)
+        if built is not None and built > version:
+            os.remove(manifest_path + suffix)
+        else:
+            os.replace(manifest_path + suffix, manifest_path)
+
+        self._remove_old_versions(version)
+        print(f"🗂️ 本地索引已重建: {len(rows)} 筆、{nlist} 群 ({time.perf_counter() - started:.2f} 秒)")
+        return version
+
+    def _remove_old_versions(self, version):
+        # 只刪比這次寫入更舊的版本 (另一個 flush 可能剛寫好更新的版本)。
+        # Windows 上還被 mmap 的檔案刪不掉 (PermissionError)，先留著，之後的 flush 再清
+        for name in os.listdir(self.path):
+            m = _VERSION_FILE.match(name)
+            if m is None or int(m.group(1) or m.group(2)) >= version:
+                continue
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def _built_version(self, manifest_path):
+        try:
+            with open(manifest_path, encoding="utf-8") as f:
+                return json.load(f)["version"]
+        except (FileNotFoundError, KeyError, ValueError):
+            return None
+
+    # ---------- 查詢 ----------
+
+    def _load_snapshot(self):
+        with open(os.path.join(self.path, "index.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+        version = manifest["version"]
+        vectors = np.load(os.path.join(self.path, f"vectors-{version}.npy"), mmap_mode="r")
+        with np.load(os.path.join(self.path, f"ivf-{version}.npz")) as ivf:
+            return _Snapshot(version, vectors, ivf["centroids"], ivf["offsets"], ivf["ids"])
+
+    def _current(self):
+        # 資料版本比手上的新 (其他行程匯入過) 就重新 mmap；還沒有人 flush 過這個版本就自己重建
+        version = self._data_version()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version >= version:
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.version >= version:
+                return snapshot
+            try:
+                snapshot = self._load_snapshot()
+            except (FileNotFoundError, KeyError, ValueError):
+                snapshot = None
+            if snapshot is None or snapshot.version < version:
+                self.flush()
+                snapshot = self._load_snapshot()
+            self._snapshot = snapshot
+            return snapshot
+
+    def _search(self, snapshot, query, top_k):
+        if len(snapshot.centroids) > 1:
+            # 只掃最近的 nprobe 群；每一群在 vectors 裡是連續的一段
+            nprobe = min(self.nprobe, len(snapshot.centroids))
+            probe = np.argpartition(-(snapshot.centroids @ query), nprobe - 1)[:nprobe]
+            rows = np.concatenate([np.arange(snapshot.offsets[c], snapshot.offsets[c + 1]) for c in probe])
+            candidates = snapshot.vectors[rows]
+        else:
+            rows = None
+            candidates = snapshot.vectors
+        scores = candidates.astype(np.float32, copy=False) @ query
+        top_k = min(top_k, len(scores))
+        if top_k == 0:
+            return [], []
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        found = best if rows is None else rows[best]
+        return snapshot.ids[found].tolist(), scores[best].tolist()
+
+    def query(self, vector, top_k=10, include_metadata=False, include_values=False, **kwargs):
+        if kwargs.get("filter"):
+            raise ValueError("本地索引不支援 metadata filter")
+        started = time.perf_counter()
+        query = _normalize(vector)
+        ids, scores = self._search(self._current(), query, top_k)
+
+        extra = {}
+        if ids and (include_metadata or include_values):
+            placeholders = ",".join("?" * len(ids))
+            rows = self._conn().execute(
+                f"SELECT id, vector, metadata FROM vectors WHERE id IN ({placeholders})", ids).fetchall()
+            extra = {r[0]: r for r in rows}
+
+        matches = []
+        for vid, score in zip(ids, scores):
+            match = {"id": vid, "score": score}
+            row = extra.get(vid)
+            if include_metadata:
+                match["metadata"] = json.loads(row[2]) if row else {}
+            if include_values:
+                match["values"] = np.frombuffer(row[1], dtype=np.float32).tolist() if row else []
+            matches.append(match)
+
+        with self._lock:
+            self.queries += 1
+            self.query_seconds += time.perf_counter() - started
+        return {"matches": matches, "namespace": ""}
+
+    def list(self):
+        # 跟 Pinecone 的 index.list() 一樣，一次 yield 一頁 ID
+        last = ""
+        while True:
+            page = [r[0] for r in self._conn().execute(
+                "SELECT id FROM vectors WHERE id > ? ORDER BY id LIMIT ?", (last, LIST_PAGE_SIZE))]
+            if not page:
+                return
+            yield page
+            last = page[-1]
+
+    def describe_index_stats(self):
+        count = self._conn().execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+        return {
+            "dimension": self.dimension,
+            "total_vector_count": count,
+            "namespaces": {"": {"vector_count": count}},
+        }
+
+    def stats(self):
+        snapshot = self._snapshot
+        with self._lock:
+            return {
+                "backend": "local",
+                "version": snapshot.version if snapshot else None,
+                "vectors": len(snapshot.ids) if snapshot else 0,
+                "ivf_lists": max(1, len(snapshot.centroids)) if snapshot else 0,
+                "queries": self.queries,
+                "avg_query_ms": round(self.query_seconds / self.queries * 1000, 3) if self.queries else 0.0,
+            }
+
+
+class LocalVectorStore(VectorStore):
+    """LangChain VectorStore，介面跟 PineconeVectorStore 一樣 (原文放在 metadata['text'])。"""
+
+    def __init__(self, index, embedding, text_key="text"):
+        self.index = index
+        self._embedding = embedding
+        self.text_key = text_key
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        ids = list(ids) if ids else [uuid.uuid4().hex for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = self._embedding.embed_documents(texts)
+        self.index.upsert(vectors=[
+            {"id": vid, "values": vec, "metadata": dict(meta, **{self.text_key: text})}
+            for vid, vec, meta, text in zip(ids, vectors, metadatas, texts)
+        ])
+        self.index.flush()
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        self.index.delete(ids=ids, delete_all=kwargs.get("delete_all", False))
+        self.index.flush()
+        return True
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, **kwargs):
+        results = self.index.query(vector=embedding, top_k=k, include_metadata=True, **kwargs)
+        documents = []
+        for match in results["matches"]:
+            metadata = dict(match["metadata"])
+            text = metadata.pop(self.text_key, "")
+            documents.append((Document(page_content=text, metadata=metadata, id=match["id"]), match["score"]))
+        return documents
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k, **kwargs)
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, **kwargs)]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        # cosine 相似度 [-1, 1] 換成 [0, 1]，跟 PineconeVectorStore 相同
+        return lambda score: (score + 1) / 2
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, path=None, **kwargs):
+        texts = list(texts)
+        dimension = len(embedding.embed_query(texts[0])) if texts else 384
+        store = cls(LocalIndex(path or os.path.join(DEFAULT_LOCAL_DIR, "default"), dimension=dimension), embedding)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+
+# ==========================================
+# 依 config.ini 選擇 Pinecone 或本地索引
+# ==========================================
+
+def vector_store_backend(config):
+    return config.get('vector-store', 'backend', fallback='pinecone')
+
+
+def open_index(config, index_name, create=True):
+    # 回傳 Pinecone 的 Index 或 LocalIndex；兩者介面相同，ingest() 與 check_pinecone.py 都能直接用
+    backend = vector_store_backend(config)
+    if backend == 'local':
+        return LocalIndex(
+            os.path.join(config.get('vector-store', 'local_dir', fallback=DEFAULT_LOCAL_DIR), index_name),
+            dimension=config.getint('vector-store', 'dimension', fallback=384),
+            dtype=config.get('vector-store', 'dtype', fallback='float32'),
+            nprobe=config.getint('vector-store', 'nprobe', fallback=8),
+            ivf_min_vectors=config.getint('vector-store', 'ivf_min_vectors', fallback=2048),
+        )
+    if backend == 'pinecone':
+        from pinecone import Pinecone
+        pc = Pinecone(api_key=config.get('line-bot', 'PINECONE_API_KEY'))
+        if create:
+            from ingest_pinecone import ensure_index
+            return ensure_index(pc, index_name)
+        return pc.Index(index_name)
+    raise ValueError(f"不支援的 vector-store backend: {backend} (可用: pinecone / local)")
+
+
+def create_vector_store(config, index, index_name, embeddings):
+    if vector_store_backend(config) == 'local':
+        return LocalVectorStore(index, embeddings)
+    from langchain_pinecone import PineconeVectorStore
+    return PineconeVectorStore.from_existing_index(index_name, embeddings)
+
+
+def manifest_path_for(index, default):
+    # 本地索引的增量匯入 manifest 跟著索引目錄走，不會跟 Pinecone 的 manifest 混在一起
+    return os.path.join(index.path, "manifest.json") if isinstance(index, LocalIndex) else default
+
+
+# ==========================================
+# 延遲 / recall 測試 (隨機分群資料，不需要模型或網路)
+# ==========================================
+
+def _clustered_vectors(count, centers, noise, rng):
+    # 文件向量會聚成一群一群的主題；noise 越大，群與群之間越分不開
+    labels = rng.integers(0, len(centers), count)
+    dimension = centers.shape[1]
+    return _normalize(centers[labels] + noise * rng.standard_normal((count, dimension)) / np.sqrt(dimension))
+
+
+def run_bench(args):
+    import shutil
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    centers = _normalize(rng.standard_normal((max(8, args.vectors // 200), args.dim)))
+    data = _clustered_vectors(args.vectors, centers, args.noise, rng)
+    queries = _clustered_vectors(args.queries, centers, args.noise, rng)
+    truth = np.argsort(-(queries @ data.T), axis=1)[:, :args.k]
+    ids = [f"v{i:08d}" for i in range(args.vectors)]
+
+    root = tempfile.mkdtemp(prefix="local-index-")
+    try:
+        for label, ivf_min in (("flat", args.vectors + 1), ("ivf", 1)):
+            index = LocalIndex(os.path.join(root, label), dimension=args.dim, dtype=args.dtype,
+                               nprobe=args.nprobe, ivf_min_vectors=ivf_min)
+            for start in range(0, args.vectors, 1000):
+                index.upsert(vectors=[{"id": ids[i], "values": data[i], "metadata": {"text": f"chunk {i}"}}
+                                      for i in range(start, min(start + 1000, args.vectors))])
+            index.flush()
+            index.query(queries[0], top_k=args.k)  # 暖機：第一次 mmap
+
+            latencies, recalls = [], []
+            for q, expected in zip(queries, truth):
+                started = time.perf_counter()
+                result = index.query(q, top_k=args.k, include_metadata=True)
+                latencies.append((time.perf_counter() - started) * 1000)
+                found = {int(m["id"][1:]) for m in result["matches"]}
+                recalls.append(len(found & set(expected.tolist())) / args.k)
+            latencies.sort()
+            stats = index.stats()
+            print(f"{label:<5} {args.dtype:<8} 群數 {stats['ivf_lists']:>4}  "
+                  f"p50 {latencies[len(latencies) // 2]:.3f} ms  p95 {latencies[int(len(latencies) * 0.95)]:.3f} ms  "
+                  f"recall@{args.k} {np.mean(recalls):.3f}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+    arg_parser = argparse.ArgumentParser(description="本地向量索引工具")
+    sub = arg_parser.add_subparsers(dest="command", required=True)
+    bench = sub.add_parser("bench", help="flat vs IVF 的查詢延遲與 recall")
+    bench.add_argument("--vectors", type=int, default=20000)
+    bench.add_argument("--queries", type=int, default=200)
+    bench.add_argument("--dim", type=int, default=384)
+    bench.add_argument("-k", type=int, default=5)
+    bench.add_argument("--nprobe", type=int, default=8)
+    bench.add_argument("--noise", type=float, default=1.0, help="群內的離散程度 (越大越難)")
+    bench.add_argument("--dtype", default="float32", choices=["float32", "float16"])
+    args = arg_parser.parse_args()
+
+    if args.command == "bench":
+        run_bench(args)
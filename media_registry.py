@@ -0,0 +1,242 @@
+import os
+import time
+import struct
+import mimetypes
+import threading
+
+
+# ==========================================
+# static/ 素材的中繼資料登記表
+# ==========================================
+# 以前 getMRTSoundMessage() 每次都 import audioread 並整個解碼 mrt_sound.m4a，
+# 只為了拿到音訊長度。這裡在啟動時掃描一次 static/，記下每個檔案的：
+#   content_type、類型 (image/audio/video)、大小、mtime、
+#   音訊/影片長度 (毫秒)、圖片寬高、對外 URL、預覽圖 URL
+# 之後訊息建構只讀記憶體；背景執行緒定期檢查 mtime，只有變動的檔案才重新讀取。
+
+# mimetypes 在各平台對這些副檔名的判斷不一致，這裡固定下來
+CONTENT_TYPES = {
+    ".m4a": "audio/mp4",
+    ".mp3": "audio/mpeg",
+    ".mp4": "video/mp4",
+    ".jpeg": "image/jpeg",
+    ".jpg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+}
+PREVIEW_EXTENSIONS = (".jpeg", ".jpg", ".png")
+MP4_EXTENSIONS = (".m4a", ".mp4", ".mov")
+# 往下找 mvhd / tkhd 時會經過的容器 box
+MP4_CONTAINERS = (b"moov", b"trak")
+
+
+def guess_content_type(path):
+    ext = os.path.splitext(path)[1].lower()
+    return CONTENT_TYPES.get(ext) or mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def _iter_mp4_boxes(f, end):
+    while f.tell() + 8 <= end:
+        start = f.tell()
+        size, box_type = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            return
+        yield box_type, start + header, start + size
+        f.seek(start + size)
+
+
+def probe_mp4(path):
+    # m4a / mp4 只要讀 moov 裡的 mvhd (長度) 與 tkhd (畫面寬高)，不需要解碼
+    duration_ms, width, height = None, None, None
+    with open(path, "rb") as f:
+        stack = [(0, os.fstat(f.fileno()).st_size)]
+        while stack:
+            begin, end = stack.pop()
+            f.seek(begin)
+            for box_type, body, box_end in list(_iter_mp4_boxes(f, end)):
+                if box_type in MP4_CONTAINERS:
+                    stack.append((body, box_end))
+                elif box_type == b"mvhd":
+                    f.seek(body)
+                    version = f.read(1)[0]
+                    if version == 1:
+                        f.seek(body + 20)
+                        timescale, duration = struct.unpack(">IQ", f.read(12))
+                    else:
+                        f.seek(body + 12)
+                        timescale, duration = struct.unpack(">II", f.read(8))
+                    if timescale:
+                        duration_ms = int(round(duration * 1000 / timescale))
+                elif box_type == b"tkhd":
+                    # 寬高是 16.16 定點數，放在 tkhd 的最後 8 bytes；音軌是 0
+                    f.seek(box_end - 8)
+                    w, h = struct.unpack(">II", f.read(8))
+                    if w and h:
+                        width, height = w >> 16, h >> 16
+    return duration_ms, width, height
+
+
+def probe_duration_ms(path):
+    # 其他格式交給 audioread，需要系統上的解碼器 (ffmpeg / gstreamer...)，讀不到就回傳 None
+    try:
+        import audioread
+        with audioread.audio_open(path) as f:
+            return int(round(f.duration * 1000))
+    except Exception as e:
+        print(f"⚠️ 無法讀取 {path} 的長度: {e}")
+        return None
+
+
+def probe_image_size(path):
+    # 只讀檔頭就能拿到寬高，不需要整張解碼
+    with open(path, "rb") as f:
+        head = f.read(26)
+        if head[:8] == b"\x89PNG\r\n\x1a\n":
+            return struct.unpack(">II", head[16:24])
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", head[6:10])
+        if head[:2] == b"\xff\xd8":
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                length = struct.unpack(">H", f.read(2))[0]
+                # SOF0 ~ SOF15 (排除 DHT / JPG / DAC) 裡面有高、寬
+                if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">xHH", f.read(5))
+                    return width, height
+                f.seek(length - 2, os.SEEK_CUR)
+    return None
+
+
+class MediaRegistry:
+    def __init__(self, root="static", base_url="", url_prefix="/static"):
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+        self.url_prefix = url_prefix
+        self._entries = {}  # 相對路徑 -> 中繼資料 dict
+        self._lock = threading.Lock()
+        self.scans = 0
+        self.probes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def url(self, relative_path):
+        return f"{self.base_url}{self.url_prefix}/{relative_path}"
+
+    def get(self, relative_path):
+        info = self._entries.get(relative_path)
+        if info is None:
+            raise KeyError(f"static/ 裡找不到 {relative_path}，請確認檔案存在")
+        return info
+
+    def scan(self):
+        # 只有新增或 mtime/大小變了的檔案才重新讀取中繼資料
+        old = self._entries
+        entries = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                # 略過 .DS_Store 之類的隱藏檔
+                if filename.startswith("."):
+                    continue
+                path = os.path.join(dirpath, filename)
+                relative = os.path.relpath(path, self.root).replace(os.sep, "/")
+                st = os.stat(path)
+                previous = old.get(relative)
+                if previous and previous["mtime"] == st.st_mtime and previous["size"] == st.st_size:
+                    entries[relative] = previous
+                else:
+                    entries[relative] = self._probe(path, relative, st)
+
+        for relative, info in entries.items():
+            info["preview_url"] = self._preview_url(relative, info, entries)
+
+        with self._lock:
+            self._entries = entries
+            self.scans += 1
+        return entries
+
+    def _probe(self, path, relative, st):
+        self.probes += 1
+        content_type = guess_content_type(path)
+        kind = content_type.split("/")[0]
+        info = {
+            "path": relative,
+            "url": self.url(relative),
+            "content_type": content_type,
+            "kind": kind,
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "duration_ms": None,
+            "width": None,
+            "height": None,
+            "preview_url": None,
+        }
+        if os.path.splitext(path)[1].lower() in MP4_EXTENSIONS:
+            try:
+                info["duration_ms"], info["width"], info["height"] = probe_mp4(path)
+            except (OSError, struct.error) as e:
+                print(f"⚠️ 無法解析 {path}: {e}")
+        if kind in ("audio", "video") and info["duration_ms"] is None:
+            info["duration_ms"] = probe_duration_ms(path)
+        elif kind == "image":
+            try:
+                size = probe_image_size(path)
+            except (OSError, struct.error) as e:
+                print(f"⚠️ 無法解析 {path}: {e}")
+                size = None
+            if size:
+                info["width"], info["height"] = size
+        return info
+
+    def _preview_url(self, relative, info, entries):
+        # 圖片用自己當預覽；影音找同名的圖片 (例如 clip.mp4 -> clip.jpeg)
+        if info["kind"] == "image":
+            return info["url"]
+        stem = os.path.splitext(relative)[0]
+        for ext in PREVIEW_EXTENSIONS:
+            if stem + ext in entries:
+                return entries[stem + ext]["url"]
+        return None
+
+    def start_watcher(self, interval_seconds):
+        # 背景定期檢查 mtime；interval <= 0 表示只在啟動時掃描一次
+        if interval_seconds <= 0 or self._thread is not None:
+            return
+
+        def loop():
+            while not self._stop.wait(interval_seconds):
+                try:
+                    self.scan()
+                except Exception as e:
+                    print(f"⚠️ 重新掃描 {self.root} 失敗: {e}")
+
+        self._thread = threading.Thread(target=loop, name="media-registry", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            return {"files": len(self._entries), "scans": self.scans, "probes": self.probes}
+
+
+def create_media_registry(config, base_url):
+    # 依 config.ini 的 [media] 區段建立，啟動時先掃描一次
+    registry = MediaRegistry(
+        root=config.get('media', 'root', fallback='static'),
+        base_url=base_url,
+    )
+    started = time.perf_counter()
+    registry.scan()
+    print(f"🎞️ 已登記 {registry.stats()['files']} 個素材 ({time.perf_counter() - started:.2f} 秒)")
+    registry.start_watcher(config.getint('media', 'rescan_seconds', fallback=60))
+    return registry
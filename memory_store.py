@@ -0,0 +1,291 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+
+
+# ==========================================
+# 對話記憶儲存區 (取代 user_histories = {})
+# ==========================================
+# 原本的 dict 每個出現過的 user_id 都留一筆，永遠不會清掉；
+# 而且只存在單一行程裡，開多個 gunicorn worker 時記憶會被拆散。
+#
+# 兩種後端，介面相同 (get / append / clear / stats)：
+#   InMemoryHistoryStore : 單一行程，LRU + 閒置 TTL + 全域字數上限
+#   SQLiteHistoryStore   : 本機 SQLite 檔案，多個 worker 共用同一份記憶
+#
+# 全域上限用「所有對話的總字數」估算記憶體用量，超過就從最久沒說話的用戶開始清。
+
+SWEEP_EVERY_N_WRITES = 100
+
+
+def _turn_chars(question, answer):
+    return len(question) + len(answer)
+
+
+class InMemoryHistoryStore:
+    def __init__(self, max_turns=5, idle_ttl_seconds=3600, max_total_chars=5_000_000):
+        self.max_turns = max_turns
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_total_chars = max_total_chars
+
+        self._users = OrderedDict()  # user_id -> [最後存取時間, deque(對話), 字數]
+        self._total_chars = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        self.evicted_idle = 0
+        self.evicted_memory = 0
+
+    def get(self, user_id):
+        now = time.time()
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return []
+            if now - entry[0] > self.idle_ttl_seconds:
+                self._drop(user_id)
+                self.evicted_idle += 1
+                return []
+            entry[0] = now
+            self._users.move_to_end(user_id)
+            return list(entry[1])
+
+    def append(self, user_id, question, answer):
+        now = time.time()
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = [now, deque(), 0]
+                self._users[user_id] = entry
+            entry[0] = now
+            self._users.move_to_end(user_id)
+
+            entry[1].append((question, answer))
+            added = _turn_chars(question, answer)
+            entry[2] += added
+            self._total_chars += added
+            # 超過每人對話上限，丟掉最舊的一輪 (deque.popleft 是 O(1))
+            while len(entry[1]) > self.max_turns:
+                old_q, old_a = entry[1].popleft()
+                entry[2] -= _turn_chars(old_q, old_a)
+                self._total_chars -= _turn_chars(old_q, old_a)
+
+            self._writes += 1
+            if self._writes % SWEEP_EVERY_N_WRITES == 0:
+                self._sweep_idle(now)
+            self._enforce_ceiling(keep=user_id)
+
+    def clear(self, user_id):
+        with self._lock:
+            self._drop(user_id)
+
+    def _drop(self, user_id):
+        entry = self._users.pop(user_id, None)
+        if entry is not None:
+            self._total_chars -= entry[2]
+
+    def _sweep_idle(self, now):
+        # OrderedDict 由舊到新排列，遇到第一個沒過期的就可以停
+        while self._users:
+            user_id, entry = next(iter(self._users.items()))
+            if now - entry[0] <= self.idle_ttl_seconds:
+                break
+            self._drop(user_id)
+            self.evicted_idle += 1
+
+    def _enforce_ceiling(self, keep):
+        while self._total_chars > self.max_total_chars and len(self._users) > 1:
+            user_id = next(iter(self._users))
+            if user_id == keep:
+                break
+            self._drop(user_id)
+            self.evicted_memory += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "memory",
+                "users": len(self._users),
+                "total_chars": self._total_chars,
+                "max_total_chars": self.max_total_chars,
+                "evicted_idle": self.evicted_idle,
+                "evicted_memory": self.evicted_memory,
+            }
+
+
+class SQLiteHistoryStore:
+    def __init__(self, path="chat_history.db", max_turns=5, idle_ttl_seconds=3600, max_total_chars=50_000_000):
+        self.path = path
+        self.max_turns = max_turns
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_total_chars = max_total_chars
+        self._local = threading.local()
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._restart_after_fork)
+
+        self.evicted_idle = 0
+        self.evicted_memory = 0
+
+        conn = self._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS turns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                chars INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_turns_user ON turns (user_id, id);
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_users_access ON users (last_access);
+        """)
+
+    def _conn(self):
+        # sqlite3 連線不能跨執行緒共用，每個 worker thread 各開一條
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            # WAL 讓多個行程可以同時讀，寫入也不會卡住讀取
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _restart_after_fork(self):
+        # gunicorn preload 時 store 在 master 建立；sqlite3 連線不能帶到 fork 出來的 worker，子行程重新開連線
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute("SELECT last_access FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return []
+        if now - row[0] > self.idle_ttl_seconds:
+            self.clear(user_id)
+            self.evicted_idle += 1
+            return []
+        conn.execute("UPDATE users SET last_access = ? WHERE user_id = ?", (now, user_id))
+        rows = conn.execute(
+            "SELECT question, answer FROM turns WHERE user_id = ? ORDER BY id", (user_id,)
+        ).fetchall()
+        return [tuple(r) for r in rows]
+
+    def append(self, user_id, question, answer):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO turns (user_id, question, answer, chars, created_at) VALUES (?, ?, ?, ?, ?)",
+                (user_id, question, answer, _turn_chars(question, answer), now),
+            )
+            conn.execute(
+                "INSERT INTO users (user_id, last_access) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET last_access = excluded.last_access",
+                (user_id, now),
+            )
+            # 只保留最近 max_turns 輪
+            conn.execute(
+                "DELETE FROM turns WHERE user_id = ? AND id NOT IN "
+                "(SELECT id FROM turns WHERE user_id = ? ORDER BY id DESC LIMIT ?)",
+                (user_id, user_id, self.max_turns),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        with self._lock:
+            self._writes += 1
+            sweep = self._writes % SWEEP_EVERY_N_WRITES == 0
+        if sweep:
+            self._sweep(now, keep=user_id)
+
+    def clear(self, user_id):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM turns WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _sweep(self, now, keep):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            expired = conn.execute(
+                "SELECT user_id FROM users WHERE last_access < ?", (now - self.idle_ttl_seconds,)
+            ).fetchall()
+            for (user_id,) in expired:
+                conn.execute("DELETE FROM turns WHERE user_id = ?", (user_id,))
+                conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            self.evicted_idle += len(expired)
+
+            # 全域上限：從最久沒說話的用戶開始清
+            total = conn.execute("SELECT COALESCE(SUM(chars), 0) FROM turns").fetchone()[0]
+            if total > self.max_total_chars:
+                for user_id, chars in conn.execute(
+                    "SELECT u.user_id, COALESCE(SUM(t.chars), 0) FROM users u "
+                    "LEFT JOIN turns t ON t.user_id = u.user_id "
+                    "GROUP BY u.user_id ORDER BY u.last_access"
+                ).fetchall():
+                    if total <= self.max_total_chars:
+                        break
+                    if user_id == keep:
+                        continue
+                    conn.execute("DELETE FROM turns WHERE user_id = ?", (user_id,))
+                    conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+                    total -= chars
+                    self.evicted_memory += 1
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def stats(self):
+        conn = self._conn()
+        users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        total = conn.execute("SELECT COALESCE(SUM(chars), 0) FROM turns").fetchone()[0]
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "users": users,
+            "total_chars": total,
+            "max_total_chars": self.max_total_chars,
+            "evicted_idle": self.evicted_idle,
+            "evicted_memory": self.evicted_memory,
+        }
+
+
+def create_history_store(config):
+    # 依 config.ini 的 [conversation] 區段建立對應的後端
+    backend = config.get('conversation', 'memory_backend', fallback='memory')
+    max_turns = config.getint('conversation', 'max_turns', fallback=5)
+    idle_ttl = config.getint('conversation', 'idle_ttl_seconds', fallback=3600)
+
+    if backend == 'sqlite':
+        return SQLiteHistoryStore(
+            path=config.get('conversation', 'sqlite_path', fallback='chat_history.db'),
+            max_turns=max_turns,
+            idle_ttl_seconds=idle_ttl,
+            max_total_chars=config.getint('conversation', 'max_total_chars', fallback=50_000_000),
+        )
+    if backend == 'memory':
+        return InMemoryHistoryStore(
+            max_turns=max_turns,
+            idle_ttl_seconds=idle_ttl,
+            max_total_chars=config.getint('conversation', 'max_total_chars', fallback=5_000_000),
+        )
+    raise ValueError(f"不支援的 memory_backend: {backend} (可用: memory / sqlite)")
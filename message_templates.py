@@ -0,0 +1,51 @@
+import re
+import json
+
+
+# ==========================================
+# 預先序列化的 LINE 訊息
+# ==========================================
+# app.py 的 getXxxMessage() 以前每次請求都重建同樣的 dict，回覆時再整包 json 編碼。
+# 這裡讓訊息在啟動時就編成 JSON bytes：
+#   - 靜態訊息 (貼圖、Emoji 名字、台北 101...)：to_json_bytes() 一次，之後直接重用
+#   - 有參數的模板 (輪播、確認、叫車)：MessageTemplate 先把固定的部分編好，
+#     每次只把 slot 的位置填進去
+#   - reply_body() 把多則訊息拼成 reply API 的 request body，不用再建 payload dict
+#
+# 訊息可以是 bytes (已序列化) 或 dict (動態內容，例如查詢結果)，兩者可以混用。
+
+_SLOT_MARK = "@@slot:{}@@"
+_SLOT_PATTERN = re.compile(rb'"@@slot:(\w+)@@"')
+
+
+def to_json_bytes(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def encode_message(message):
+    return message if isinstance(message, bytes) else to_json_bytes(message)
+
+
+def reply_body(reply_token, messages):
+    return (b'{"replyToken":' + to_json_bytes(reply_token)
+            + b',"messages":[' + b",".join(encode_message(m) for m in messages) + b"]}")
+
+
+def slot(name):
+    # 模板中要替換的欄位；必須是完整的 JSON 值，不能嵌在其他字串裡
+    return _SLOT_MARK.format(name)
+
+
+class MessageTemplate:
+    def __init__(self, message):
+        # 切成 [固定片段, 欄位名稱, 固定片段, 欄位名稱, ..., 固定片段]
+        parts = _SLOT_PATTERN.split(to_json_bytes(message))
+        self._literals = parts[0::2]
+        self._slots = [name.decode() for name in parts[1::2]]
+
+    def render(self, **values):
+        out = [self._literals[0]]
+        for name, literal in zip(self._slots, self._literals[1:]):
+            out.append(to_json_bytes(values[name]))
+            out.append(literal)
+        return b"".join(out)
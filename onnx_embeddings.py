@@ -0,0 +1,251 @@
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import threading
+
+import numpy as np
+
+# ==========================================
+# ONNX (int8 量化) 向量化後端
+# ==========================================
+# 查詢與匯入的向量都經過 PyTorch 版的 all-MiniLM-L6-v2 (HuggingFaceEmbeddings)，
+# 在只有 CPU 的主機上，這是每次檢索最花時間的一步，也是匯入文件最慢的地方。
+# 這裡把同一個模型匯出成 ONNX 並做 int8 動態量化，執行時只需要 onnxruntime + tokenizers：
+#   - 不用 import torch，啟動快、記憶體小
+#   - 跟 sentence-transformers 一樣做 mean pooling + L2 正規化，輸出 384 維，
+#     可以直接查詢用 PyTorch 版建好的 Chroma / Pinecone 索引 (dimension=384)
+#
+# 匯出 (需要 torch + transformers，只要做一次)：
+#   python onnx_embeddings.py export --out onnx_models/all-MiniLM-L6-v2
+# config.ini:
+#   [embedding]
+#   backend = onnx
+# 延遲、吞吐量、recall@k 比較：python bench_embeddings.py
+
+DEFAULT_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+DEFAULT_ONNX_DIR = "onnx_models/all-MiniLM-L6-v2"
+FP32_FILENAME = "model.onnx"
+INT8_FILENAME = "model_int8.onnx"
+META_FILENAME = "onnx_meta.json"
+INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+
+
+def _sentence_transformers_settings(model_name):
+    # 從 sentence-transformers 的設定讀出 max_seq_length 與是否正規化；讀不到就用 MiniLM 的預設值
+    max_seq_length, normalize = 256, True
+    try:
+        from huggingface_hub import hf_hub_download
+        local = os.path.isdir(model_name)
+
+        def fetch(filename):
+            return os.path.join(model_name, filename) if local else hf_hub_download(model_name, filename)
+
+        with open(fetch("sentence_bert_config.json")) as f:
+            max_seq_length = json.load(f).get("max_seq_length", max_seq_length)
+        with open(fetch("modules.json")) as f:
+            normalize = any(m.get("type", "").endswith("Normalize") for m in json.load(f))
+    except Exception as e:
+        print(f"⚠️ 讀不到 sentence-transformers 設定，使用預設值: {e}")
+    return max_seq_length, normalize
+
+
+def export_onnx(model_name=DEFAULT_MODEL_NAME, output_dir=DEFAULT_ONNX_DIR, quantize=True, opset=17):
+    """把 Hugging Face 模型匯出成 ONNX (model.onnx)，quantize=True 時再產生 int8 版 (model_int8.onnx)。"""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    max_seq_length, normalize = _sentence_transformers_settings(model_name)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer.save_pretrained(output_dir)  # 會寫出 tokenizer.json，執行時只用 tokenizers 讀它
+
+    class LastHiddenState(torch.nn.Module):
+        # 用關鍵字參數呼叫 forward；不同版本的 transformers 位置參數的順序不一樣
+        def __init__(self, bert):
+            super().__init__()
+            self.bert = bert
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.bert(input_ids=input_ids, attention_mask=attention_mask,
+                             token_type_ids=token_type_ids).last_hidden_state
+
+    sample = tokenizer(["匯出用的範例句子", "another sample"], padding=True, return_tensors="pt")
+    fp32_path = os.path.join(output_dir, FP32_FILENAME)
+    started = time.perf_counter()
+    with torch.no_grad():
+        torch.onnx.export(
+            LastHiddenState(model),
+            tuple(sample[name] for name in INPUT_NAMES),
+            fp32_path,
+            input_names=INPUT_NAMES,
+            output_names=["last_hidden_state"],
+            dynamic_axes={name: {0: "batch", 1: "sequence"} for name in INPUT_NAMES + ["last_hidden_state"]},
+            opset_version=opset,
+            dynamo=False,
+        )
+    print(f"📦 已匯出 {fp32_path} ({time.perf_counter() - started:.1f} 秒)")
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        int8_path = os.path.join(output_dir, INT8_FILENAME)
+        # 動態量化：權重存成 int8，activation 執行時才量化，不需要校正資料
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+        print(f"📦 已量化 {int8_path} ({os.path.getsize(fp32_path) >> 20} MB → {os.path.getsize(int8_path) >> 20} MB)")
+
+    meta = {
+        "model_name": model_name,
+        "dimension": model.config.hidden_size,
+        "max_seq_length": max_seq_length,
+        "pooling": "mean",
+        "normalize": normalize,
+        "quantized": quantize,
+    }
+    with open(os.path.join(output_dir, META_FILENAME), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2, ensure_ascii=False)
+    return meta
+
+
+class OnnxEmbeddings:
+    """介面跟 LangChain 的 Embeddings 相同 (embed_documents / embed_query)，可以直接取代 HuggingFaceEmbeddings。"""
+
+    def __init__(self, model_dir=DEFAULT_ONNX_DIR, quantized=True, batch_size=16, threads=0):
+        from tokenizers import Tokenizer
+
+        meta_path = os.path.join(model_dir, META_FILENAME)
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(
+                f"{model_dir} 裡沒有匯出的 ONNX 模型，請先執行: python onnx_embeddings.py export --out {model_dir}")
+        with open(meta_path, encoding="utf-8") as f:
+            self.meta = json.load(f)
+        if quantized and not self.meta.get("quantized"):
+            raise FileNotFoundError(f"{model_dir} 沒有 int8 模型，請重新匯出 (不要加 --no-quantize)")
+
+        self.model_dir = model_dir
+        self.quantized = quantized
+        self.batch_size = batch_size
+        self.dimension = self.meta["dimension"]
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.meta["max_seq_length"])
+        self.tokenizer.no_padding()
+
+        self.threads = threads
+        self._load_session()
+
+        self._lock = threading.Lock()
+        self.embedded_texts = 0
+        self.embed_seconds = 0.0
+        # ONNX Runtime 的執行緒池不會跟著 fork 到子行程 (gunicorn preload)，子行程要重建 session；
+        # 在 fork hook 裡直接建 session 會卡住，所以只先丟掉，第一次用到時再載入。
+        # int8 模型只有十幾 MB，各 worker 各載一份影響不大
+        os.register_at_fork(after_in_child=self._restart_after_fork)
+
+    def _load_session(self):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.threads > 0:
+            options.intra_op_num_threads = self.threads
+        path = os.path.join(self.model_dir, INT8_FILENAME if self.quantized else FP32_FILENAME)
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def _restart_after_fork(self):
+        self._lock = threading.Lock()
+        self.session = None
+
+    def _encode_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        length = max(len(e.ids) for e in encodings)
+        # 自己補齊到這一批最長的長度 (補 0，attention_mask 為 0 的位置不會算進 pooling)
+        input_ids = np.zeros((len(texts), length), dtype=np.int64)
+        attention_mask = np.zeros((len(texts), length), dtype=np.int64)
+        token_type_ids = np.zeros((len(texts), length), dtype=np.int64)
+        for row, e in enumerate(encodings):
+            n = len(e.ids)
+            input_ids[row, :n] = e.ids
+            attention_mask[row, :n] = e.attention_mask
+            token_type_ids[row, :n] = e.type_ids
+
+        if self.session is None:
+            with self._lock:
+                if self.session is None:
+                    self._load_session()
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask, "token_type_ids": token_type_ids}
+        hidden = self.session.run(None, {k: v for k, v in feeds.items() if k in self._input_names})[0]
+
+        # mean pooling (跟 sentence-transformers 的 Pooling 一樣只平均有效 token)
+        mask = attention_mask[:, :, None].astype(np.float32)
+        vectors = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.meta.get("normalize", True):
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return vectors
+
+    def encode(self, texts):
+        """回傳 numpy 陣列 (len(texts), dimension)。"""
+        started = time.perf_counter()
+        # 依長度排序再分批，同一批的 padding 比較少；最後再排回原本順序
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for start in range(0, len(order), self.batch_size):
+            idx = order[start:start + self.batch_size]
+            vectors[idx] = self._encode_batch([texts[i] for i in idx])
+        with self._lock:
+            self.embedded_texts += len(texts)
+            self.embed_seconds += time.perf_counter() - started
+        return vectors
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        return self.encode(list(texts)).tolist()
+
+    def embed_query(self, text):
+        return self.encode([text])[0].tolist()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "onnx-int8" if self.quantized else "onnx",
+                "embedded_texts": self.embedded_texts,
+                "texts_per_sec": round(self.embedded_texts / self.embed_seconds, 1) if self.embed_seconds else 0.0,
+            }
+
+
+def create_embeddings(config, model_name=DEFAULT_MODEL_NAME):
+    # 依 config.ini 的 [embedding] backend 建立向量化後端：torch (HuggingFaceEmbeddings) 或 onnx
+    backend = config.get('embedding', 'backend', fallback='torch')
+    if backend == 'onnx':
+        return OnnxEmbeddings(
+            model_dir=config.get('embedding', 'onnx_dir', fallback=DEFAULT_ONNX_DIR),
+            quantized=config.getboolean('embedding', 'onnx_quantized', fallback=True),
+            # 批次太大反而慢 (padding 多、cache 放不下)，跟 process pool 的 batch_size 分開設定
+            batch_size=config.getint('embedding', 'onnx_batch_size', fallback=16),
+            threads=config.getint('embedding', 'onnx_threads', fallback=0),
+        )
+    if backend == 'torch':
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+        return HuggingFaceEmbeddings(model_name=model_name)
+    raise ValueError(f"不支援的 embedding backend: {backend} (可用: torch / onnx)")
+
+
+if __name__ == "__main__":
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+    arg_parser = argparse.ArgumentParser(description="MiniLM 的 ONNX 匯出與 int8 量化")
+    sub = arg_parser.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export", help="匯出 ONNX 並量化成 int8")
+    export.add_argument("--model", default=DEFAULT_MODEL_NAME, help="Hugging Face 模型名稱或本地目錄")
+    export.add_argument("--out", default=DEFAULT_ONNX_DIR)
+    export.add_argument("--no-quantize", action="store_true", help="只匯出 fp32")
+    args = arg_parser.parse_args()
+
+    if args.command == "export":
+        meta = export_onnx(args.model, args.out, quantize=not args.no_quantize)
+        print(f"✅ 完成: {json.dumps(meta, ensure_ascii=False)}")
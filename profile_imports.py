@@ -0,0 +1,101 @@
+import os
+import re
+import sys
+import io
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+# ==========================================
+# 啟動 import 時間分析 (python -X importtime)
+# ==========================================
+# 在子行程裡 import 各個入口模組 (會照常讀 config.ini、跑模組層級的程式碼)，
+# 解析 -X importtime 的輸出，列出總時間與最花時間的頂層套件。
+# --ref 可以同時量某個 git 版本 (用 git archive 解到暫存目錄)，方便比較改動前後：
+#
+#   python profile_imports.py app LineBot_RAG RAG_withmemory --ref HEAD~1
+#   python profile_imports.py app --top 15
+
+sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+_WALL = re.compile(r"@@wall (\S+)")
+
+
+def profile_module(module, cwd):
+    # 回傳 (import 花的毫秒數, [(累計毫秒, 直接 import 的套件), ...])；import 失敗就回傳 (None, 錯誤訊息)
+    # 總時間用子行程自己量的 wall time：背景暖機執行緒的 import 會插進 -X importtime 的輸出，
+    # 讓縮排層級對不上，所以逐套件的明細只當參考
+    code = ("import sys, time; started = time.perf_counter(); import {0}; "
+            "sys.__stderr__.write(f'@@wall {{time.perf_counter() - started}}\\n')").format(module)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=cwd, capture_output=True, text=True,
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE="1"),
+    )
+    wall = _WALL.search(result.stderr)
+    if result.returncode != 0 or wall is None:
+        errors = [l for l in (result.stderr + result.stdout).splitlines() if l and not l.startswith("import time:")]
+        return None, errors[-1:]
+
+    # -X importtime 先印子模組、再印父模組，縮排越深層級越深；
+    # 收集每一層還沒歸屬的套件，遇到入口模組那一行時，下一層收集到的就是它直接 import 的套件
+    entries, pending = [], {}
+    for line in result.stderr.splitlines():
+        m = _LINE.match(line)
+        if not m:
+            continue
+        depth = len(m.group(3)) // 2
+        children = pending.pop(depth + 1, [])
+        if m.group(4) == module and not entries:
+            entries = children
+        pending.setdefault(depth, []).append((int(m.group(2)) / 1000, m.group(4)))
+    return float(wall.group(1)) * 1000, sorted(entries, reverse=True)
+
+
+def export_ref(ref, cwd):
+    # 把某個 git 版本解到暫存目錄，config.ini / static / 索引檔這些沒進版控的東西複製過去
+    target = tempfile.mkdtemp(prefix="importtime-")
+    archive = subprocess.run(["git", "archive", ref], cwd=cwd, capture_output=True, check=True).stdout
+    subprocess.run(["tar", "-x", "-C", target], input=archive, check=True)
+    for name in ("config.ini", "bitcoin_paper.pdf", "chroma_db"):
+        src = os.path.join(cwd, name)
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(target, name), dirs_exist_ok=True)
+        elif os.path.exists(src):
+            shutil.copy(src, target)
+    return target
+
+
+def report(label, module, cwd, top):
+    total, entries = profile_module(module, cwd)
+    if total is None:
+        print(f"❌ [{label}] import {module} 失敗: {' '.join(entries)}")
+        return None
+    print(f"📦 [{label}] import {module}: {total:,.0f} ms")
+    for ms, name in entries[:top]:
+        print(f"    {ms:9,.1f} ms  {name}")
+    return total
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="入口模組的 import 時間分析")
+    arg_parser.add_argument("modules", nargs="+", help="要量測的模組，例如 app LineBot_RAG")
+    arg_parser.add_argument("--ref", help="同時量測這個 git 版本 (例如 HEAD~1)，用來比較前後")
+    arg_parser.add_argument("--top", type=int, default=10, help="列出最花時間的前幾個套件")
+    args = arg_parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    ref_dir = export_ref(args.ref, here) if args.ref else None
+    try:
+        for module in args.modules:
+            before = report(args.ref, module, ref_dir, args.top) if ref_dir else None
+            after = report("目前", module, here, args.top)
+            if before and after:
+                print(f"⏱️ {module}: {before:,.0f} ms → {after:,.0f} ms (x{before / after:.1f})")
+    finally:
+        if ref_dir:
+            shutil.rmtree(ref_dir, ignore_errors=True)
@@ -0,0 +1,75 @@
+import re
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+# ==========================================
+# 查詢向量快取 (LRU + TTL)
+# ==========================================
+# 用戶常常問一模一樣或幾乎一樣的問題 (例如「什麼是 Proof of Work？」)，
+# 每次都要跑一次 MiniLM 才能去 Pinecone 查詢。這裡把 embed_query 包一層快取，
+# key 是正規化後的文字，命中就直接拿舊向量，不必再做 model forward。
+
+_SPACES = re.compile(r"\s+")
+_TRAILING_PUNCT = "?？!！。.~～ "
+
+
+def normalize_query(text):
+    # 全形/半形統一 (NFKC)、大小寫、連續空白、結尾標點都視為同一個問題
+    text = unicodedata.normalize("NFKC", text).strip().lower()
+    text = _SPACES.sub(" ", text)
+    return text.rstrip(_TRAILING_PUNCT)
+
+
+class CachedQueryEmbeddings:
+    def __init__(self, embeddings, max_size=1024, ttl_seconds=3600):
+        self.embeddings = embeddings
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._cache = OrderedDict()  # key -> (建立時間, 向量)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def embed_query(self, text):
+        key = normalize_query(text)
+        now = time.monotonic()
+        with self._lock:
+            item = self._cache.get(key)
+            if item is not None and (self.ttl_seconds is None or now - item[0] < self.ttl_seconds):
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return list(item[1])
+            self.misses += 1
+
+        # 在鎖外面算向量，避免一個慢查詢卡住其他 worker
+        vector = self.embeddings.embed_query(text)
+
+        with self._lock:
+            self._cache[key] = (now, tuple(vector))
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return vector
+
+    def embed_documents(self, texts):
+        # 文件向量只在匯入時用到，不需要快取
+        return self.embeddings.embed_documents(texts)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._cache),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
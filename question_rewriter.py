@@ -0,0 +1,98 @@
+import re
+import threading
+
+
+# ==========================================
+# 問題改寫策略 (省掉 ConversationalRetrievalChain 的額外 Gemini 呼叫)
+# ==========================================
+# ConversationalRetrievalChain 只要有 chat_history，就會先多打一次 Gemini
+# 把「新問題 + 歷史」改寫成獨立問題，延遲和費用都翻倍。
+# 但大部分訊息本來就是完整問題 (沒有「它」「那個」這類指代)，根本不用改寫。
+#
+# 模式 (config.ini [conversation] condense_mode)：
+#   llm   : 原本的行為，有歷史就讓 Gemini 改寫
+#   auto  : 沒有指代詞就跳過改寫；有指代詞才交給 Gemini
+#   local : 完全不呼叫 Gemini，有指代詞時用上一題在本地組出獨立問題
+#
+# 跳過改寫的方法是傳空的 chat_history 給 chain：chain 看到沒有歷史就不會呼叫
+# question_generator。我們的 prompt 只用到 {context} 和 {question}，
+# 歷史本來就只用在改寫這一步，所以答案不受影響。
+
+CONDENSE_MODES = ("llm", "auto", "local")
+
+# 中文指代、承接上文的詞。中文沒有空白分詞，只用子字串比對，所以不放單字：
+# 「其」「該」「此」「他」會比對到「其他」「應該」「因此」這類一般用語，幾乎每句都要改寫
+_ZH_REFERENCES = (
+    "這個", "那個", "這些", "那些", "這樣", "那樣", "這種", "那種", "這裡", "那裡",
+    "上述", "前述", "上面", "剛剛", "剛才", "前面", "上一個",
+    "還有呢", "那呢", "然後呢", "為什麼呢", "舉例", "再說", "詳細", "繼續", "換句話說",
+)
+# 人稱代名詞要接著常見的搭配字才算 (它的、他們、她是…)；前面是「其」的 (其他、其它) 不算
+_ZH_PRONOUNS = re.compile(r"(?<!其)[它他她牠祂](?:們|的|是|有|會|在|能|可以|怎麼|為什麼)")
+_EN_REFERENCES = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|he|she|his|her|"
+    r"above|previous|former|latter|same|more|else|also|why|how so)\b",
+    re.IGNORECASE,
+)
+# 太短的訊息 (例如「為什麼？」「舉個例子」) 幾乎都是追問
+SHORT_FOLLOW_UP_CHARS = 6
+
+
+def needs_rewrite(question):
+    text = question.strip()
+    if len(text) <= SHORT_FOLLOW_UP_CHARS:
+        return True
+    if any(word in text for word in _ZH_REFERENCES) or _ZH_PRONOUNS.search(text):
+        return True
+    return bool(_EN_REFERENCES.search(text))
+
+
+def local_rewrite(question, chat_history):
+    # 不靠 LLM：把上一題當成主題接在前面，讓檢索與回答都知道在問什麼
+    last_question = chat_history[-1][0]
+    return f"關於「{last_question}」：{question}"
+
+
+class QuestionRewriter:
+    def __init__(self, mode="auto"):
+        if mode not in CONDENSE_MODES:
+            raise ValueError(f"condense_mode 必須是 {CONDENSE_MODES} 其中之一，收到: {mode}")
+        self.mode = mode
+        self._lock = threading.Lock()
+
+        self.skipped = 0        # 沒有歷史或不需要改寫，直接用原句
+        self.local_rewrites = 0 # 本地改寫
+        self.llm_rewrites = 0   # 交給 chain 用 Gemini 改寫
+
+    def prepare(self, question, chat_history):
+        """回傳 (要送進 chain 的 question, 要送進 chain 的 chat_history)。"""
+        if not chat_history:
+            return question, chat_history
+
+        if self.mode == "llm":
+            self._count("llm_rewrites")
+            return question, chat_history
+
+        if not needs_rewrite(question):
+            self._count("skipped")
+            return question, []
+
+        if self.mode == "auto":
+            self._count("llm_rewrites")
+            return question, chat_history
+
+        self._count("local_rewrites")
+        return local_rewrite(question, chat_history), []
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "skipped": self.skipped,
+                "local_rewrites": self.local_rewrites,
+                "llm_rewrites": self.llm_rewrites,
+            }
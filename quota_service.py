@@ -0,0 +1,152 @@
+import json
+import time
+import threading
+
+
+# ==========================================
+# 推播額度查詢 (快取 + single-flight + 本地計數)
+# ==========================================
+# 「quoda」指令以前每次都同步呼叫 /v2/bot/message/quota/consumption，
+# 用戶狂按時每一下都會打到 LINE。QuotaService 改成：
+#   - 上游結果快取 ttl_seconds 秒
+#   - 上游查詢失敗後 error_ttl_seconds 秒內不再重查，直接回覆上次的值 (沒有就回 None)
+#   - 過期時同一時間只有一個執行緒去問 LINE，其他人等它的結果
+#     (已經有舊值的話直接回覆「舊值 + 本地計數」，不用等)
+#   - 透過 LineClient 的 send listener 在本地累計自己送出的訊息，
+#     兩次查詢之間回傳「上次查到的用量 + 之後自己送出的數量」的即時估計
+#
+# LINE 的 totalUsage 只計算 push / multicast / broadcast 等推播訊息，reply 不算額度，
+# 所以估計值只加上推播的則數；reply 只記請求次數，不解析內容 (reply 常是預先序列化好的 bytes)。
+# 注意：本地計數只涵蓋這個行程送出的訊息。
+
+BILLED_KINDS = ("push", "multicast", "broadcast", "narrowcast")
+
+
+def message_count(payload):
+    if isinstance(payload, bytes):
+        payload = json.loads(payload)
+    count = len(payload.get("messages", []))
+    # multicast 每個收件人都算一次
+    if isinstance(payload.get("to"), list):
+        count *= len(payload["to"])
+    return count
+
+
+class QuotaService:
+    def __init__(self, fetch_usage, ttl_seconds=60, wait_seconds=10, error_ttl_seconds=15):
+        """fetch_usage() 向 LINE 查詢並回傳 totalUsage，失敗時丟例外。"""
+        self.fetch_usage = fetch_usage
+        self.ttl_seconds = ttl_seconds
+        self.wait_seconds = wait_seconds
+        self.error_ttl_seconds = error_ttl_seconds
+
+        self._lock = threading.Lock()
+        self._usage = None
+        self._fetched_at = 0.0
+        self._sent_since_fetch = 0
+        self._refreshing = None  # 進行中的查詢 (threading.Event)
+        self._failed_at = None   # 上次查詢失敗的時間；成功後清掉
+        self._last_error = None
+
+        self.upstream_calls = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.upstream_errors = 0
+        self.error_cache_hits = 0
+        self.billed_sent = 0
+        self.replies_sent = 0
+        self.record_errors = 0
+
+    def record_sent(self, kind, payload):
+        # 給 LineClient.add_send_listener 使用；統計失敗不能讓送訊息的流程跟著失敗
+        try:
+            if kind not in BILLED_KINDS:
+                with self._lock:
+                    self.replies_sent += 1
+                return
+            count = message_count(payload)
+            with self._lock:
+                self._sent_since_fetch += count
+                self.billed_sent += count
+        except Exception as e:
+            with self._lock:
+                self.record_errors += 1
+            print(f"⚠️ 推播額度本地計數失敗: {e}")
+
+    def _estimate(self):
+        return None if self._usage is None else self._usage + self._sent_since_fetch
+
+    def cached_usage(self):
+        # 快取還沒過期就回傳估計值，否則回傳 None (不會呼叫上游)
+        with self._lock:
+            if self._usage is not None and time.monotonic() - self._fetched_at < self.ttl_seconds:
+                self.cache_hits += 1
+                return self._estimate()
+        return None
+
+    def total_usage(self):
+        with self._lock:
+            if self._usage is not None and time.monotonic() - self._fetched_at < self.ttl_seconds:
+                self.cache_hits += 1
+                return self._estimate()
+            if self._failed_at is not None and time.monotonic() - self._failed_at < self.error_ttl_seconds:
+                # 剛剛才失敗過，先不打擾上游，回覆上次的值
+                self.error_cache_hits += 1
+                return self._estimate()
+            if self._refreshing is not None:
+                # 已經有人在查詢了
+                self.coalesced += 1
+                if self._usage is not None:
+                    return self._estimate()
+                event, leader = self._refreshing, False
+            else:
+                event = self._refreshing = threading.Event()
+                leader = True
+                sent_before = self._sent_since_fetch
+
+        if not leader:
+            event.wait(self.wait_seconds)
+            with self._lock:
+                return self._estimate()
+
+        try:
+            with self._lock:
+                self.upstream_calls += 1
+            usage = self.fetch_usage()
+            with self._lock:
+                self._usage = usage
+                self._fetched_at = time.monotonic()
+                self._failed_at = None
+                self._last_error = None
+                # 查詢期間送出的訊息可能還沒算進 totalUsage，保留下來
+                self._sent_since_fetch -= sent_before
+        except Exception as e:
+            print(f"⚠️ 查詢推播額度失敗: {e}")
+            with self._lock:
+                self._failed_at = time.monotonic()
+                self._last_error = str(e)
+                self.upstream_errors += 1
+        finally:
+            with self._lock:
+                self._refreshing = None
+            event.set()
+
+        with self._lock:
+            return self._estimate()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "usage_estimate": self._estimate(),
+                "last_upstream_usage": self._usage,
+                "sent_since_fetch": self._sent_since_fetch,
+                "upstream_calls": self.upstream_calls,
+                "cache_hits": self.cache_hits,
+                "coalesced": self.coalesced,
+                "upstream_errors": self.upstream_errors,
+                "error_cache_hits": self.error_cache_hits,
+                "last_error": self._last_error,
+                "billed_sent": self.billed_sent,
+                "replies_sent": self.replies_sent,
+                "record_errors": self.record_errors,
+            }
@@ -0,0 +1,109 @@
+import os
+import json
+import shutil
+import hashlib
+import urllib.request
+
+
+# ==========================================
+# 持久化向量索引 (Chroma on disk)
+# ==========================================
+# 以前每次啟動都要重新 讀 PDF -> 切塊 -> 向量化 -> 建 Chroma，冷啟動要幾十秒，
+# 多開幾個 gunicorn worker 就要再付幾次。現在把索引存在磁碟上，
+# 目錄名稱就是「PDF 內容雜湊 + 切塊/向量模型設定」算出來的 key，
+# key 沒變就直接打開舊索引，key 變了才重建。
+
+INDEX_FORMAT_VERSION = 1
+META_FILENAME = "index_meta.json"
+DEFAULT_PERSIST_ROOT = "chroma_db"
+DEFAULT_PDF_URL = "https://bitcoin.org/bitcoin.pdf"
+
+
+def download_pdf(pdf_filename, url=DEFAULT_PDF_URL):
+    # 檢查並下載 PDF (如果沒有的話)
+    if os.path.exists(pdf_filename):
+        return pdf_filename
+    print("📥 下載 PDF 中...")
+    headers = {'User-Agent': 'Mozilla/5.0'}
+    req = urllib.request.Request(url, headers=headers)
+    with urllib.request.urlopen(req) as response, open(pdf_filename, 'wb') as out_file:
+        out_file.write(response.read())
+    return pdf_filename
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def index_key(pdf_paths, model_name, chunk_size, chunk_overlap):
+    # 把「來源檔內容」與「會影響向量結果的設定」一起算雜湊
+    settings = {
+        "version": INDEX_FORMAT_VERSION,
+        "model_name": model_name,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "sources": sorted(
+            (os.path.basename(p), file_sha256(p)) for p in pdf_paths
+        ),
+    }
+    raw = json.dumps(settings, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return hashlib.sha256(raw).hexdigest()[:16], settings
+
+
+def load_and_split(pdf_paths, chunk_size=1000, chunk_overlap=200):
+    from langchain_community.document_loaders import PyPDFLoader
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    docs = []
+    for pdf_path in pdf_paths:
+        docs.extend(PyPDFLoader(pdf_path).load())
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return text_splitter.split_documents(docs)
+
+
+def load_or_build_chroma(pdf_paths, embeddings, model_name,
+                         chunk_size=1000, chunk_overlap=200,
+                         persist_root=DEFAULT_PERSIST_ROOT):
+    from langchain_community.vectorstores import Chroma
+
+    key, settings = index_key(pdf_paths, model_name, chunk_size, chunk_overlap)
+    index_dir = os.path.join(persist_root, key)
+
+    if os.path.exists(os.path.join(index_dir, META_FILENAME)):
+        print(f"📂 使用既有的向量索引: {index_dir}")
+        return Chroma(persist_directory=index_dir, embedding_function=embeddings)
+
+    # 先建在暫存目錄，完成後再 rename，避免多個 worker 同時啟動時讀到建到一半的索引
+    print(f"🔨 索引不存在或來源已變更，重新建立: {index_dir}")
+    os.makedirs(persist_root, exist_ok=True)
+    tmp_dir = f"{index_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    texts = load_and_split(pdf_paths, chunk_size, chunk_overlap)
+    db = Chroma.from_documents(texts, embeddings, persist_directory=tmp_dir)
+    del db
+    with open(os.path.join(tmp_dir, META_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(dict(settings, key=key, chunks=len(texts)), f, ensure_ascii=False, indent=2)
+
+    try:
+        os.rename(tmp_dir, index_dir)
+    except OSError:
+        # 別的 worker 已經先建好了，用它的就好
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    else:
+        _remove_stale_indexes(persist_root, keep=key)
+        print(f"✅ 向量索引建立完成，共 {len(texts)} 個段落")
+
+    return Chroma(persist_directory=index_dir, embedding_function=embeddings)
+
+
+def _remove_stale_indexes(persist_root, keep):
+    # 清掉舊 key 的索引目錄 (暫存目錄可能是別的 process 正在建，不動它)
+    for name in os.listdir(persist_root):
+        path = os.path.join(persist_root, name)
+        if name != keep and '.tmp-' not in name and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
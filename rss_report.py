@@ -0,0 +1,92 @@
+import os
+import sys
+import io
+import argparse
+
+# ==========================================
+# 各行程記憶體報告 (RSS / PSS / Private)
+# ==========================================
+# RSS 會把 copy-on-write 共用的分頁在每個 worker 都算一次，看不出 preload 省了多少；
+# PSS 把共用分頁平均分攤給共用的行程，Private 是只屬於該行程的部分，兩者加總才是真正用掉的記憶體。
+# 讀 /proc/<pid>/smaps_rollup，只支援 Linux。
+#
+#   gunicorn -c gunicorn.conf.py LineBot_RAG:app          # [startup] mode = background
+#   python rss_report.py --match gunicorn
+#   gunicorn -c gunicorn.conf.py LineBot_RAG:app          # [startup] mode = preload
+#   python rss_report.py --match gunicorn
+
+sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+
+def read_memory(pid):
+    # 回傳 {"rss": kB, "pss": kB, "private": kB}
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                fields[parts[0][:-1]] = int(parts[1])
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "private": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
+
+
+def read_cmdline(pid):
+    with open(f"/proc/{pid}/cmdline", "rb") as f:
+        return f.read().replace(b"\0", b" ").decode("utf-8", "replace").strip()
+
+
+def read_ppid(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        # comm 可能含空白，從最後一個 ")" 之後開始切
+        return int(f.read().rsplit(")", 1)[1].split()[1])
+
+
+def find_processes(match=None, root_pid=None):
+    processes = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit() or int(name) == os.getpid():
+            continue
+        pid = int(name)
+        try:
+            cmdline, ppid = read_cmdline(pid), read_ppid(pid)
+        except OSError:
+            continue
+        if root_pid is not None and pid != root_pid and ppid != root_pid:
+            continue
+        if match is not None and match not in cmdline:
+            continue
+        processes.append((pid, ppid, cmdline))
+    return sorted(processes)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="各行程的 RSS / PSS / Private 記憶體")
+    arg_parser.add_argument("--match", help="cmdline 含有這個字串的行程，例如 gunicorn")
+    arg_parser.add_argument("--pid", type=int, help="master PID；會一起列出它的子行程")
+    args = arg_parser.parse_args()
+    if args.match is None and args.pid is None:
+        arg_parser.error("請指定 --match 或 --pid")
+
+    processes = find_processes(args.match, args.pid)
+    if not processes:
+        print("找不到符合的行程")
+        sys.exit(1)
+
+    pids = {pid for pid, _, _ in processes}
+    total = {"rss": 0, "pss": 0, "private": 0}
+    print(f"{'PID':>7} {'角色':<6} {'RSS MB':>9} {'PSS MB':>9} {'Private MB':>11}  cmdline")
+    for pid, ppid, cmdline in processes:
+        try:
+            memory = read_memory(pid)
+        except OSError:
+            continue
+        role = "worker" if ppid in pids else "master"
+        for key in total:
+            total[key] += memory[key]
+        print(f"{pid:>7} {role:<6} {memory['rss'] / 1024:>9.1f} {memory['pss'] / 1024:>9.1f} "
+              f"{memory['private'] / 1024:>11.1f}  {cmdline[:60]}")
+    print(f"{'合計':>14} {total['rss'] / 1024:>9.1f} {total['pss'] / 1024:>9.1f} {total['private'] / 1024:>11.1f}")
+    print("(RSS 合計會重複計算共用分頁；實際用量請看 PSS 合計)")
@@ -0,0 +1,49 @@
+from line_stream import StreamingLineSender, LINE_MAX_MESSAGES_PER_REQUEST, LINE_MAX_TEXT_LENGTH
+
+# python -m pytest -q test_line_stream.py
+
+
+def make_sender(max_pushes, min_push_chars=200):
+    replies, pushes = [], []
+    sender = StreamingLineSender(replies.append, pushes.append,
+                                 min_push_chars=min_push_chars, max_pushes=max_pushes)
+    return sender, replies, pushes
+
+
+def long_answer(paragraphs=60, length=3000):
+    # 每段接近單則上限，整段答案會切成遠超過 5 則訊息
+    return "第一句。" + "".join("段" * length + "\n\n" for _ in range(paragraphs))
+
+
+def stream(sender, text, chunk=500):
+    for start in range(0, len(text), chunk):
+        sender.feed(text[start:start + chunk])
+    return sender.finish()
+
+
+def test_push_count_never_exceeds_max_pushes():
+    for max_pushes in (1, 2, 4):
+        sender, replies, pushes = make_sender(max_pushes)
+        stream(sender, long_answer())
+        assert len(replies) == 1
+        assert len(pushes) == sender.pushes <= max_pushes
+        for messages in pushes:
+            assert len(messages) <= LINE_MAX_MESSAGES_PER_REQUEST
+            assert all(len(m["text"]) <= LINE_MAX_TEXT_LENGTH for m in messages)
+
+
+def test_finish_merges_tail_into_last_push():
+    # 串流中都沒達到 min_push_chars，整段在 finish() 一次送出
+    sender, replies, pushes = make_sender(max_pushes=1, min_push_chars=10 ** 9)
+    stream(sender, "第一句。" + "字" * (LINE_MAX_TEXT_LENGTH * 6) + "\n" + "尾" * 10)
+    assert len(pushes) == 1
+    assert len(pushes[0]) == LINE_MAX_MESSAGES_PER_REQUEST
+    assert pushes[0][-1]["text"].endswith("…")
+
+
+def test_zero_max_pushes_only_replies():
+    sender, replies, pushes = make_sender(max_pushes=0)
+    answer = stream(sender, long_answer(paragraphs=3))
+    assert len(replies) == 1
+    assert pushes == []
+    assert answer.startswith("第一句。")
@@ -0,0 +1,204 @@
+import time
+import threading
+
+from bulk_push import TokenBucket
+
+
+# ==========================================
+# 每位用戶一次只跑一輪 RAG + 限速
+# ==========================================
+# 以前同一個用戶連傳三句話，三個 worker 會同時 qa_chain.invoke()，
+# 同時讀寫同一份對話記憶 (後寫的蓋掉先寫的)，Gemini 也被叫了三次。
+# UserScheduler 放在 JobQueue 前面：
+#   - 同一個 user_id 的訊息依序處理，前一輪跑完才開始下一輪
+#   - coalesce 開啟時，前一輪還在跑的期間傳來的訊息會合併成一個問題 (用最後一則的 reply token 回覆)；
+#     coalesce_window_seconds > 0 時第一則訊息也會先等這麼久再開始 (每則回覆都會慢這麼多，預設 0 不等)
+#   - 每位用戶與全域各有一個 token bucket 限制 LLM 呼叫次數；合併的訊息也要扣用戶的 token，
+#     用戶超速立即拒絕，全域超速最多等 global_wait_seconds
+# 序列化只在單一行程內有效；多個 gunicorn worker 時同一用戶仍可能落在不同行程。
+
+SWEEP_EVERY_N_SUBMITS = 500
+
+
+class _UserState:
+    __slots__ = ("pending", "active", "bucket", "last_seen")
+
+    def __init__(self, bucket):
+        self.pending = []
+        self.active = False
+        self.bucket = bucket
+        self.last_seen = time.monotonic()
+
+
+class UserScheduler:
+    def __init__(self, job_queue, handle_turn, on_reject=None, dedup=None, coalesce=True,
+                 coalesce_window_seconds=0.0, max_pending_per_user=5,
+                 user_rate_per_minute=6, user_burst=3,
+                 global_rate_per_second=2, global_burst=5, global_wait_seconds=10):
+        """handle_turn(event, text)：event 是這一輪最後一則訊息，text 是 (合併後的) 問題。
+        on_reject(event, reason)：訊息被拒絕時呼叫，reason 是 user_rate / global_rate / user_pending / queue_full。"""
+        self.job_queue = job_queue
+        self.handle_turn = handle_turn
+        self.on_reject = on_reject
+        self.dedup = dedup
+        self.coalesce = coalesce
+        self.coalesce_window_seconds = coalesce_window_seconds
+        self.max_pending_per_user = max_pending_per_user
+        self.user_rate_per_minute = user_rate_per_minute
+        self.user_burst = user_burst
+        self.global_wait_seconds = global_wait_seconds
+        # rate <= 0 表示不限速
+        self.global_bucket = TokenBucket(global_rate_per_second, global_burst) if global_rate_per_second > 0 else None
+
+        self._users = {}
+        self._submits = 0
+        self._lock = threading.Lock()
+
+        self.queued = 0
+        self.coalesced = 0
+        self.turns = 0
+        self.rejected = {"user_rate": 0, "global_rate": 0, "user_pending": 0, "queue_full": 0}
+
+    def _new_bucket(self):
+        if self.user_rate_per_minute <= 0:
+            return None
+        return TokenBucket(self.user_rate_per_minute / 60.0, self.user_burst)
+
+    def submit(self, user_id, event):
+        """回傳 queued / coalesced / rejected。"""
+        schedule = False
+        with self._lock:
+            state = self._users.get(user_id)
+            if state is None:
+                state = self._users[user_id] = _UserState(self._new_bucket())
+            state.last_seen = time.monotonic()
+
+            self._submits += 1
+            if self._submits % SWEEP_EVERY_N_SUBMITS == 0:
+                self._sweep()
+
+            if len(state.pending) >= self.max_pending_per_user:
+                reason = "user_pending"
+            elif state.bucket is not None and not state.bucket.try_acquire():
+                # 合併的訊息一樣要扣 token，否則連續狂傳就能繞過用戶的限速
+                reason = "user_rate"
+            elif self.coalesce and state.pending:
+                # 下一輪還沒開始，直接併進去，不多花一次 LLM 呼叫
+                state.pending.append(event)
+                self.coalesced += 1
+                return "coalesced"
+            else:
+                reason = None
+                state.pending.append(event)
+                self.queued += 1
+                if not state.active:
+                    state.active = True
+                    schedule = True
+
+        if reason is not None:
+            self._reject([event], reason)
+            return "rejected"
+        if schedule:
+            if self.coalesce and self.coalesce_window_seconds > 0:
+                timer = threading.Timer(self.coalesce_window_seconds, self._dispatch, args=(user_id,))
+                timer.daemon = True
+                timer.start()
+            else:
+                self._dispatch(user_id)
+        return "queued"
+
+    def _dispatch(self, user_id):
+        if self.job_queue.submit(self._run_turn, user_id):
+            return
+        # 背景佇列滿了：這位用戶等待中的訊息全部拒絕
+        with self._lock:
+            state = self._users[user_id]
+            events, state.pending = state.pending, []
+            state.active = False
+        print(f"⚠️ 工作佇列已滿 (深度 {self.job_queue.depth()})，拒絕新訊息")
+        self._reject(events, "queue_full")
+
+    def _run_turn(self, user_id):
+        with self._lock:
+            state = self._users[user_id]
+            if self.coalesce:
+                events, state.pending = state.pending, []
+            else:
+                events = [state.pending.pop(0)]
+
+        try:
+            if self.global_bucket is not None and not self.global_bucket.try_acquire(self.global_wait_seconds):
+                self._reject(events, "global_rate")
+                return
+            if len(events) > 1:
+                print(f"🧩 合併 {len(events)} 則連續訊息成一個問題")
+            text = "\n".join(e.text for e in events)
+            with self._lock:
+                self.turns += 1
+            try:
+                self.handle_turn(events[-1], text)
+            except BaseException:
+                self._release(events)
+                raise
+            if self.dedup is not None:
+                for e in events:
+                    self.dedup.complete(e.webhook_event_id)
+        finally:
+            # 這一輪結束才排下一輪，確保同一用戶不會同時有兩輪在跑
+            with self._lock:
+                more = bool(state.pending)
+                if not more:
+                    state.active = False
+            if more:
+                self._dispatch(user_id)
+
+    def _reject(self, events, reason):
+        with self._lock:
+            self.rejected[reason] += len(events)
+        self._release(events)
+        if self.on_reject is not None:
+            for e in events:
+                self.on_reject(e, reason)
+
+    def _release(self, events):
+        if self.dedup is not None:
+            for e in events:
+                self.dedup.release(e.webhook_event_id)
+
+    def _sweep(self):
+        # 閒置到 token bucket 已經補滿的用戶可以整個丟掉，下次再建新的
+        idle_seconds = 60.0 * max(1, self.user_burst) / max(self.user_rate_per_minute, 1)
+        now = time.monotonic()
+        for user_id in [u for u, s in self._users.items()
+                        if not s.active and not s.pending and now - s.last_seen > idle_seconds]:
+            del self._users[user_id]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": len(self._users),
+                "active_users": sum(1 for s in self._users.values() if s.active),
+                "pending": sum(len(s.pending) for s in self._users.values()),
+                "queued": self.queued,
+                "coalesced": self.coalesced,
+                "turns": self.turns,
+                "rejected": dict(self.rejected),
+            }
+
+
+def create_user_scheduler(config, job_queue, handle_turn, on_reject=None, dedup=None):
+    # 依 config.ini 的 [user-scheduler] 區段建立
+    return UserScheduler(
+        job_queue,
+        handle_turn,
+        on_reject=on_reject,
+        dedup=dedup,
+        coalesce=config.getboolean('user-scheduler', 'coalesce', fallback=True),
+        coalesce_window_seconds=config.getfloat('user-scheduler', 'coalesce_window_seconds', fallback=0.0),
+        max_pending_per_user=config.getint('user-scheduler', 'max_pending_per_user', fallback=5),
+        user_rate_per_minute=config.getfloat('user-scheduler', 'user_rate_per_minute', fallback=6),
+        user_burst=config.getint('user-scheduler', 'user_burst', fallback=3),
+        global_rate_per_second=config.getfloat('user-scheduler', 'global_rate_per_second', fallback=2),
+        global_burst=config.getint('user-scheduler', 'global_burst', fallback=5),
+        global_wait_seconds=config.getfloat('user-scheduler', 'global_wait_seconds', fallback=10),
+    )
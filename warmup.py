@@ -0,0 +1,113 @@
+import os
+import time
+import threading
+
+from flask import jsonify
+
+
+# ==========================================
+# 背景暖機 + 存活/就緒檢查
+# ==========================================
+# RAG bot 以前在 import 階段就載入 langchain、sentence-transformers/torch、Chroma、Pinecone，
+# 還要打開索引，全部完成之前 Flask 連 port 都還沒開，health check 只能一直失敗。
+# 現在把這些重量級初始化包成 init 函式交給 Warmup：
+#   - mode = background：port 立刻開始服務，init 在背景執行緒跑
+#   - mode = eager     ：跟以前一樣，啟動時先跑完 init 才開始服務 (失敗就結束行程)
+#   - mode = preload   ：給 gunicorn preload_app / uwsgi 這類先 import 再 fork 的部署 (見 gunicorn.conf.py)。
+#                        master 先跑 preload (載入向量模型這類唯讀、可以 copy-on-write 共用的東西)，
+#                        fork 出來的每個 worker 再各自在背景跑 init (不能跨 fork 的連線、索引)
+# 並提供兩個檢查端點：
+#   GET / 、GET /healthz : 存活 (liveness)，行程活著就回 200
+#   GET /readyz          : 就緒 (readiness)，init 完成才回 200，否則 503
+
+STARTING = "starting"
+READY = "ready"
+FAILED = "failed"
+
+
+class Warmup:
+    def __init__(self, name, init):
+        self.name = name
+        self.init = init
+        self.state = STARTING
+        self.error = None
+        self.started_at = None
+        self.seconds = None
+        self._ready = threading.Event()
+        self._done = threading.Event()
+        self._thread = None
+
+    def run(self):
+        self.started_at = time.time()
+        started = time.perf_counter()
+        try:
+            self.init()
+            self.state = READY
+            self._ready.set()
+        except Exception as e:
+            self.state = FAILED
+            self.error = str(e)
+            print(f"❌ {self.name} 初始化失敗: {e}")
+        finally:
+            self.seconds = round(time.perf_counter() - started, 3)
+            self._done.set()
+        if self.state == READY:
+            print(f"✅ {self.name} 暖機完成 ({self.seconds} 秒)")
+        return self.state == READY
+
+    def start(self):
+        # 已經在跑或跑完 (eager) 就不再重複
+        if self._thread is None and not self._done.is_set():
+            self._thread = threading.Thread(target=self.run, name=f"{self.name}-warmup", daemon=True)
+            self._thread.start()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def wait(self, timeout=None):
+        # 給背景 worker 用：等暖機完成最多 timeout 秒；回傳是否已就緒
+        self._done.wait(timeout)
+        return self.ready
+
+    def status(self):
+        return {
+            "name": self.name,
+            "state": self.state,
+            "error": self.error,
+            "started_at": self.started_at,
+            "seconds": self.seconds,
+        }
+
+
+def register_health_routes(app, warmup):
+    def liveness():
+        return "OK", 200
+
+    def readiness():
+        return jsonify(warmup.status()), (200 if warmup.ready else 503)
+
+    app.add_url_rule("/", "liveness", liveness, methods=["GET"])
+    app.add_url_rule("/healthz", "healthz", liveness, methods=["GET"])
+    app.add_url_rule("/readyz", "readyz", readiness, methods=["GET"])
+
+
+def start_warmup(config, name, init, preload=None):
+    # 依 config.ini 的 [startup] mode 決定背景暖機、啟動時就跑完，或 master 預載 + worker 暖機
+    warmup = Warmup(name, init)
+    mode = config.get('startup', 'mode', fallback='background')
+    if mode == 'background':
+        warmup.start()
+    elif mode == 'eager':
+        if not warmup.run():
+            raise SystemExit(1)
+    elif mode == 'preload':
+        if preload is not None:
+            started = time.perf_counter()
+            preload()
+            print(f"📦 {name} 已在 master 預載 ({time.perf_counter() - started:.2f} 秒)，等待 fork worker")
+        # 執行緒不會跟著 fork 到子行程，所以 init 要在每個 worker 裡才開始跑
+        os.register_at_fork(after_in_child=warmup.start)
+    else:
+        raise ValueError(f"不支援的 startup mode: {mode} (可用: background / eager / preload)")
+    return warmup
@@ -0,0 +1,102 @@
+import hmac
+import json
+import base64
+import hashlib
+import threading
+
+try:
+    # orjson 直接吃 bytes，比標準 json 快很多；沒安裝就退回 json
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    orjson = None
+    _loads = json.loads
+
+
+# ==========================================
+# 共用的 Webhook 入口：驗簽 + 解析
+# ==========================================
+# 以前 Pinecone bot 先把 body 解碼成字串、再編碼回 bytes 算 HMAC，用 != 比對簽章
+# (不是固定時間比較)，再 json.loads 一次；另外兩個 RAG bot 完全沒驗簽。
+# WebhookIngress 統一處理：
+#   - 直接用原始 bytes 算 HMAC-SHA256，以 hmac.compare_digest 比對 X-Line-Signature
+#   - 只解析一次 (有 orjson 就用 orjson)
+#   - 把事件包成 WebhookEvent 物件交給 handler，不用再到處寫 event['message']['text']
+
+
+class InvalidSignatureError(Exception):
+    pass
+
+
+class WebhookEvent:
+    __slots__ = ("type", "reply_token", "webhook_event_id", "is_redelivery", "timestamp",
+                 "source_type", "user_id", "group_id", "message_type", "message_id", "text",
+                 "postback_data", "raw")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.type = raw.get("type")
+        self.reply_token = raw.get("replyToken")
+        self.webhook_event_id = raw.get("webhookEventId")
+        self.is_redelivery = raw.get("deliveryContext", {}).get("isRedelivery", False)
+        self.timestamp = raw.get("timestamp")
+
+        source = raw.get("source", {})
+        self.source_type = source.get("type")
+        self.user_id = source.get("userId")
+        self.group_id = source.get("groupId") or source.get("roomId")
+
+        message = raw.get("message", {})
+        self.message_type = message.get("type")
+        self.message_id = message.get("id")
+        self.text = message.get("text")
+        self.postback_data = raw.get("postback", {}).get("data")
+
+    @property
+    def is_text_message(self):
+        return self.type == "message" and self.message_type == "text"
+
+    def __repr__(self):
+        return f"WebhookEvent(type={self.type!r}, message_type={self.message_type!r}, user_id={self.user_id!r})"
+
+
+class WebhookIngress:
+    def __init__(self, channel_secret):
+        self._key = channel_secret.encode("utf-8")
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+
+    def signature_for(self, body):
+        return base64.b64encode(hmac.new(self._key, body, hashlib.sha256).digest())
+
+    def verify(self, body, signature):
+        """body 是原始 bytes；signature 是 X-Line-Signature header。"""
+        if not signature:
+            return False
+        return hmac.compare_digest(self.signature_for(body), signature.encode("ascii", "ignore"))
+
+    def parse(self, body):
+        # JSON 格式錯誤本身就是 ValueError；格式正確但不是 webhook 的結構 ([]、"x") 也當成 ValueError，呼叫端回 400
+        payload = _loads(body)
+        if not isinstance(payload, dict):
+            raise ValueError(f"webhook body 必須是 JSON object，收到 {type(payload).__name__}")
+        events = payload.get("events", [])
+        if not isinstance(events, list) or not all(isinstance(raw, dict) for raw in events):
+            raise ValueError("webhook body 的 events 必須是 object 的 list")
+        return [WebhookEvent(raw) for raw in events]
+
+    def handle(self, body, signature):
+        # 驗簽失敗丟 InvalidSignatureError；成功回傳 WebhookEvent list
+        if not self.verify(body, signature):
+            with self._lock:
+                self.rejected += 1
+            raise InvalidSignatureError("X-Line-Signature 驗證失敗")
+        events = self.parse(body)
+        with self._lock:
+            self.accepted += 1
+        return events
+
+    def stats(self):
+        with self._lock:
+            return {"accepted": self.accepted, "rejected": self.rejected, "json": "orjson" if orjson else "json"}